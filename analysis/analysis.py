@@ -1,3 +1,6 @@
+import json
+import logging
+import re
 import numpy as np
 import pandas as pd
 from scipy.optimize import curve_fit
@@ -6,11 +9,16 @@ from registry.models import *
 from registry.util import *
 from analysis.util import *
 from . import inverse
+from . import cache
+from . import growth
+from flapjack_api.timing import span
 from scipy.interpolate import interp1d, UnivariateSpline
 from scipy.signal import medfilt, savgol_filter
 import wellfare as wf
 import time
 
+logger = logging.getLogger('flapjack.analysis')
+
 remove_background = {
         'Velocity': False,
         'Mean Velocity': False,
@@ -28,11 +36,25 @@ remove_background = {
         'Background Correct': True
     }
 
+def combine_results(results):
+    '''
+    Combine a dict of analysis type -> result dataframe into one dataframe
+    with an Analysis column
+    '''
+    frames = [result.assign(Analysis=analysis_type) 
+                for analysis_type, result in results.items() if len(result)>0]
+    if len(frames)==0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True, sort=False)
+
 # Main analysis class
 class Analysis:
-    def __init__(self, params, signals):
+    def __init__(self, params, signals, check=None):
         self.set_params(params)
         self.signals = signals
+        # Called for each sample analyzed, raises JobCancelled to stop
+        # the analysis of a cancelled job, see flapjack_api.jobs
+        self.check = check
         # Functions to call for particular analysis types
         self.analysis_funcs = {
             'Velocity': self.velocity,
@@ -51,9 +73,22 @@ class Analysis:
             'Background Correct': self.background_correct
         }
         self.background = {}
+        self.biomass = {}
+        self.smoothed_biomass = {}
+        self.growth_fits = {}
+        self.corrected = {}
+        # Data versions of the samples looked up in the result cache, and the
+        # samples looked up for each analysis type and parameters
+        self.versions = {}
+        self.looked_up = {}
 
     def set_params(self, params):
-        self.analysis_type = params['type']
+        # A list of types is analyzed in a single pass, see analyze_all
+        if isinstance(params['type'], (list, tuple)):
+            self.analysis_types = list(params['type'])
+        else:
+            self.analysis_types = [params['type']]
+        self.analysis_type = self.analysis_types[0]
         self.density_name = params.get('biomass_signal')
         self.ref_name = params.get('ref_signal')
         self.bg_std_devs = float(params.get('bg_correction', 0))
@@ -70,18 +105,258 @@ class Analysis:
         self.chemical_id = params.get('analyte', None)
         self.chemical_id1 = params.get('analyte1', None)
         self.chemical_id2 = params.get('analyte2', None)
-        self.bounds = [[0,0,0,0], [1,1,1,24]]
+        # Bounds for Gompertz model parameters (y0, ymax, um, l)
+        self.bounds = ([1e-2,0.01,0,-24], [1,4,2,24])
         self.function = params.get('function')
+        # Reuse stored results of samples whose data has not changed
+        self.incremental = bool(params.get('incremental', True))
+        # Automatic choice of eps and n_gaussians for the inverse method
+        self.sweep = bool(params.get('sweep', False))
+        self.sweep_method = params.get('sweep_method', 'gcv')
+        self.sweep_eps = [float(eps) for eps in params.get('sweep_eps', np.logspace(-4, 0, 9))]
+        self.sweep_n_gaussians = [int(n) for n in params.get('sweep_n_gaussians', [10, 20, 30, 40])]
+        self.sweep_samples = int(params.get('sweep_samples', 24))
+        self.regularization = None
+
+    def canonical_params(self):
+        '''
+        Analysis parameters as a json string, equal for equivalent requests
+        '''
+        params = dict(
+            type=self.analysis_type,
+            biomass_signal=self.density_name,
+            ref_signal=self.ref_name,
+            bg_correction=self.bg_std_devs,
+            min_biomass=self.min_density,
+            ndt=self.n_doubling_times,
+            remove_data=self.remove_data,
+            smoothing_type=self.smoothing_type,
+            pre_smoothing=self.smoothing_param1,
+            post_smoothing=self.smoothing_param2,
+            degr=self.degr,
+            eps_L=self.eps_L,
+            n_gaussians=self.n_gaussians,
+            eps=self.eps,
+            analyte=self.chemical_id,
+            analyte1=self.chemical_id1,
+            analyte2=self.chemical_id2,
+            function=self.function,
+            signals=sorted(self.signals) if self.signals else None
+        )
+        return json.dumps(params, sort_keys=True, default=str)
+
+    def get_cached_results(self, samples):
+        '''
+        Return a list of cached result dataframes and the queryset of samples
+        that still need to be analyzed because their data has changed
+        '''
+        if not self.incremental or not cache.cache_enabled() or len(self.analysis_types)>1:
+            return [], samples
+        if self.needs_sweep():
+            # Parameters are not known until the sweep has run
+            return [], samples
+        cached = self.lookup_results(samples.values_list('id', flat=True))
+        return list(cached.values()), samples.exclude(id__in=list(cached))
+
+    def lookup_results(self, sample_ids):
+        '''
+        Return dict of sample id -> cached result of the samples not already
+        looked up with the current analysis type and parameters, recording
+        their data versions to store their results once computed
+        '''
+        key = (self.analysis_type, self.canonical_params())
+        looked_up = self.looked_up.setdefault(key, set())
+        sample_ids = [samp_id for samp_id in sample_ids if samp_id not in looked_up]
+        if len(sample_ids)==0:
+            return {}
+        versions = cache.get_data_versions(sample_ids)
+        self.versions.update(versions)
+        looked_up.update(sample_ids)
+        if not self.incremental:
+            return {}
+        return cache.get_results(self.analysis_type, key[1], versions)
+
+    def get_data(self, samples):
+        '''
+        Return the results of the samples that are known without analyzing
+        their measurements, from the measurement summaries or stored results,
+        and the measurements of the other samples. The regularization of the
+        inverse method is chosen here, once for all plates, if requested.
+
+        Returns:
+        results = list of result dataframes
+        df = measurements to analyze, one plate at a time with analyze
+        '''
+        summary = self.analyze_summaries(samples)
+        if summary is not None:
+            # Answered from the measurement summaries
+            return [summary], pd.DataFrame()
+        # Stored results are reused, only samples whose data changed are analyzed
+        results, samples = self.get_cached_results(samples)
+        df = get_measurements(samples, self.signals)
+        if self.needs_sweep():
+            self.select_regularization(df)
+        return results, df
+
+    def analyze_summaries(self, samples):
+        '''
+        Compute Mean Expression or Max Expression of the samples from their
+        measurement summaries, without reading the measurements
 
-    def analyze_data(self, df):     
+        Returns:
+        result = dataframe as returned by analyze_data, or None if the result
+            cannot be computed exactly from the summaries
+        '''
+        if len(self.analysis_types)>1 or self.analysis_type not in ['Mean Expression', 'Max Expression']:
+            return None
+        if self.remove_data:
+            # Points below the background threshold are removed individually
+            return None
+        df = get_summaries(samples, self.signals)
+        if len(df)==0:
+            return None
+
+        # Background correction of the summaries, see bg_correct. The mean
+        # of the corrected series is the mean minus the mean background,
+        # the max is only known if there is no background to subtract.
+        df = df.dropna(subset=['Vector'])
+        if len(df)==0:
+            return df
+        background = self.get_summary_background(df)
+        if background is None:
+            return None
+        bg = [
+            background.get((assay, media), {}).get(signal_id, (0., None))
+            for assay, media, signal_id in zip(df['Assay'], df['Media'], df['Signal_id'])
+        ]
+        # The background is subtracted time point by time point, so series
+        # and background must be of the same length
+        if any(count is not None and count!=n for (_, count), n in zip(bg, df['Count'])):
+            return None
+        bg = np.array([mean for mean, _ in bg])
+        if self.analysis_type=='Max Expression':
+            if np.any(bg!=0):
+                return None
+            df['Measurement'] = df['Max']
+        else:
+            df['Measurement'] = df['Measurement'] - bg
+        df = df.dropna(subset=['Measurement'])
+        df = df.drop(columns=['Count', 'Min', 'Max', 'Std', 'Last Time', 'AUC'])
+        return self.analysis_funcs[self.analysis_type](df)
+
+    def get_summary_background(self, df):
+        '''
+        Return dict of (assay, media) -> {signal id: (mean background, series
+        length)}, from the summaries of the control samples as in
+        compute_background. The mean of the control means is the mean
+        background only if the control series are of the same length, None
+        is returned otherwise.
+        '''
+        assays = df['Assay'].unique()
+        controls = MeasurementSummary.objects.filter(
+                            sample__assay__name__in=list(assays),
+                            sample__vector__isnull=True
+                        ).values_list('sample__assay__name', 'sample__media__name', 
+                                        'sample__strain__id', 'signal_id', 'mean', 'count')
+        controls = pd.DataFrame.from_records(list(controls), 
+                        columns=['Assay', 'Media', 'Strain', 'Signal_id', 'Mean', 'Count'])
+        background = {}
+        for (assay, media), data in controls.groupby(['Assay', 'Media']):
+            no_cells = data[data['Strain'].isnull()]
+            if len(no_cells)==0:
+                # No background data to subtract
+                continue
+            # Media background for biomass, strain background for the rest
+            data = pd.concat([data[data['Signal_id']!=self.density_name],
+                              no_cells[no_cells['Signal_id']==self.density_name]])
+            stats = data.groupby('Signal_id')['Count'].agg(['nunique', 'first'])
+            if (stats['nunique']>1).any():
+                return None
+            means = data.groupby('Signal_id')['Mean'].mean()
+            background[(assay, media)] = {
+                signal_id: (means[signal_id], stats.loc[signal_id, 'first']) for signal_id in means.index
+            }
+        return background
+
+    def analyze(self, df):
+        '''
+        Analyze df with the requested analysis type, or with all the types
+        combined in one dataframe if a list of types was requested
+        '''
+        if len(self.analysis_types)>1:
+            return combine_results(self.analyze_all(df))
+        return self.analyze_data(df)
+
+    def analyze_all(self, df):
+        '''
+        Analyze df with each of the requested analysis types, sharing the
+        background corrected data, biomass, smoothing and growth fits
+
+        Returns:
+        results = dict of analysis type -> result dataframe
+        '''
+        results = {}
+        for analysis_type in self.analysis_types:
+            self.analysis_type = analysis_type
+            results[analysis_type] = self.analyze_data(df)
+        self.analysis_type = self.analysis_types[0]
+        return results
+
+    def analyze_data(self, df):
+        '''
+        Analyze the data in df, reusing cached results for samples that have
+        already been analyzed with the same parameters and data. Samples
+        already looked up by get_cached_results are not looked up again.
+        '''
+        if self.needs_sweep() and self.analysis_type=='Expression Rate (inverse)':
+            self.select_regularization(df)
+        if len(df)==0:
+            # Nothing to analyze, e.g. all samples had cached results
+            return df
+        if not cache.cache_enabled():
+            return self.compute(df)
+
+        cached = self.lookup_results(df['Sample'].unique())
+        results = list(cached.values())
+        data = df[~df['Sample'].isin(list(cached))]
+        if len(data)>0:
+            result = self.compute(data)
+            pairs = list(data.groupby(['Sample', 'Signal_id']).groups)
+            cache.store_results(self.analysis_type, self.canonical_params(), pairs, self.versions, result)
+            results.append(result)
+        return pd.concat(results)
+
+    def compute(self, df):
+        n_samples = df['Sample'].nunique() if 'Sample' in df.columns else 0
         # Is it necessary to remove background for this analysis?
         if remove_background[self.analysis_type]:
-            df = self.bg_correct(df)
+            with span('analysis.background', samples=n_samples):
+                df = self.get_corrected(df)
         # Apply analysis to dataframe
         analysis_func = self.analysis_funcs[self.analysis_type]
-        df = analysis_func(df)
+        with span('analysis.compute', type=self.analysis_type, samples=n_samples):
+            df = analysis_func(df)
         return df
 
+    def get_corrected(self, df):
+        '''
+        Return the background corrected data of the samples in df. Samples
+        are corrected once and reused by all analyses of this object.
+        '''
+        samp_ids = sorted(df['Sample'].unique())
+        missing = [samp_id for samp_id in samp_ids if samp_id not in self.corrected]
+        if len(missing)>0:
+            corrected = self.bg_correct(df[df['Sample'].isin(missing)])
+            for samp_id in missing:
+                self.corrected[samp_id] = None
+            if len(corrected)>0:
+                for samp_id, samp_data in corrected.groupby('Sample'):
+                    self.corrected[samp_id] = samp_data
+        frames = [self.corrected[samp_id] for samp_id in samp_ids if self.corrected[samp_id] is not None]
+        if len(frames)==0:
+            return df.iloc[0:0]
+        return pd.concat(frames)
+
     def compute_background(self, assay, media, strain):
         s = Sample.objects.filter(assay__name__exact=assay) \
                             .filter(media__name__exact=media)
@@ -127,6 +402,44 @@ class Analysis:
             self.background[key] = self.compute_background(assay, media, strain)
         return self.background[key]
 
+    def get_biomass_index(self, df):
+        '''
+        Return a dict mapping sample id to (time, biomass) arrays sorted by
+        time, background corrected. Biomass is loaded only for samples not
+        already in the index, so it is shared by all analyses of this object.
+        '''
+        samp_ids = [samp_id for samp_id in df['Sample'].unique() if samp_id not in self.biomass]
+        if len(samp_ids)>0:
+            density_df = get_biomass(df[df['Sample'].isin(samp_ids)], self.density_name)
+            density_df = self.bg_correct(density_df)
+            empty = (np.array([]), np.array([]))
+            for samp_id in samp_ids:
+                self.biomass[samp_id] = empty
+            if len(density_df)>0:
+                density_df = density_df.sort_values(['Sample', 'Time'])
+                for samp_id, density in density_df.groupby('Sample', sort=False):
+                    self.biomass[samp_id] = (density['Time'].values, density['Measurement'].values)
+        return self.biomass
+
+    def get_growth_fits(self, df):
+        '''
+        Return a dict mapping sample id to the Gompertz model parameters fitted
+        to its biomass, or None if the fit failed. Only samples not already
+        fitted are fitted, so the fits are shared by all analyses of this
+        object (e.g. Alpha and Rho).
+        '''
+        biomass = self.get_biomass_index(df)
+        series = {}
+        for samp_id, samp_data in df.groupby('Sample'):
+            if samp_id not in self.growth_fits:
+                odt, odval = biomass[samp_id]
+                # Position in the plate, neighbouring wells warm start each other
+                position = tuple(samp_data[['Assay', 'Row', 'Column']].values[0])
+                series[samp_id] = (odt[odval>0.], odval[odval>0.], position)
+        if len(series)>0:
+            self.growth_fits.update(growth.fit_gompertz_batch(series, self.bounds, check=self.check))
+        return self.growth_fits
+
     def bg_correct(self, df):
         # Empty dataframe to accumulate result
         meas_bg_corrected = pd.DataFrame()
@@ -144,6 +457,7 @@ class Analysis:
         rows = []
         grouped_sample = meas.groupby('Sample')
         for samp_id,sample_data in grouped_sample:
+            self.check_cancelled()
             assay = sample_data['Assay'].values[0]
             media = sample_data['Media'].values[0]
             strain = sample_data['Strain'].values[0]
@@ -159,8 +473,6 @@ class Analysis:
                     bg_media_mean, bg_media_std = bg_media.get(name, (0.,0.))
                     vals_corrected = vals - bg_media_mean
                     if self.remove_data:
-                        print('Correcting OD bg', flush=True)
-                        print('Removing %d data points'%np.sum(vals_corrected < self.bg_std_devs*bg_media_std), flush=True)
                         vals_corrected[vals_corrected < np.maximum(self.bg_std_devs*bg_media_std, self.min_density)] = np.nan
                     #print('bgmean, bgstd = ', bg_media_mean, bg_media_std)
                 else:
@@ -168,8 +480,6 @@ class Analysis:
                     bg_strain_mean, bg_strain_std = bg_strain.get(name, (0.,0.))
                     vals_corrected = vals - bg_strain_mean
                     if self.remove_data:
-                        print('Correcting fluo bg', flush=True)
-                        print('Removing %d data points'%np.sum(vals_corrected < self.bg_std_devs*bg_strain_std), flush=True)
                         vals_corrected[vals_corrected < self.bg_std_devs*bg_strain_std] = np.nan
                     #print('bgmean, bgstd = ', bg_strain_mean, bg_strain_std)
 
@@ -206,7 +516,6 @@ class Analysis:
         pre_smoothing = Savitsky-Golay filter parameter (window size)
         post_smoothing = Savitsky-Golay filter parameter (window size)
         '''
-        print(self.smoothing_param1, self.smoothing_param2, flush=True)
         
         result = pd.DataFrame()
         rows = []
@@ -217,10 +526,8 @@ class Analysis:
         grouped_sample = df.groupby('Sample')
         n_samples = len(grouped_sample)
         # Loop over samples
-        si = 1
         for samp_id, samp_data in grouped_sample:
-            print('Computing velocity of sample %d of %d'%(si, n_samples), flush=True)
-            si += 1
+            self.check_cancelled()
             for meas_name, data in samp_data.groupby('Signal_id'):
                 data = data.sort_values('Time')
                 time = data['Time'].values
@@ -278,9 +585,7 @@ class Analysis:
         pre_smoothing = Savitsky-Golay filter parameter (window size)
         post_smoothing = Savitsky-Golay filter parameter (window size)
         '''
-        print(self.smoothing_param1, self.smoothing_param2, flush=True)
-        density_df = get_biomass(df, self.density_name)
-        density_df = self.bg_correct(density_df)
+        biomass = self.get_biomass_index(df)
 
         result = pd.DataFrame()
         rows = []
@@ -291,18 +596,13 @@ class Analysis:
         grouped_sample = df.groupby('Sample')
         n_samples = len(grouped_sample)
         # Loop over samples
-        si = 1
         for samp_id, samp_data in grouped_sample:
-            print('Computing indirect expression rate of sample %d of %d'%(si, n_samples), flush=True)
-            si += 1
+            self.check_cancelled()
             for meas_name, data in samp_data.groupby('Signal_id'):
                 data = data.sort_values('Time')
                 time = data['Time'].values
                 val = data['Measurement'].values
-                density = density_df[density_df['Sample']==samp_id]
-                density = density.sort_values('Time')
-                density_val = density['Measurement'].values
-                density_time = density['Time'].values
+                density_time, density_val = biomass[samp_id]
                 
                 if self.smoothing_type=='savgol':
                     min_data_pts = max(self.smoothing_param1, self.smoothing_param2)
@@ -319,7 +619,10 @@ class Analysis:
                         if self.smoothing_type=='savgol':
                             #print('Applying savgol filter', flush=True)
                             sval = savgol_filter(val, int(self.smoothing_param1), 2, mode='interp')
-                            sdensity = savgol_filter(density_val, int(self.smoothing_param1), 2, mode='interp')
+                            # Biomass is smoothed once per sample for all signals
+                            if samp_id not in self.smoothed_biomass:
+                                self.smoothed_biomass[samp_id] = savgol_filter(density_val, int(self.smoothing_param1), 2, mode='interp')
+                            sdensity = self.smoothed_biomass[samp_id]
                             #print(len(val), len(density_val), flush=True)
                         elif smoothing_type=='lowess':
                             #print('Applying lowess filter', flush=True)
@@ -381,10 +684,9 @@ class Analysis:
         if len(df)==0:
             return(df)
 
-        density_df = get_biomass(df, self.density_name)
-        density_df = self.bg_correct(density_df)
-        if len(density_df)==0:
-            return density_df
+        biomass = self.get_biomass_index(df)
+        if all(len(biomass[samp_id][0])==0 for samp_id in df['Sample'].unique()):
+            return pd.DataFrame()
         
         result = pd.DataFrame()
         rows = []
@@ -392,26 +694,19 @@ class Analysis:
         grouped_sample = df.groupby('Sample')
         n_samples = len(grouped_sample)
         # Loop over samples
-        si = 1
         for samp_id, samp_data in grouped_sample:
-            print('Computing direct expression rate of sample %d of %d'%(si, n_samples), flush=True)
-            si += 1
+            self.check_cancelled()
             for meas_name, data in samp_data.groupby('Signal_id'):
                 data = data.sort_values('Time')
                 time = data['Time']
                 val = data['Measurement']
-                density = density_df[density_df['Sample']==samp_id]
-                density = density.sort_values('Time')
-                density_val = density['Measurement']
-                density_time = density['Time']
+                odt, ody = biomass[samp_id]
 
                 if len(val)>1:
                     # Construct curves
                     fpt = time.values
                     fpy = val.values
                     cfp = wf.curves.Curve(x=fpt, y=fpy)
-                    odt = density_time.values
-                    ody = density_val.values
                     cod = wf.curves.Curve(x=odt, y=ody)
                     # Compute time range
                     od_xmin, od_xmax = cod.xlim()
@@ -441,73 +736,148 @@ class Analysis:
             print('No rows to add to expression rate dataframe', flush=True)
         return(result)
 
-    def expression_rate_inverse(self, df):
+    def check_cancelled(self):
+        if self.check:
+            self.check()
+
+    def needs_sweep(self):
+        return self.sweep and self.regularization is None \
+                    and 'Expression Rate (inverse)' in self.analysis_types
+
+    def select_regularization(self, df):
         '''
-        Parameters:
-            df = data frame to analyse
-            density_df = dataframe containing density (biomass) measurements
-            degr = degradation rate of reporter protein
-            eps = Tikhoniv regularization parameter
-            n_gaussians = number of gaussians in basis
+        Choose eps and n_gaussians for the inverse method by a parallel sweep
+        over a representative subset of the samples in df, and use them in
+        the following analyses
+
+        Returns:
+        selection = dict of chosen parameters and diagnostics, see
+            inverse.sweep_regularization, or None if there is no data
         '''
+        if len(df)==0 or 'Sample' not in df:
+            # No measurements match the request
+            return None
+        df = self.get_corrected(df)
         if len(df)==0:
-            return(df)
-
-        density_df = get_biomass(df, self.density_name)
-        density_df = self.bg_correct(density_df)
-        if len(density_df)==0:
-            return density_df
-        
-        result = pd.DataFrame()
-        rows = []
+            return None
+        _, expression_batches = self.get_inverse_batches(df)
+
+        # Representative subset, evenly spaced in order of final expression
+        series = []
+        for key, (ttu, batch) in expression_batches.items():
+            for i, (_,_,fp) in enumerate(batch):
+                series.append((np.nan_to_num(fp[-1]), key, i))
+        if len(series)==0:
+            return None
+        series.sort(key=lambda s: s[0])
+        n_samples = min(self.sweep_samples, len(series))
+        subset = {}
+        for j in np.unique(np.linspace(0, len(series)-1, n_samples).round().astype(int)):
+            _, key, i = series[j]
+            subset.setdefault(key, []).append(i)
+        batches = []
+        for key, idx in subset.items():
+            ttu, batch = expression_batches[key]
+            batches.append((
+                ttu,
+                np.array([batch[i][2] for i in idx]),
+                np.array([batch[i][1] for i in idx])
+            ))
+
+        with span('analysis.regularization_sweep', samples=n_samples):
+            selection = inverse.sweep_regularization(
+                batches,
+                gamma=self.degr,
+                epsilons=self.sweep_eps,
+                n_gaussians_list=self.sweep_n_gaussians,
+                method=self.sweep_method)
+        if selection:
+            self.eps = selection['eps']
+            self.n_gaussians = selection['n_gaussians']
+        self.regularization = selection
+        return selection
+
+    def get_inverse_batches(self, df):
+        '''
+        Collect the series to fit by the inverse method, batched by time grid
+        so that all samples in a plate are characterized together
 
+        Returns:
+        growth_batches, expression_batches = dicts of time range ->
+            (ttu, list of (data, biomass at ttu, expression at ttu))
+        '''
+        biomass = self.get_biomass_index(df)
+        growth_batches = {}
+        expression_batches = {}
         grouped_sample = df.groupby('Sample')
-        n_samples = len(grouped_sample)
-        # Loop over samples
-        si = 1
         for samp_id, samp_data in grouped_sample:
-            print('Computing inverse expression rate of sample %d of %d'%(si, n_samples), flush=True)
-            si += 1
+            self.check_cancelled()
             for meas_name, data in samp_data.groupby('Signal_id'):
                 data = data.sort_values('Time')
                 time = data['Time']
                 val = data['Measurement']
-                density = density_df[density_df['Sample']==samp_id]
-                density = density.sort_values('Time')
-                density_val = density['Measurement']
-                density_time = density['Time']
+                odt, ody = biomass[samp_id]
 
                 if len(val)>1:
                     # Construct curves
                     fpt = time.values
                     fpy = val.values
                     cfp = wf.curves.Curve(x=fpt, y=fpy)
-                    odt = density_time.values
-                    ody = density_val.values
                     cod = wf.curves.Curve(x=odt, y=ody)
                     # Compute time range
                     od_xmin, od_xmax = cod.xlim()
-                    cfp_xmin, cfp_xmax = cfp.xlim()
-                    xmin = max(od_xmin, cfp_xmin)
-                    xmax = min(od_xmax, cfp_xmax)
                     ttu = np.linspace(od_xmin, od_xmax, 100, endpoint=False)
-                    # Fit model
+                    key = (od_xmin, od_xmax)
                     if meas_name==self.density_name:
-                        ksynth = inverse.characterize_growth(
-                            cod(ttu), 
-                            ttu, 
-                            n_gaussians=self.n_gaussians,
-                            epsilon=self.eps)
+                        batch = growth_batches.setdefault(key, (ttu, []))
+                        batch[1].append((data, cod(ttu), None))
                     else:
-                        ksynth = inverse.characterize(
-                            cfp(ttu), 
-                            cod(ttu), 
-                            ttu, 
-                            gamma=self.degr, 
-                            n_gaussians=self.n_gaussians,
-                            epsilon=self.eps)
-                    data = data.assign(Rate=ksynth(fpt))
-                    rows.append(data)
+                        batch = expression_batches.setdefault(key, (ttu, []))
+                        batch[1].append((data, cod(ttu), cfp(ttu)))
+        return growth_batches, expression_batches
+
+    def expression_rate_inverse(self, df):
+        '''
+        Parameters:
+            df = data frame to analyse
+            density_df = dataframe containing density (biomass) measurements
+            degr = degradation rate of reporter protein
+            eps = Tikhoniv regularization parameter
+            n_gaussians = number of gaussians in basis
+        '''
+        if len(df)==0:
+            return(df)
+
+        biomass = self.get_biomass_index(df)
+        if all(len(biomass[samp_id][0])==0 for samp_id in df['Sample'].unique()):
+            return pd.DataFrame()
+        
+        result = pd.DataFrame()
+        rows = []
+
+        growth_batches, expression_batches = self.get_inverse_batches(df)
+
+        # Fit models
+        for ttu, batch in growth_batches.values():
+            ksynths = inverse.characterize_growth_batch(
+                [od for _,od,_ in batch],
+                ttu,
+                n_gaussians=self.n_gaussians,
+                epsilon=self.eps,
+                check=self.check)
+            for (data,_,_), ksynth in zip(batch, ksynths):
+                rows.append(data.assign(Rate=ksynth(data['Time'].values)))
+        for ttu, batch in expression_batches.values():
+            ksynths = inverse.characterize_batch(
+                [fp for _,_,fp in batch],
+                [od for _,od,_ in batch],
+                ttu,
+                gamma=self.degr,
+                n_gaussians=self.n_gaussians,
+                epsilon=self.eps,
+                check=self.check)
+            for (data,_,_), ksynth in zip(batch, ksynths):
+                rows.append(data.assign(Rate=ksynth(data['Time'].values)))
 
         if len(rows)>0:
             result = result.append(rows)
@@ -576,24 +946,49 @@ class Analysis:
 
     # Other analysis types that make different forms of resulting data
     # ----
+    def get_supplement_index(self, df):
+        '''
+        Return dict of sample id -> {chemical id: concentration column} of the
+        supplements in each sample, from the chemical columns created in
+        get_measurements
+        '''
+        if 'Chemical_id' not in df.columns:
+            return {}
+        conc_columns = [col for col in df.columns if re.match(r'^Concentration[0-9]+$', col)]
+        first = df.groupby('Sample')['Chemical_id'].first()
+        index = {}
+        for samp_id, chem_ids in first.items():
+            columns = {}
+            if isinstance(chem_ids, (list, tuple)):
+                for i, chem_id in enumerate(chem_ids):
+                    col = f'Concentration{i+1}'
+                    if col in conc_columns and chem_id not in columns:
+                        columns[chem_id] = col
+            index[samp_id] = columns
+        return index
+
+    def get_concentrations(self, df, supplements, samp_ids, chemical_id):
+        '''
+        Return the concentration of the chemical in each row of df, from the
+        concentration column of the chemical in its sample. Samples with
+        several supplements of the chemical have a row for each of them.
+        '''
+        columns = df['Sample'].map({samp_id: supplements[samp_id][chemical_id] for samp_id in samp_ids})
+        concs = pd.Series(np.nan, index=df.index)
+        for col in columns.dropna().unique():
+            rows = (columns==col).values
+            concs[rows] = df.loc[rows, col].values
+        return concs
+
     def induction_curve(self, df):
-        data = df[df['Chemical_id'].apply(lambda x: self.chemical_id in x)]
-        if len(data)==0:
+        supplements = self.get_supplement_index(df)
+        # Samples that contain the chemical
+        samp_ids = [samp_id for samp_id, chems in supplements.items() if self.chemical_id in chems]
+        if len(samp_ids)==0:
             # The data does not correspond to the specified chemicals
             return pd.DataFrame()
-        chem_data = []
-        for id, samp_data in data.groupby('Sample'):
-            chem_ids = samp_data.Chemical_id.values[0]
-            if len(chem_ids)==0:
-                # The data does not correspond to the specified chemicals
-                return pd.DataFrame()
-            idx = np.where(np.array(chem_ids)==self.chemical_id)[0]
-            if len(idx)==0:
-                # The data does not correspond to the specified chemicals
-                return pd.DataFrame()
-            samp_data['Concentration'] = samp_data[f'Concentration{idx[0]+1}']
-            chem_data.append(samp_data)
-        chem_data = pd.concat(chem_data)
+        chem_data = df[df['Sample'].isin(samp_ids)].copy()
+        chem_data['Concentration'] = self.get_concentrations(chem_data, supplements, samp_ids, self.chemical_id)
         analyzed_data = self.analysis_funcs[self.function](chem_data)
         return analyzed_data
 
@@ -607,34 +1002,18 @@ class Analysis:
         '''
         Compute heatmap for two-input induced expression
         '''
-        # Slice the data for the specified chemicals
-        data = df[df['Chemical_id'].apply(lambda x: self.chemical_id1 in x)]
-        data = data[data['Chemical_id'].apply(lambda x: self.chemical_id2 in x)]
-        if len(data)==0:
+        # Samples containing both of the specified chemicals
+        supplements = self.get_supplement_index(df)
+        samp_ids = [samp_id for samp_id, chems in supplements.items() 
+                        if self.chemical_id1 in chems and self.chemical_id2 in chems]
+        if len(samp_ids)==0:
             # The data does not correspond to the specified chemicals
             return pd.DataFrame()
 
-        chem_data = []
-        for id, samp_data in data.groupby('Sample'):
-            # The chemicals in the sample
-            chem_ids = samp_data.Chemical_id.values[0]
-            if len(chem_ids)==0:
-                # The data does not correspond to the specified chemicals
-                return pd.DataFrame()
-
-            # Find the relevant chemicals in the lists
-            idx1 = np.where(np.array(chem_ids)==self.chemical_id1)[0]
-            idx2 = np.where(np.array(chem_ids)==self.chemical_id2)[0]
-
-            if len(idx1)==0 or len(idx2)==0:
-                # The data does not correspond to the specified chemicals
-                return pd.DataFrame()
-
-            # New columns with the concentrations of each chemical
-            samp_data['Concentration A'] = samp_data[f'Concentration{idx1[0]+1}']
-            samp_data['Concentration B'] = samp_data[f'Concentration{idx2[0]+1}']
-            chem_data.append(samp_data)
-        chem_data = pd.concat(chem_data)
+        # New columns with the concentrations of each chemical
+        chem_data = df[df['Sample'].isin(samp_ids)].copy()
+        chem_data['Concentration A'] = self.get_concentrations(chem_data, supplements, samp_ids, self.chemical_id1)
+        chem_data['Concentration B'] = self.get_concentrations(chem_data, supplements, samp_ids, self.chemical_id2)
         # Analyze the data and return
         analyzed_data = self.analysis_funcs[self.function](chem_data)
         return analyzed_data
@@ -643,47 +1022,39 @@ class Analysis:
         # Parameters:
         #   bounds = tuple of list of min and max values for  Gompertz model parameters
         #   df = dataframe of measurements including OD
-        #   density_df = dataframe containing biomass measurements
         #   ndt = number of doubling times to extend exponential phase
-        density_df = get_biomass(df, self.density_name)
-        density_df = self.bg_correct(density_df)
+        biomass = self.get_biomass_index(df)
+        growth_fits = self.get_growth_fits(df)
         
         result = pd.DataFrame()
         rows = []
 
+        failed = []
         grouped_samples = df.groupby('Sample')
         for samp_id,data in grouped_samples:
-            # input values for Gompertz model fit
-            oddf = density_df[density_df['Sample']==samp_id]
-            oddf = oddf.sort_values('Time')
-            odt = oddf['Time'].values
-            odval = oddf['Measurement'].values
-            odt = odt[odval>0.]
-            odval = odval[odval>0.]
-            #y = np.log(odval[odval>0.]) - np.log(np.nanmin(odval[odval>0.]))
-
-            # Fit Gompertz model
-            #try:
-            self.bounds = ([1e-2,0.01,0,-24], [1,4,2,24])
-            z,_ = curve_fit(gompertz, odt, odval, bounds=self.bounds)
-            #except:
-            #    print('Gompertz fitting failed', flush=True)
-            #    break
-                
-            y0 = z[0]
-            ymax = z[1]
-            A = np.log(ymax/y0)
-            um = z[2]
-            l = z[3]
-            print('y0, ymax, um, l', y0, ymax, um, l, flush=True)
-
-            # Compute time of peak growth
-            tm = ((A/(np.exp(1)*um))+l)
-            # Compute doubling time at peak growth
-            dt = np.log(2)/um
-            # Time range to consider exponential growth phase
-            t1 = tm
-            t2 = tm + self.n_doubling_times * dt
+            self.check_cancelled()
+            samp_odt, samp_odval = biomass[samp_id]
+
+            # Fitted Gompertz model
+            z = growth_fits[samp_id]
+            if z is None:
+                # No exponential phase, alpha is NaN for all signals
+                failed.append(samp_id)
+                t1, t2 = np.nan, np.nan
+            else:
+                y0 = z[0]
+                ymax = z[1]
+                A = np.log(ymax/y0)
+                um = z[2]
+                l = z[3]
+
+                # Compute time of peak growth
+                tm = ((A/(np.exp(1)*um))+l)
+                # Compute doubling time at peak growth
+                dt = np.log(2)/um
+                # Time range to consider exponential growth phase
+                t1 = tm
+                t2 = tm + self.n_doubling_times * dt
             #print('t1, t2', t1, t2, flush=True)
 
             # Compute alpha as slope of fluo vs od for each measurement name
@@ -696,10 +1067,9 @@ class Analysis:
                 mt = mdf['Time'].values
                 
                 # od measurements
-                oddf = oddf[(oddf['Time']>=t1)&(oddf['Time']<=t2)]
-                oddf = oddf.sort_values('Time')
-                odval = oddf['Measurement'].values
-                odt = oddf['Time'].values
+                od_range = (samp_odt>=t1) & (samp_odt<=t2)
+                odval = samp_odval[od_range]
+                odt = samp_odt[od_range]
                 
                 if len(mt)>1 and len(odt)>1:
                     smval = interp1d(mt, mval, kind='linear', bounds_error=False)
@@ -724,6 +1094,8 @@ class Analysis:
                     data['Alpha'] = np.nan
                 # Append to list of rows to append to result
                 rows.append(data)
+        if len(failed)>0:
+            logger.warning('Gompertz fitting failed for %d samples: %s', len(failed), failed)
         # Append alpha values to result df
         if len(rows)>0:
             result=result.append(rows)
@@ -743,10 +1115,11 @@ class Analysis:
         if len(alpha_ref)==0:
             return(alpha_ref)
 
+        # Reference alpha of the sample each row belongs to
+        alpha_ref = alpha_ref.groupby('Sample')['Alpha'].first()
         alpha = alpha.sort_values('Sample')
-        alpha_ref = alpha_ref.sort_values('Sample')
 
-        rho_vals = alpha['Alpha'].values / alpha_ref['Alpha'].values
+        rho_vals = alpha['Alpha'].values / alpha['Sample'].map(alpha_ref).values
         alpha = alpha.assign(Rho=rho_vals)
 
         return alpha
@@ -0,0 +1,120 @@
+import hashlib
+import io
+import json
+import pandas as pd
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+from registry.models import Sample
+from .models import AnalysisResult
+
+# Persistent cache of per-sample analysis results
+# -----------------------------------------------------------------------------------
+def cache_enabled():
+    return getattr(settings, 'ANALYSIS_CACHE_ENABLED', True)
+
+def result_key(analysis_type, params, sample_id, signal_id, data_version):
+    '''
+    Key identifying the result of an analysis for one sample and signal
+
+    params = canonicalized (json) analysis parameters
+    '''
+    key = json.dumps([analysis_type, params, int(sample_id), int(signal_id), data_version])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def get_data_versions(sample_ids):
+    '''
+    Return dict of sample id -> data version. The version changes whenever
+    the measurements of the sample, or of the background control samples
+    used to correct it, change
+    '''
+    samples = list(Sample.objects.filter(id__in=list(sample_ids)) \
+                        .values_list('id', 'data_version', 'assay__name', 'media__name'))
+    assays = set([assay for _,_,assay,_ in samples])
+
+    # Background controls are the samples without vector with the same
+    # assay and media, see Analysis.compute_background
+    controls = {}
+    bg_samples = Sample.objects.filter(assay__name__in=assays, vector__isnull=True) \
+                        .order_by('id') \
+                        .values_list('id', 'data_version', 'assay__name', 'media__name')
+    for samp_id,version,assay,media in bg_samples:
+        controls.setdefault((assay, media), []).append('%d.%d'%(samp_id, version))
+
+    versions = {}
+    for samp_id,version,assay,media in samples:
+        bg = ','.join(controls.get((assay, media), []))
+        bg_version = hashlib.sha1(bg.encode()).hexdigest()[:16]
+        versions[samp_id] = '%d:%s'%(version, bg_version)
+    return versions
+
+def get_results(analysis_type, params, versions):
+    '''
+    Return dict of sample id -> dataframe for the samples that have cached
+    results at their current data version. Results of a sample are stored
+    for all its signals at once, so any entry means the sample is complete.
+    '''
+    entries = AnalysisResult.objects.filter(
+                        analysis_type=analysis_type,
+                        params=params,
+                        sample__id__in=list(versions)
+                    ).values_list('id', 'sample_id', 'data_version', 'data')
+    frames = {}
+    hits = []
+    for pk,samp_id,version,data in entries:
+        if versions.get(samp_id)==version:
+            frames.setdefault(samp_id, []).append(
+                pd.read_json(io.StringIO(data), orient='split', convert_dates=False)
+            )
+            hits.append(pk)
+    if len(hits)>0:
+        AnalysisResult.objects.filter(id__in=hits).update(last_used=timezone.now())
+    return {samp_id: pd.concat(data) for samp_id,data in frames.items()}
+
+def store_results(analysis_type, params, pairs, versions, result):
+    '''
+    Store the rows of result belonging to each (sample id, signal id) pair
+    '''
+    if len(result)>0:
+        grouped = dict(list(result.groupby(['Sample', 'Signal_id'])))
+    else:
+        grouped = {}
+    objs = []
+    for samp_id,signal_id in pairs:
+        data = grouped.get((samp_id, signal_id), result.iloc[0:0])
+        data = data.to_json(orient='split', index=False, double_precision=15)
+        objs.append(AnalysisResult(
+            key=result_key(analysis_type, params, samp_id, signal_id, versions[samp_id]),
+            analysis_type=analysis_type,
+            params=params,
+            sample_id=int(samp_id),
+            signal_id=int(signal_id),
+            data_version=versions[samp_id],
+            data=data,
+            size=len(data)
+        ))
+    # Replace results stored for older versions of the data
+    AnalysisResult.objects.filter(
+                        analysis_type=analysis_type,
+                        params=params,
+                        sample__id__in=list(set([int(samp_id) for samp_id,_ in pairs]))
+                    ).delete()
+    AnalysisResult.objects.bulk_create(objs, ignore_conflicts=True)
+    evict()
+
+def evict(max_size=None):
+    '''
+    Remove least recently used results until the cache fits in max_size bytes
+    '''
+    if max_size is None:
+        max_size = getattr(settings, 'ANALYSIS_CACHE_MAX_SIZE', 512*1024*1024)
+    total = AnalysisResult.objects.aggregate(total=Sum('size'))['total'] or 0
+    if total <= max_size:
+        return
+    to_delete = []
+    for pk,size in AnalysisResult.objects.order_by('last_used').values_list('id', 'size').iterator():
+        if total <= max_size:
+            break
+        to_delete.append(pk)
+        total -= size
+    AnalysisResult.objects.filter(id__in=to_delete).delete()
@@ -1,22 +1,37 @@
 # Built in imports.
 import json
-import asyncio
+import logging
 # Third Party imports.
-from channels.exceptions import DenyConnection
 from channels.generic.websocket import AsyncWebsocketConsumer
 from analysis.analysis import Analysis 
-from analysis.util import *
-from registry.util import get_samples, get_measurements
-from plotly.subplots import make_subplots
-import plotly
-import pandas as pd
-import time
-import math
+from analysis.encoding import ResultStream
+from registry.util import get_samples
+from flapjack_api.executor import run_sync
+from flapjack_api.jobs import JobManager
+from flapjack_api.progress import ProgressReporter
+
+logger = logging.getLogger('flapjack.consumers')
+
+def result_message(result_df, progress, stream=None):
+    '''
+    Serialized message with the result dataframe, as typed arrays if stream
+    is a ResultStream
+    '''
+    if stream:
+        message = stream.data_message(result_df, progress)
+    else:
+        message = {
+            'type': 'progress_update',
+            'progress': progress,
+            'data': result_df.to_json()
+        }
+    return json.dumps(message)
 
 class AnalysisConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
-        print(self.user)
+        logger.info('Analysis connection of user %s', self.user)
+        self.jobs = JobManager()
         await self.accept()
         await self.channel_layer.group_add(
             "analysis",
@@ -24,47 +39,77 @@ class AnalysisConsumer(AsyncWebsocketConsumer):
         )
         
     async def receive(self, text_data):
-        print(f"Receive. text_data: {text_data}", flush=True)
         data = json.loads(text_data)
         if data['type'] == 'analysis':
-            print(data, flush=True)
-            await self.generate_data({'params': data['parameters']})
+            logger.debug('Analysis request of user %s: %s', self.user, data['parameters'])
+            # A new analysis request supersedes the one being computed
+            job = self.jobs.submit(self.generate_data, {'params': data['parameters']})
+            await self.send(text_data=json.dumps({
+                'type': 'job_started',
+                'data': {'job_id': job.id}
+            }))
+        elif data['type'] == 'cancel':
+            self.jobs.cancel(data.get('job_id'))
 
     async def disconnect(self, message):
+        # Nobody will see the results of outstanding jobs
+        self.jobs.cancel_all()
         await self.channel_layer.group_discard(
             "analysis",
             self.channel_name
         )
 
-    async def generate_data(self, event):
+    async def generate_data(self, job, event):
         params = event['params']
         analysis_params = params['analysis']
         signals = params.get('signal')
-        s = get_samples(params)
-        df = get_measurements(s, signals)
         if analysis_params:
-            analysis = Analysis(analysis_params, signals)
-            await self.run_analysis(df, analysis)
+            analysis = Analysis(analysis_params, signals, check=job.check)
+            sweep = analysis.needs_sweep()
+            # The queryset is built and evaluated in the pool, not the event loop
+            s = await run_sync(get_samples, params)
+            cached, df = await run_sync(analysis.get_data, s)
+            if sweep:
+                # The regularization chosen once for all plates
+                await self.send(text_data=json.dumps({
+                    'type': 'regularization',
+                    'data': analysis.regularization
+                }))
+            # Compact typed array frames if requested by the client
+            if params.get('encoding') == 'typed':
+                stream = ResultStream()
+                message = await run_sync(stream.metadata_message, cached + [df])
+                await self.send(text_data=json.dumps(message))
+            else:
+                stream = None
+            for result_df in cached:
+                await self.send_result(result_df, 0, stream)
+            await self.run_analysis(df, analysis, stream)
         # Send back finished message
         await self.send(text_data=json.dumps({
             'type': 'finished'
         }))
 
-    async def run_analysis(self, df, analysis):
-        grouped = df.groupby('Sample')
+    async def send_result(self, result_df, progress, stream=None):
+        text_data = await run_sync(result_message, result_df, progress, stream)
+        await self.send(text_data=text_data)
+
+    async def run_analysis(self, df, analysis, stream=None):
+        if len(df)==0:
+            return
+        # Analyze one plate at a time so that samples sharing a time grid
+        # can be fitted together
+        grouped = df.groupby(['Study', 'Assay'])
         #result_dfs = []
-        n_samples = len(grouped)
+        n_assays = len(grouped)
         progress = 0
+        # Results carry data so each is sent, only yielding is rate limited
+        reporter = ProgressReporter(None)
         for id,g in grouped:
-            result_df = analysis.analyze_data(g)
+            result_df = await run_sync(analysis.analyze, g)
             #result_dfs.append(result_df)
             progress += 1
-            await self.send(text_data=json.dumps({
-                'type': 'progress_update',
-                'progress': int(100 * progress / n_samples),
-                'data': result_df.to_json()
-            }))
-            await asyncio.sleep(0)
+            await self.send_result(result_df, int(100 * progress / n_assays), stream)
+            await reporter.pause()
         #df = pd.concat(result_dfs, ignore_index=True)
         #return df
-
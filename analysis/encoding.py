@@ -0,0 +1,110 @@
+import base64
+import json
+import re
+import numpy as np
+import pandas as pd
+
+# Compact encoding of numeric data as typed arrays
+# -----------------------------------------------------------------------------------
+# Columns describing a sample from the registry, constant over all its rows.
+# Concentration, Concentration A and Concentration B are computed by the
+# analysis and are not in the metadata, so they are sent as data columns
+sample_columns = [
+    'Study',
+    'Assay',
+    'Media',
+    'Strain',
+    'Vector',
+    'Supplement',
+    'Chemical',
+    'Chemical_id',
+    'Row',
+    'Column'
+]
+# Columns for individual chemicals, e.g. Concentration2
+numbered_sample_column = re.compile(r'^(Supplement|Chemical|Chemical_id|Concentration)([0-9]+)$')
+
+# Columns describing a signal, constant over all its rows
+signal_columns = ['Signal', 'Color']
+
+# Columns identifying the sample and signal of each row
+id_columns = ['Sample', 'Signal_id']
+
+def is_sample_column(column):
+    return column in sample_columns or numbered_sample_column.match(column) is not None
+
+def encode_array(values, dtype='f4'):
+    '''
+    Encode array as a typed array, in the form used by plotly.js:
+    {'dtype': 'f4', 'bdata': base64 encoded little-endian buffer}
+    '''
+    arr = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+    return {
+        'dtype': dtype,
+        'bdata': base64.b64encode(arr.tobytes()).decode('ascii')
+    }
+
+def frame_records(df, columns, key):
+    '''
+    Dict of key value -> dict of columns from the first row for each key,
+    with NaN converted to None
+    '''
+    if len(df)==0 or len(columns)==0:
+        return {}
+    first = df.groupby(key)[columns].first()
+    # Python objects rather than json, which would round small concentrations
+    first = first.astype(object).where(pd.notnull(first), None)
+    return {str(k): record for k,record in first.to_dict(orient='index').items()}
+
+class ResultStream:
+    '''
+    Encodes analysis results as a metadata message followed by a numbered
+    sequence of data frames. Metadata of samples and signals is sent once,
+    data frames carry only the numeric columns as typed arrays.
+    '''
+    def __init__(self, dtype='f4'):
+        self.dtype = dtype
+        self.seq = 0
+
+    def metadata_message(self, dfs):
+        '''
+        Message with the metadata of all samples and signals in dfs
+        '''
+        dfs = [df for df in dfs if len(df)>0]
+        if len(dfs)==0:
+            samples, signals = {}, {}
+        else:
+            df = pd.concat(dfs)
+            samp_cols = [c for c in df.columns if is_sample_column(c)]
+            sig_cols = [c for c in df.columns if c in signal_columns]
+            samples = frame_records(df, samp_cols, 'Sample')
+            signals = frame_records(df, sig_cols, 'Signal_id')
+        return {
+            'type': 'analysis_metadata',
+            'samples': samples,
+            'signals': signals
+        }
+
+    def data_message(self, df, progress):
+        '''
+        Message with the numeric columns of the result dataframe df
+        '''
+        data = {}
+        for column in df.columns:
+            if is_sample_column(column) or column in signal_columns:
+                continue
+            values = df[column].values
+            if column in id_columns:
+                data[column] = encode_array(values, 'i4')
+            elif np.issubdtype(values.dtype, np.number) or values.dtype==bool:
+                data[column] = encode_array(values, self.dtype)
+            else:
+                data[column] = json.loads(df[column].to_json(orient='values'))
+        self.seq += 1
+        return {
+            'type': 'analysis_data',
+            'seq': self.seq,
+            'progress': progress,
+            'length': len(df),
+            'data': data
+        }
@@ -0,0 +1,103 @@
+import numpy as np
+from scipy.optimize import curve_fit
+from analysis.util import gompertz
+
+# Fitting of growth models to biomass data
+# -----------------------------------------------------------------------------------
+def gompertz_jacobian(t, y0, ymax, um, l):
+    '''
+    Partial derivatives of gompertz(t, y0, ymax, um, l) with respect to
+    (y0, ymax, um, l), shape (len(t), 4)
+    '''
+    e = np.exp(1)
+    A = np.log(ymax/y0)
+    u = ((um*e)/A)*(l-t) + 1
+    eu = np.exp(u)
+    g = np.exp(-eu)
+    od = y0 * np.exp(A*g)
+    # Derivatives of the log relative biomass A*g
+    dFdA = g * (1 + eu*(u-1))
+    dFdum = -eu * g * e * (l-t)
+    dFdl = -eu * g * um * e
+    jac = np.empty((len(t), 4))
+    jac[:,0] = od / y0 * (1 - dFdA)
+    jac[:,1] = od / ymax * dFdA
+    jac[:,2] = od * dFdum
+    jac[:,3] = od * dFdl
+    return jac
+
+def gompertz_initial_guess(t, y, bounds):
+    '''
+    Estimate Gompertz parameters from the data: initial and final biomass,
+    maximum slope of log biomass and the lag time at which the tangent at
+    the maximum slope crosses the initial biomass
+    '''
+    lower, upper = bounds
+    y0 = np.min(y[:max(3, len(y)//10)])
+    ymax = np.max(y)
+    ly = np.log(y)
+    slope = np.gradient(ly, t)
+    # Median of 3 to reject single noisy points
+    if len(slope)>2:
+        slope = np.median([slope[:-2], slope[1:-1], slope[2:]], axis=0)
+        ts, lys = t[1:-1], ly[1:-1]
+    else:
+        ts, lys = t, ly
+    im = np.argmax(slope)
+    um = slope[im]
+    if um>0:
+        l = ts[im] - (lys[im] - np.log(y0)) / um
+    else:
+        l = 0
+    p0 = np.array([y0, ymax, um, l])
+    # Keep strictly inside the bounds
+    eps = 1e-6 * (np.array(upper) - np.array(lower))
+    return np.clip(p0, np.array(lower) + eps, np.array(upper) - eps)
+
+def fit_gompertz(t, y, bounds, p0=None):
+    '''
+    Fit Gompertz model to biomass data y at times t, starting from p0 if given
+    (e.g. fit of a neighbouring well) and falling back to a data driven
+    initial guess
+
+    Returns:
+    z = fitted parameters (y0, ymax, um, l), or None if fitting failed
+    '''
+    starts = [gompertz_initial_guess(t, y, bounds)]
+    if p0 is not None:
+        lower, upper = bounds
+        starts.insert(0, np.clip(p0, lower, upper))
+    for start in starts:
+        try:
+            z,_ = curve_fit(gompertz, t, y, p0=start, bounds=bounds, jac=gompertz_jacobian)
+            return z
+        except (RuntimeError, ValueError):
+            continue
+    return None
+
+def fit_gompertz_batch(series, bounds, check=None):
+    '''
+    Fit Gompertz model to many samples
+
+    series = dict of sample id -> (t, y, position), where position is used to
+        order the samples so that each fit is warm started from the previous
+        (neighbouring) well
+    check = function called before each fit, raising to stop
+
+    Returns:
+    fits = dict of sample id -> fitted parameters or None
+    '''
+    fits = {}
+    previous = None
+    for samp_id in sorted(series, key=lambda samp_id: series[samp_id][2]):
+        if check:
+            check()
+        t, y, _ = series[samp_id]
+        if len(t) < 4:
+            fits[samp_id] = None
+            continue
+        z = fit_gompertz(t, y, bounds, p0=previous)
+        fits[samp_id] = z
+        if z is not None:
+            previous = z
+    return fits
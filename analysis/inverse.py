@@ -1,6 +1,7 @@
 import numpy as np
-from scipy.optimize import least_squares
+from scipy.optimize import least_squares, lsq_linear
 from scipy.interpolate import interp1d
+from concurrent.futures import ThreadPoolExecutor
 
 # Inverse method for expression rate
 #
@@ -57,45 +58,15 @@ def residuals(data, p0, odval, dt, t, n_gaussians, epsilon, gamma):
     return func
 
 def characterize(expression, biomass, t, gamma, n_gaussians, epsilon):
-    dt = np.diff(t).mean()
-    nt = len(t)
-
-    # Bounds for fitting
-    lower_bounds = [0] + [0]*n_gaussians
-    upper_bounds = [1e8] + [1e8]*n_gaussians
-    bounds = [lower_bounds, upper_bounds]
-    '''
-        p0 = x[0]
-        profile = x[1:]
-    '''
-    residuals_func = residuals(
-                expression, 
-                expression[0],
-                biomass, 
-                epsilon=epsilon, 
-                dt=dt, 
-                t=t, 
+    profiles = characterize_batch(
+                np.atleast_2d(expression),
+                np.atleast_2d(biomass),
+                t,
+                gamma=gamma,
                 n_gaussians=n_gaussians,
-                gamma=gamma
+                epsilon=epsilon
                 )
-    res = least_squares(
-            residuals_func, 
-            [0] + [100]*n_gaussians, 
-            bounds=bounds
-            )
-    res = res
-
-    p0 = res.x[0]
-
-    profile = np.zeros_like(t)
-    means = np.linspace(t.min(), t.max(), n_gaussians)
-    vars = [(t.max()-t.min())/n_gaussians] * n_gaussians 
-    heights = res.x[1:]
-    for mean,var,height in zip(means, vars, heights):
-        gaussian = height * np.exp(-(t-mean)*(t-mean) / var / 2) / np.sqrt(2 * np.pi * var)
-        profile = profile + gaussian
-    profile = interp1d(t, profile, fill_value='extrapolate', bounds_error=False)
-    return profile
+    return profiles[0]
 
 # Inverse method for growth rate
 #
@@ -155,28 +126,310 @@ def characterize_growth(
         epsilon
         ):
     # Characterize growth rate profile
+    profiles = characterize_growth_batch(
+                np.atleast_2d(biomass),
+                t,
+                n_gaussians=n_gaussians,
+                epsilon=epsilon
+                )
+    return profiles[0]
+
+# Batched inverse methods
+#
+# All samples in a batch share the time grid t, so the gaussian basis and the
+# coefficients of the discretized forward models are computed only once.
+def gaussian_basis(t, n_gaussians):
+    '''
+    Matrix of gaussian basis functions evaluated at times t,
+    shape (len(t), n_gaussians)
+    '''
+    means = np.linspace(t.min(), t.max(), n_gaussians)
+    var = (t.max()-t.min())/n_gaussians
+    tt = t[:,np.newaxis] - means[np.newaxis,:]
+    return np.exp(-tt*tt / var / 2) / np.sqrt(2 * np.pi * var)
+
+def design_matrices(biomass, basis, dt, gamma, sim_steps=10):
+    '''
+    The forward model is linear in (p0, heights), so for each sample the model
+    output at times t[1:] is design[i] @ x. Returns array of shape
+    (n_samples, nt-1, 1+n_gaussians)
+    '''
+    n_samples, nt = biomass.shape
+    n_gaussians = basis.shape[1]
+    # Integrate sim_steps Euler steps with constant input exactly
+    a = 1 - gamma * dt / sim_steps
+    decay = a**sim_steps
+    gain = dt / sim_steps * np.sum(a**np.arange(sim_steps))
+
+    state = np.zeros((n_samples, 1+n_gaussians))
+    state[:,0] = 1
+    design = np.zeros((n_samples, nt-1, 1+n_gaussians))
+    for k in range(nt-1):
+        state = decay * state
+        state[:,1:] += gain * biomass[:,k,np.newaxis] * basis[np.newaxis,k,:]
+        design[:,k,:] = state
+    return design
+
+def characterize_batch(
+        expression,
+        biomass,
+        t,
+        gamma,
+        n_gaussians,
+        epsilon,
+        upper_bound=1e8,
+        check=None
+        ):
+    '''
+    Fit expression rate profiles for many samples sharing the time grid t
+
+    expression, biomass = arrays of shape (n_samples, len(t))
+    check = function called before each constrained fit, raising to stop
+
+    Returns:
+    profiles = list of interpolating functions, one per sample
+    '''
+    expression = np.asarray(expression, dtype=float)
+    biomass = np.asarray(biomass, dtype=float)
+    n_samples = expression.shape[0]
+    dt = np.diff(t).mean()
+
+    basis = gaussian_basis(t, n_gaussians)
+    design = design_matrices(biomass, basis, dt, gamma)
+
+    # Tikhonov regularization of the heights appended as extra rows
+    reg = np.zeros((n_gaussians, 1+n_gaussians))
+    reg[:,1:] = epsilon * np.eye(n_gaussians)
+    A = np.concatenate((design, np.broadcast_to(reg, (n_samples,)+reg.shape)), axis=1)
+    b = np.concatenate((expression[:,1:], np.zeros((n_samples, n_gaussians))), axis=1)
+
+    # Unconstrained solution for all samples at once, via batched QR
+    Q, R = np.linalg.qr(A)
+    Qtb = np.einsum('sij,si->sj', Q, b)
+    with np.errstate(all='ignore'):
+        x = np.linalg.solve(R, Qtb[:,:,np.newaxis])[:,:,0]
+
+    # Samples for which the bounds are active need a constrained solve
+    infeasible = ~np.all(np.isfinite(x) & (x>=0) & (x<=upper_bound), axis=1)
+    for i in np.where(infeasible)[0]:
+        if check:
+            check()
+        res = lsq_linear(A[i], b[i], bounds=(0, upper_bound))
+        x[i] = res.x
+
+    profiles = basis @ x[:,1:].T
+    return [
+        interp1d(t, profiles[:,i], fill_value='extrapolate', bounds_error=False)
+        for i in range(n_samples)
+    ]
+
+def characterize_growth_batch(
+        biomass,
+        t,
+        n_gaussians,
+        epsilon,
+        sim_steps=10,
+        check=None
+        ):
+    '''
+    Fit growth rate profiles for many samples sharing the time grid t
+
+    biomass = array of shape (n_samples, len(t))
+    check = function called before each fit, raising to stop
+
+    Returns:
+    profiles = list of interpolating functions, one per sample
+    '''
+    biomass = np.asarray(biomass, dtype=float)
     dt = np.mean(np.diff(t))
-    nt = len(t)
+    basis = gaussian_basis(t, n_gaussians)
+    h = dt / sim_steps
+
+    def model(x):
+        # Closed form of forward_model_growth
+        mu = basis @ x[1:]
+        step = 1 + mu * h
+        growth = np.concatenate(([1.], np.cumprod(step**sim_steps)[:-1]))
+        return x[0] * growth, growth, step
+
+    def residuals(x, data):
+        od, _, _ = model(x)
+        return np.concatenate((data - od, epsilon * x[1:]))
+
+    def jacobian(x, data):
+        od, growth, step = model(x)
+        # d(od_k)/d(heights) = od_k * sum_{j<k} dt * basis_j / step_j
+        dlog = np.cumsum(dt * basis / step[:,np.newaxis], axis=0)
+        dlog = np.concatenate((np.zeros((1, n_gaussians)), dlog[:-1]), axis=0)
+        jac = np.zeros((len(t)+n_gaussians, 1+n_gaussians))
+        jac[:len(t),0] = -growth
+        jac[:len(t),1:] = -od[:,np.newaxis] * dlog
+        jac[len(t):,1:] = epsilon * np.eye(n_gaussians)
+        return jac
 
     lower_bounds = [0] + [0]*n_gaussians
     upper_bounds = [100] + [50]*n_gaussians
     bounds = [lower_bounds, upper_bounds]
+    x0 = [0.01] + [1]*n_gaussians
 
-    data = biomass
-    res = least_squares(
-            residuals_growth(data, epsilon=epsilon, dt=dt, t=t, n_gaussians=n_gaussians), 
-            [0.01] + [1]*n_gaussians, 
-            bounds=bounds
-            )
-    init_biomass = res.x[0]
-    profile = np.zeros_like(t)
-    means = np.linspace(t.min(), t.max(), n_gaussians)
-    vars = [(t.max()-t.min())/n_gaussians] * n_gaussians 
-    heights = res.x[1:]
-    for mean,var,height in zip(means, vars, heights):
-        gaussian = height * np.exp(-(t-mean)*(t-mean) / var / 2) / np.sqrt(2 * np.pi * var)
-        profile = profile + gaussian
-    mu_profile = interp1d(t, profile, fill_value='extrapolate', bounds_error=False)
+    profiles = []
+    for data in biomass:
+        if check:
+            check()
+        res = least_squares(
+                residuals,
+                x0,
+                jac=jacobian,
+                bounds=bounds,
+                args=(data,)
+                )
+        profile = basis @ res.x[1:]
+        profiles.append(
+            interp1d(t, profile, fill_value='extrapolate', bounds_error=False)
+        )
+    return profiles
+
+# Selection of regularization parameters
+#
+def regularization_scores(expression, biomass, t, gamma, n_gaussians, epsilons):
+    '''
+    Evaluate the unconstrained Tikhonov regularized fit of characterize_batch
+    for each value in epsilons, for all samples at once
+
+    Returns:
+    scores = dict of arrays of shape (len(epsilons), n_samples) with keys
+        gcv = generalized cross validation score
+        residual_norm = norm of the data residual
+        solution_norm = norm of the gaussian heights
+    '''
+    expression = np.asarray(expression, dtype=float)
+    biomass = np.asarray(biomass, dtype=float)
+    dt = np.diff(t).mean()
+    basis = gaussian_basis(t, n_gaussians)
+    design = design_matrices(biomass, basis, dt, gamma)
+    b = expression[:,1:]
+    m = b.shape[1]
+
+    DtD = np.einsum('sij,sik->sjk', design, design)
+    Dtb = np.einsum('sij,si->sj', design, b)
+    # Only the heights are penalized, not the initial value
+    penalty = np.eye(1+n_gaussians)
+    penalty[0,0] = 0
+
+    gcv, residual_norm, solution_norm = [], [], []
+    with np.errstate(all='ignore'):
+        for epsilon in epsilons:
+            M = DtD + epsilon**2 * penalty
+            x = np.linalg.solve(M, Dtb[:,:,np.newaxis])[:,:,0]
+            residual = np.einsum('sij,sj->si', design, x) - b
+            rss = np.sum(residual**2, axis=1)
+            # Trace of the influence matrix D (D'D + eps^2 P)^-1 D'
+            trace = np.trace(np.linalg.solve(M, DtD), axis1=1, axis2=2)
+            gcv.append(m * rss / (m - trace)**2)
+            residual_norm.append(np.sqrt(rss))
+            solution_norm.append(np.linalg.norm(x[:,1:], axis=1))
+    return {
+        'gcv': np.array(gcv),
+        'residual_norm': np.array(residual_norm),
+        'solution_norm': np.array(solution_norm)
+    }
+
+def lcurve_corner(residual_norm, solution_norm):
+    '''
+    Index of the point of maximum curvature of the L-curve
+    (log residual norm, log solution norm), and the curvature at each point
+    '''
+    x = np.log(residual_norm)
+    y = np.log(solution_norm)
+    dx, dy = np.gradient(x), np.gradient(y)
+    ddx, ddy = np.gradient(dx), np.gradient(dy)
+    with np.errstate(all='ignore'):
+        curvature = (dx*ddy - dy*ddx) / (dx*dx + dy*dy)**1.5
+    curvature = np.where(np.isfinite(curvature), curvature, -np.inf)
+    return int(np.argmax(curvature)), curvature
+
+def sweep_regularization(
+        batches,
+        gamma,
+        epsilons,
+        n_gaussians_list,
+        method='gcv',
+        max_workers=None
+        ):
+    '''
+    Choose the regularization parameter epsilon and number of gaussians for
+    characterize_batch over a grid of values, evaluated in parallel
+
+    batches = list of (t, expression, biomass), samples sharing a time grid
+    method = 'gcv' to minimize generalized cross validation, or 'lcurve' to
+        take the corner of the L-curve for each number of gaussians and then
+        the number of gaussians with the lowest GCV score at its corner
+
+    Scores are aggregated over samples as geometric means, so that bright
+    and dim samples carry equal weight.
+
+    Returns:
+    selection = dict with the chosen eps and n_gaussians, the method and the
+        diagnostics for each grid point
+    '''
+    epsilons = np.asarray(epsilons, dtype=float)
+    tasks = [(n_gaussians, batch) for n_gaussians in n_gaussians_list for batch in batches]
+
+    def evaluate(task):
+        n_gaussians, (t, expression, biomass) = task
+        scores = regularization_scores(expression, biomass, t, gamma, n_gaussians, epsilons)
+        return {key: np.log(value) for key, value in scores.items()}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(evaluate, tasks))
+
+    # Combine batches for each number of gaussians, mean of log scores
+    grid = {}
+    for (n_gaussians, _), scores in zip(tasks, results):
+        combined = grid.setdefault(n_gaussians, {})
+        for key, value in scores.items():
+            combined.setdefault(key, []).append(value)
+    for n_gaussians, combined in grid.items():
+        for key, value in combined.items():
+            value = np.concatenate(value, axis=1)
+            value = np.where(np.isfinite(value), value, np.nan)
+            with np.errstate(all='ignore'):
+                combined[key] = np.exp(np.nanmean(value, axis=1))
+        combined['curvature'] = lcurve_corner(combined['residual_norm'], combined['solution_norm'])[1]
+
+    # Choose the grid point
+    candidates = []
+    for n_gaussians, combined in grid.items():
+        if method=='lcurve':
+            indices = [lcurve_corner(combined['residual_norm'], combined['solution_norm'])[0]]
+        else:
+            indices = range(len(epsilons))
+        for i in indices:
+            score = combined['gcv'][i]
+            if np.isfinite(score):
+                candidates.append((score, n_gaussians, epsilons[i]))
+    if len(candidates)==0:
+        return None
+    _, n_gaussians, epsilon = min(candidates)
 
-    return mu_profile
+    def finite(value):
+        return float(value) if np.isfinite(value) else None
 
+    diagnostics = []
+    for ng, combined in sorted(grid.items()):
+        for i, epsilon_i in enumerate(epsilons):
+            diagnostics.append({
+                'n_gaussians': int(ng),
+                'eps': float(epsilon_i),
+                'gcv': finite(combined['gcv'][i]),
+                'residual_norm': finite(combined['residual_norm'][i]),
+                'solution_norm': finite(combined['solution_norm'][i]),
+                'curvature': finite(combined['curvature'][i]),
+            })
+    return {
+        'eps': float(epsilon),
+        'n_gaussians': int(n_gaussians),
+        'method': method,
+        'samples': int(sum(len(expression) for _, expression, _ in batches)),
+        'grid': diagnostics
+    }
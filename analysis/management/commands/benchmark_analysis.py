@@ -0,0 +1,163 @@
+import json
+import platform
+import time
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+from registry.models import *
+from registry.util import get_measurements, update_summaries
+from analysis.analysis import Analysis
+from analysis.synthetic import synthetic_plate
+
+
+class Rollback(Exception):
+    """
+    Raised to roll back the synthetic data at the end of the benchmark
+    """
+
+
+class Command(BaseCommand):
+    help = 'Time each analysis type on synthetic plates of increasing size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[24, 96, 384],
+                            help='Number of wells of each synthetic plate')
+        parser.add_argument('--times', type=int, default=97,
+                            help='Number of measurement times per well')
+        parser.add_argument('--types', nargs='+', default=None,
+                            help='Analysis types to run, default all')
+        parser.add_argument('--repeat', type=int, default=1,
+                            help='Number of runs of each analysis, the fastest is reported')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None,
+                            help='Write results as json to this file')
+        parser.add_argument('--compare', default=None,
+                            help='Json file of a previous run to compare with')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                results = self.run_benchmark(options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+        report = {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'times': options['times'],
+            'repeat': options['repeat'],
+            'seed': options['seed'],
+            'results': results
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                for r in json.load(f)['results']:
+                    baseline[(r['type'], r['wells'])] = r['seconds']
+        self.print_results(results, baseline)
+
+    def run_benchmark(self, options):
+        user = User.objects.create(username='benchmark-%d'%int(time.time()))
+        types = options['types'] or list(Analysis({'type': 'Velocity'}, None).analysis_funcs)
+        results = []
+        for n_wells in options['sizes']:
+            plate = synthetic_plate(n_wells=n_wells, n_times=options['times'], seed=options['seed'])
+            assay, signals, chemicals = self.load_plate(user, plate, n_wells)
+            samples = Sample.objects.filter(assay=assay)
+
+            start = time.time()
+            df = get_measurements(samples)
+            load_time = time.time() - start
+            results.append({
+                'type': 'Load measurements',
+                'wells': n_wells,
+                'rows': len(df),
+                'seconds': load_time
+            })
+
+            params = {
+                'biomass_signal': signals['OD'].id,
+                'ref_signal': signals['RFP'].id,
+                'analyte': chemicals['A'].id,
+                'analyte1': chemicals['A'].id,
+                'analyte2': chemicals['B'].id,
+            }
+            for analysis_type in types:
+                params['type'] = analysis_type
+                if analysis_type=='Kymograph':
+                    params['function'] = 'Expression Rate (indirect)'
+                else:
+                    params['function'] = 'Mean Expression'
+                elapsed = []
+                for i in range(options['repeat']):
+                    # New analysis object each run so that nothing is reused
+                    analysis = Analysis(params, None)
+                    start = time.time()
+                    with override_settings(ANALYSIS_CACHE_ENABLED=False):
+                        result = analysis.analyze_data(df)
+                    elapsed.append(time.time() - start)
+                results.append({
+                    'type': analysis_type,
+                    'wells': n_wells,
+                    'rows': len(result),
+                    'seconds': min(elapsed)
+                })
+                self.stdout.write(f'{analysis_type}, {n_wells} wells: {min(elapsed):.3f} s')
+        return results
+
+    def load_plate(self, user, plate, n_wells):
+        '''
+        Create the study, assay, samples and measurements of a synthetic plate
+        '''
+        name = f'Benchmark {n_wells} wells'
+        study = Study.objects.create(name=name, description='Synthetic data', owner=user, public=False)
+        assay = Assay.objects.create(study=study, name=name, machine='Synthetic',
+                                     description='Synthetic data', temperature=37.)
+        media = Media.objects.create(owner=user, name=f'{name} media', description='')
+        strain = Strain.objects.create(owner=user, name=f'{name} strain', description='')
+        vector = Vector.objects.create(owner=user, name=f'{name} vector')
+        signals = {}
+        for sig_name in plate['wells'][0]['signals']:
+            signals[sig_name] = Signal.objects.create(owner=user, name=sig_name, description='')
+        chemicals = {}
+        supplements = {}
+        for chem_name in ['A', 'B']:
+            chem = Chemical.objects.create(owner=user, name=f'{name} inducer {chem_name}', description='')
+            chemicals[chem_name] = chem
+            for conc in plate['concs_%s'%chem_name.lower()]:
+                supplements[(chem_name, conc)] = Supplement.objects.create(
+                    owner=user, name=f'{chem.name} {conc:.2g}', chemical=chem, concentration=conc
+                )
+
+        meas = []
+        for well in plate['wells']:
+            samp = Sample.objects.create(
+                assay=assay,
+                media=media,
+                strain=None if well['kind']=='media' else strain,
+                vector=vector if well['kind']=='cells' else None,
+                row=well['row'],
+                col=well['col']
+            )
+            samp.supplements.add(supplements[('A', well['conc_a'])], supplements[('B', well['conc_b'])])
+            for sig_name,vals in well['signals'].items():
+                for t,val in zip(plate['times'], vals):
+                    meas.append(Measurement(sample=samp, signal=signals[sig_name], value=val, time=t))
+        Measurement.objects.bulk_create(meas, batch_size=500)
+        update_summaries(Sample.objects.filter(assay=assay).values_list('id', flat=True))
+        return assay, signals, chemicals
+
+    def print_results(self, results, baseline):
+        for r in results:
+            line = f"{r['type']:<30} {r['wells']:>5} wells {r['seconds']:>9.3f} s"
+            old = baseline.get((r['type'], r['wells']))
+            if old:
+                line += f"   was {old:>9.3f} s, speedup {old/max(r['seconds'], 1e-9):.2f}x"
+            self.stdout.write(line)
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from analysis import worker
+
+
+class Command(BaseCommand):
+    help = 'Run queued analysis jobs, e.g. from a separate worker process or a nightly schedule'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep waiting for new jobs instead of exiting when the queue is empty')
+        parser.add_argument('--interval', type=float, default=5.,
+                            help='Seconds between checks for new jobs with --loop')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Maximum number of jobs to run')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            # Jobs left running by stopped workers are queued again
+            worker.recover_stale_jobs()
+            limit = None if options['limit'] is None else options['limit'] - total
+            n = worker.run_queued(limit)
+            total += n
+            if n:
+                self.stdout.write(f'Ran {n} analysis jobs')
+            if not options['loop'] or (options['limit'] is not None and total >= options['limit']):
+                break
+            if n==0:
+                time.sleep(options['interval'])
@@ -0,0 +1,31 @@
+# Generated by Django 3.0.5 on 2026-10-19 16:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('registry', '0030_auto_20221118_1227'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('analysis_type', models.CharField(max_length=100)),
+                ('params', models.TextField()),
+                ('data_version', models.CharField(max_length=100)),
+                ('data', models.TextField()),
+                ('size', models.IntegerField()),
+                ('last_used', models.DateTimeField(auto_now=True, db_index=True)),
+                ('sample', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registry.Sample')),
+                ('signal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registry.Signal')),
+            ],
+        ),
+    ]
@@ -1,3 +1,58 @@
 from django.db import models
+from registry.models import Sample, Signal
 
-# Create your models here.
+
+class AnalysisResult(models.Model):
+    """
+    Cached result of an analysis for one sample and signal
+    """
+    key = models.CharField(max_length=64, unique=True)
+    analysis_type = models.CharField(max_length=100)
+    params = models.TextField()
+    sample = models.ForeignKey(Sample, on_delete=models.CASCADE)
+    signal = models.ForeignKey(Signal, on_delete=models.CASCADE)
+    data_version = models.CharField(max_length=100)
+    data = models.TextField()
+    size = models.IntegerField()
+    last_used = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.analysis_type}: sample {self.sample_id}, signal {self.signal_id}"
+
+
+class AnalysisJob(models.Model):
+    """
+    Analysis submitted through the REST API and run by a background worker,
+    see analysis.worker
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (FINISHED, 'Finished'),
+        (FAILED, 'Failed'),
+        (CANCELLED, 'Cancelled'),
+    ]
+
+    owner = models.ForeignKey(
+        'auth.User', related_name='analysis_jobs', on_delete=models.CASCADE)
+    params = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    progress = models.FloatField(default=0)
+    error = models.TextField(blank=True)
+    result = models.TextField(blank=True)
+    n_rows = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    # Refreshed while a worker runs the job, so that jobs of stopped workers
+    # can be detected and run again, up to ANALYSIS_JOB_MAX_ATTEMPTS times
+    heartbeat = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"Analysis job {self.id} ({self.status})"
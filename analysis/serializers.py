@@ -0,0 +1,42 @@
+import json
+from rest_framework import serializers
+from .analysis import Analysis
+from .models import AnalysisJob
+
+
+class AnalysisJobSerializer(serializers.ModelSerializer):
+    id = serializers.ReadOnlyField()
+    owner = serializers.HiddenField(default=serializers.CurrentUserDefault())
+    params = serializers.JSONField()
+
+    class Meta:
+        model = AnalysisJob
+        exclude = ['result']
+        read_only_fields = ['status', 'progress', 'error', 'n_rows', 'created', 'started', 'finished',
+                            'heartbeat', 'attempts']
+
+    def validate_params(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError('Expected an object of sample filters and analysis parameters')
+        analysis_params = value.get('analysis')
+        if not isinstance(analysis_params, dict) or 'type' not in analysis_params:
+            raise serializers.ValidationError('Missing analysis parameters with an analysis type')
+        try:
+            analysis = Analysis(analysis_params, value.get('signal'))
+        except (TypeError, ValueError) as e:
+            raise serializers.ValidationError(f'Invalid analysis parameters: {e}')
+        unknown = [t for t in analysis.analysis_types if t not in analysis.analysis_funcs]
+        if unknown:
+            raise serializers.ValidationError(f'Unknown analysis type {", ".join(map(str, unknown))}')
+        return value
+
+    def to_internal_value(self, data):
+        values = super().to_internal_value(data)
+        values['params'] = json.dumps(values['params'])
+        return values
+
+    def to_representation(self, instance):
+        rep = super().to_representation(instance)
+        if isinstance(rep['params'], str):
+            rep['params'] = json.loads(rep['params'])
+        return rep
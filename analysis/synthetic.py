@@ -0,0 +1,95 @@
+import numpy as np
+from analysis.util import gompertz
+
+# Synthetic plate data for testing and benchmarking the analysis engines
+# -----------------------------------------------------------------------------------
+def hill(c, k, n):
+    return c**n / (k**n + c**n)
+
+def plate_shape(n_wells):
+    '''
+    Number of rows and columns of a plate with n_wells wells,
+    e.g. 24 = 4x6, 96 = 8x12, 384 = 16x24
+    '''
+    cols = max(1, int(round(np.sqrt(n_wells * 1.5))))
+    rows = int(np.ceil(n_wells / cols))
+    return rows, cols
+
+def synthetic_plate(
+        n_wells=96,
+        n_times=97,
+        duration=24.,
+        n_media_wells=2,
+        n_strain_wells=2,
+        noise=0.02,
+        seed=0
+    ):
+    '''
+    Generate measurements of a plate reader experiment
+
+    Wells contain either media only, cells without DNA, or cells with a
+    construct expressing GFP under control of two inducers (A varies along
+    columns, B along rows) and constitutive RFP. Biomass follows a Gompertz
+    model with well to well variability, fluorescence is the integral of the
+    expression rate times biomass, plus autofluorescence and noise.
+
+    Returns:
+    plate = dict with keys
+        times = array of measurement times (h)
+        concs_a, concs_b = concentrations (M) of inducers along columns, rows
+        wells = list of dicts with keys row, col, kind ('media', 'strain' or
+            'cells'), conc_a, conc_b, and signals, a dict of signal name ->
+            array of measurements
+    '''
+    rng = np.random.RandomState(seed)
+    rows, cols = plate_shape(n_wells)
+    t = np.linspace(0, duration, n_times)
+    dt = np.diff(t, prepend=0)
+    concs_a = np.logspace(-9, -3, cols)
+    concs_b = np.logspace(-9, -3, rows)
+
+    # Media background and noise level of each signal
+    media_bg = {'OD': 0.05, 'GFP': 50., 'RFP': 20.}
+    wells = []
+    for i in range(n_wells):
+        row, col = i // cols, i % cols
+        if i < n_media_wells:
+            kind = 'media'
+        elif i < n_media_wells + n_strain_wells:
+            kind = 'strain'
+        else:
+            kind = 'cells'
+
+        if kind == 'media':
+            od = np.zeros_like(t)
+        else:
+            y0 = 0.01 * (1 + 0.1*rng.randn())
+            ymax = 1.2 * (1 + 0.1*rng.randn())
+            um = 0.6 * (1 + 0.1*rng.randn())
+            lag = 2. * (1 + 0.1*rng.randn())
+            od = gompertz(t, y0, ymax, um, lag)
+
+        # Autofluorescence proportional to biomass
+        gfp = 200. * od
+        rfp = 100. * od
+        if kind == 'cells':
+            # Expression rate depends on both inducers
+            rate = 1e3 * hill(concs_a[col], 1e-6, 2) * (0.2 + 0.8*hill(concs_b[row], 1e-6, 1.5))
+            gfp = gfp + np.cumsum(rate * od * dt)
+            rfp = rfp + np.cumsum(500. * od * dt)
+
+        signals = {}
+        for name, val in [('OD', od), ('GFP', gfp), ('RFP', rfp)]:
+            val = val + media_bg[name]
+            val = val * (1 + noise*rng.randn(n_times)) + noise*media_bg[name]*rng.randn(n_times)
+            signals[name] = val
+
+        wells.append(dict(
+            row=row+1,
+            col=col+1,
+            kind=kind,
+            conc_a=concs_a[col],
+            conc_b=concs_b[row],
+            signals=signals
+        ))
+    return dict(times=t, concs_a=concs_a, concs_b=concs_b, wells=wells)
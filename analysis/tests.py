@@ -1,3 +1,863 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from registry.models import Sample, Signal, Measurement, Study, Assay, Vector, Chemical, Supplement
+from registry.util import get_measurements, get_biomass, measurements_changed
+from analysis import cache, growth, inverse, worker
+from analysis.analysis import Analysis
+from analysis.encoding import ResultStream
+from analysis.models import AnalysisJob, AnalysisResult
+from analysis.management.commands.benchmark_analysis import Command as BenchmarkCommand
+from analysis.synthetic import synthetic_plate
+from flapjack_api.jobs import JobCancelled
+from analysis.util import gompertz, normalize_data
 
-# Create your tests here.
+
+def simulate_expression(t, od, rate, gamma, p0):
+    '''
+    Expression of a reporter produced at rate per unit biomass, integrated
+    as in inverse.forward_model
+    '''
+    dt = np.diff(t).mean()
+    fp = np.zeros_like(t)
+    p = p0
+    for k in range(len(t)):
+        fp[k] = p
+        for step in range(10):
+            p += (od[k]*rate[k] - gamma*p) * dt / 10
+    return fp
+
+
+class InverseBatchTests(SimpleTestCase):
+    """
+    The batched inverse fits must match the per-sample least squares fits of
+    the residuals functions they replace
+    """
+
+    n_gaussians = 24
+    epsilon = 0.01
+    gamma = 0.05
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.t = np.linspace(0, 24, 100, endpoint=False)
+        self.od = 0.01*np.exp(0.3*self.t) / (1 + 0.01*(np.exp(0.3*self.t) - 1))
+
+    def assertProfilesClose(self, old, new):
+        self.assertLess(np.abs(old - new).max() / np.abs(old).max(), 1e-4)
+
+    def test_design_matrices(self):
+        # The linear forward model equals forward_model for any parameters
+        t = self.t
+        dt = np.diff(t).mean()
+        basis = inverse.gaussian_basis(t, self.n_gaussians)
+        design = inverse.design_matrices(self.od[np.newaxis], basis, dt, self.gamma)
+        x = self.rng.uniform(0, 100, 1 + self.n_gaussians)
+        old, _ = inverse.forward_model(Dt=dt, odval=self.od, profile=basis @ x[1:],
+                                       nt=len(t), p0=x[0], gamma=self.gamma)
+        np.testing.assert_allclose(design[0] @ x, old[1:], rtol=1e-10)
+
+    def test_characterize_batch(self):
+        t = self.t
+        dt = np.diff(t).mean()
+        expression = []
+        for i in range(3):
+            rate = 50*np.exp(-(t - 8 - i)**2 / 8)
+            fp = simulate_expression(t, self.od, rate, self.gamma, p0=5.)
+            expression.append(fp + self.rng.normal(0, 0.5, len(t)))
+        profiles = inverse.characterize_batch(expression, [self.od]*3, t,
+                                              gamma=self.gamma,
+                                              n_gaussians=self.n_gaussians,
+                                              epsilon=self.epsilon)
+        basis = inverse.gaussian_basis(t, self.n_gaussians)
+        for fp, profile in zip(expression, profiles):
+            func = inverse.residuals(fp, fp[0], self.od, dt=dt, t=t,
+                                     n_gaussians=self.n_gaussians,
+                                     epsilon=self.epsilon, gamma=self.gamma)
+            res = least_squares(func, [0] + [100]*self.n_gaussians,
+                                bounds=([0]*(1 + self.n_gaussians), [1e8]*(1 + self.n_gaussians)))
+            self.assertProfilesClose(basis @ res.x[1:], profile(t))
+
+    def test_characterize_growth_batch(self):
+        t = self.t
+        dt = np.diff(t).mean()
+        biomass = [self.od * (1 + self.rng.normal(0, 0.01, len(t))) for i in range(3)]
+        profiles = inverse.characterize_growth_batch(biomass, t,
+                                                     n_gaussians=self.n_gaussians,
+                                                     epsilon=self.epsilon)
+        basis = inverse.gaussian_basis(t, self.n_gaussians)
+        for od, profile in zip(biomass, profiles):
+            func = inverse.residuals_growth(od, epsilon=self.epsilon, dt=dt, t=t,
+                                            n_gaussians=self.n_gaussians)
+            res = least_squares(func, [0.01] + [1]*self.n_gaussians,
+                                bounds=([0]*(1 + self.n_gaussians), [100] + [50]*self.n_gaussians))
+            self.assertProfilesClose(basis @ res.x[1:], profile(t))
+
+
+def decode_array(encoded):
+    dtype = np.dtype(encoded['dtype']).newbyteorder('<')
+    return np.frombuffer(base64.b64decode(encoded['bdata']), dtype=dtype)
+
+
+class ResultStreamTests(TestCase):
+    """
+    Typed array frames must carry every column the client needs to rebuild
+    the result, including the concentrations computed by the analysis
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='stream')
+        plate = synthetic_plate(n_wells=24, n_times=13, seed=0)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(user, plate, 24)
+
+    def test_heatmap_round_trip(self):
+        df = get_measurements(Sample.objects.filter(assay=self.assay))
+        analysis = Analysis({
+            'type': 'Heatmap',
+            'function': 'Mean Expression',
+            'biomass_signal': self.signals['OD'].id,
+            'analyte1': self.chemicals['A'].id,
+            'analyte2': self.chemicals['B'].id
+        }, None)
+        result = analysis.analyze_data(df)
+        self.assertGreater(len(result), 0)
+
+        stream = ResultStream()
+        # As received by the client
+        metadata = json.loads(json.dumps(stream.metadata_message([df])))
+        message = json.loads(json.dumps(stream.data_message(result, 100)))
+        data = message['data']
+        self.assertEqual(message['length'], len(result))
+        for column in ['Concentration A', 'Concentration B', 'Expression']:
+            np.testing.assert_allclose(decode_array(data[column]),
+                                       result[column].values.astype(np.float32))
+        np.testing.assert_array_equal(decode_array(data['Sample']), result['Sample'].values)
+
+        # The registry metadata of every sample and signal is in the metadata
+        samples = metadata['samples']
+        for samp_id, concentration in result.groupby('Sample')['Concentration1'].first().items():
+            self.assertEqual(samples[str(samp_id)]['Concentration1'], concentration)
+            self.assertNotIn('Concentration A', samples[str(samp_id)])
+        signals = metadata['signals']
+        for signal_id, name in result.groupby('Signal_id')['Signal'].first().items():
+            self.assertEqual(signals[str(signal_id)]['Signal'], name)
+
+
+class SyntheticDataTests(TestCase):
+    """
+    The synthetic plates used by the benchmark must load as complete assays
+    that the analyses can run on
+    """
+
+    def test_synthetic_plate(self):
+        plate = synthetic_plate(n_wells=24, n_times=13, seed=1)
+        self.assertEqual(len(plate['times']), 13)
+        self.assertEqual(len(plate['wells']), 24)
+        kinds = [well['kind'] for well in plate['wells']]
+        self.assertEqual(kinds.count('media'), 2)
+        self.assertEqual(kinds.count('strain'), 2)
+        for well in plate['wells']:
+            self.assertEqual(sorted(well['signals']), ['GFP', 'OD', 'RFP'])
+            for values in well['signals'].values():
+                self.assertEqual(len(values), 13)
+                self.assertTrue(np.all(np.isfinite(values)))
+        # Same seed, same plate
+        again = synthetic_plate(n_wells=24, n_times=13, seed=1)
+        np.testing.assert_array_equal(plate['wells'][5]['signals']['GFP'],
+                                      again['wells'][5]['signals']['GFP'])
+
+    def test_load_and_analyze(self):
+        user = User.objects.create(username='synthetic')
+        plate = synthetic_plate(n_wells=24, n_times=25, seed=0)
+        assay, signals, chemicals = BenchmarkCommand().load_plate(user, plate, 24)
+        samples = Sample.objects.filter(assay=assay)
+        self.assertEqual(samples.count(), 24)
+        self.assertEqual(Signal.objects.filter(owner=user).count(), 3)
+        self.assertEqual(Measurement.objects.filter(sample__assay=assay).count(), 24*3*25)
+        self.assertEqual(samples.filter(vector__isnull=True).count(), 4)
+
+        df = get_measurements(samples)
+        for analysis_type in ['Velocity', 'Mean Expression', 'Induction Curve']:
+            analysis = Analysis({
+                'type': analysis_type,
+                'function': 'Mean Expression',
+                'biomass_signal': signals['OD'].id,
+                'analyte': chemicals['A'].id
+            }, None)
+            result = analysis.analyze(df)
+            self.assertGreater(len(result), 0)
+            self.assertTrue(set(result['Sample']) <= set(df['Sample']))
+
+    def test_benchmark_command(self):
+        n_samples = Sample.objects.count()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'benchmark.json')
+            call_command('benchmark_analysis', sizes=[8], times=9, types=['Velocity'],
+                         output=output, stdout=open(os.devnull, 'w'))
+            with open(output) as f:
+                report = json.load(f)
+        self.assertEqual([(r['type'], r['wells']) for r in report['results']],
+                         [('Load measurements', 8), ('Velocity', 8)])
+        # The synthetic data is rolled back
+        self.assertEqual(Sample.objects.count(), n_samples)
+
+
+def normalize_series(norm_type, meas, column):
+    '''
+    Normalization of a single series, as done series by series before
+    normalize_data was vectorized
+    '''
+    meas = meas.copy()
+    val = meas[column].values
+    if norm_type=='Min/Max':
+        meas[column] = (val-np.nanmin(val)) / (np.nanmax(val) - np.nanmin(val))
+    elif norm_type=='Mean/std':
+        meas[column] = (val-np.nanmean(val)) / np.nanstd(val)
+    elif norm_type=='Temporal Mean':
+        t = meas['Time'].values
+        order = np.argsort(t)
+        ts, vs = t[order], val[order]
+        mean = np.sum(0.5 * np.diff(ts) * (vs[1:] + vs[:-1])) / (ts.max() - ts.min())
+        meas[column] = val / mean
+    return meas
+
+
+class NormalizeTests(SimpleTestCase):
+    """
+    normalize_data must match the normalization of each series on its own
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        rows = []
+        for samp_id in [3, 1, 2]:
+            for signal_id in [2, 1]:
+                t = np.sort(rng.uniform(0, 24, 20))
+                rows.append(pd.DataFrame({
+                    'Sample': samp_id,
+                    'Signal_id': signal_id,
+                    'Time': rng.permutation(t),
+                    'Measurement': rng.uniform(1, 100, 20)
+                }))
+        self.df = pd.concat(rows, ignore_index=True)
+        self.df = self.df.sample(frac=1, random_state=0)
+        self.df.loc[self.df.index[:3], 'Measurement'] = np.nan
+
+    def reference(self, norm_type):
+        rows = []
+        for samp_id, samp_data in self.df.groupby('Sample'):
+            for signal_id, meas in samp_data.groupby('Signal_id'):
+                rows.append(normalize_series(norm_type, meas, 'Measurement'))
+        return pd.concat(rows)
+
+    def test_min_max_and_mean_std(self):
+        for norm_type in ['Min/Max', 'Mean/std']:
+            result = normalize_data(self.df.copy(), norm_type, 'Measurement')
+            pd.testing.assert_frame_equal(result, self.reference(norm_type))
+
+    def test_temporal_mean(self):
+        # Without missing values, which the trapezoid rule does not skip
+        self.df = self.df.dropna()
+        result = normalize_data(self.df.copy(), 'Temporal Mean', 'Measurement')
+        pd.testing.assert_frame_equal(result, self.reference('Temporal Mean'))
+
+    def test_no_normalization(self):
+        self.assertIs(normalize_data(self.df, 'None', 'Measurement'), self.df)
+
+
+class RegularizationTests(SimpleTestCase):
+
+    def test_sweep_without_data(self):
+        analysis = Analysis({'type': 'Expression Rate (inverse)', 'sweep': True}, [1])
+        self.assertTrue(analysis.needs_sweep())
+        self.assertIsNone(analysis.select_regularization(pd.DataFrame()))
+
+
+@override_settings(ANALYSIS_JOB_IN_PROCESS=False)
+class AnalysisJobTests(TestCase):
+    """
+    Analysis jobs submitted through the REST api, run here with run_queued
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner')
+        cls.other = User.objects.create(username='other')
+        plate = synthetic_plate(n_wells=8, n_times=25, seed=0)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(cls.owner, plate, 8)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def submit(self, params, client=None):
+        client = client or self.client
+        return client.post('/api/analysis_job/', {'params': params}, format='json')
+
+    def params(self, **analysis):
+        analysis = dict({'type': 'Velocity', 'biomass_signal': self.signals['OD'].id}, **analysis)
+        return {'assay': [self.assay.id], 'analysis': analysis}
+
+    def test_validation(self):
+        for params in [[1, 2], {'assay': [self.assay.id]}, self.params(type='Unknown')]:
+            response = self.submit(params)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(AnalysisJob.objects.count(), 0)
+
+    def test_run_and_results(self):
+        response = self.submit(self.params())
+        self.assertEqual(response.status_code, 201)
+        job_id = response.json()['id']
+        self.assertEqual(response.json()['status'], AnalysisJob.QUEUED)
+        self.assertEqual(response.json()['params'], self.params())
+
+        response = self.client.get(f'/api/analysis_job/{job_id}/result/')
+        self.assertEqual(response.status_code, 409)
+
+        self.assertEqual(worker.run_queued(), 1)
+        job = self.client.get(f'/api/analysis_job/{job_id}/').json()
+        self.assertEqual(job['status'], AnalysisJob.FINISHED)
+        self.assertEqual(job['attempts'], 1)
+        self.assertGreater(job['n_rows'], 0)
+
+        response = self.client.get(f'/api/analysis_job/{job_id}/result/')
+        result = pd.read_json(io.StringIO(response.content.decode()), orient='split')
+        self.assertEqual(len(result), job['n_rows'])
+        self.assertTrue(set(result['Sample']) <= set(Sample.objects.filter(assay=self.assay)
+                                                          .values_list('id', flat=True)))
+        response = self.client.get(f'/api/analysis_job/{job_id}/result/', {'output': 'csv'})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        response = self.client.get(f'/api/analysis_job/{job_id}/result/', {'output': 'typed'})
+        self.assertEqual(response.json()['data']['length'], job['n_rows'])
+
+    def test_no_measurements(self):
+        params = self.params(type='Expression Rate (inverse)', sweep=True)
+        params['assay'] = [0]
+        job_id = self.submit(params).json()['id']
+        worker.run_queued()
+        job = AnalysisJob.objects.get(id=job_id)
+        self.assertEqual(job.status, AnalysisJob.FINISHED)
+        self.assertEqual(job.n_rows, 0)
+
+    def test_owner_scoping(self):
+        job_id = self.submit(self.params()).json()['id']
+        other = APIClient()
+        other.force_authenticate(self.other)
+        self.assertEqual(other.get('/api/analysis_job/').json()['count'], 0)
+        self.assertEqual(other.get(f'/api/analysis_job/{job_id}/').status_code, 404)
+        self.assertEqual(other.post(f'/api/analysis_job/{job_id}/cancel/').status_code, 404)
+        self.assertEqual(other.delete(f'/api/analysis_job/{job_id}/').status_code, 404)
+        self.assertEqual(self.client.get('/api/analysis_job/').json()['count'], 1)
+
+        # The other user's job only analyzes the samples they can access
+        job_id = self.submit(self.params(), client=other).json()['id']
+        worker.run_queued()
+        self.assertEqual(AnalysisJob.objects.get(id=job_id).n_rows, 0)
+        Study.objects.filter(id=self.assay.study_id).update(public=True)
+        job_id = self.submit(self.params(), client=other).json()['id']
+        worker.run_queued()
+        self.assertGreater(AnalysisJob.objects.get(id=job_id).n_rows, 0)
+
+    def test_cancel(self):
+        job_id = self.submit(self.params()).json()['id']
+        response = self.client.post(f'/api/analysis_job/{job_id}/cancel/')
+        self.assertEqual(response.json()['status'], AnalysisJob.CANCELLED)
+        self.assertEqual(worker.run_queued(), 0)
+        worker.run_job(job_id)
+        self.assertEqual(AnalysisJob.objects.get(id=job_id).status, AnalysisJob.CANCELLED)
+        response = self.client.get(f'/api/analysis_job/{job_id}/result/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.delete(f'/api/analysis_job/{job_id}/').status_code, 204)
+        self.assertFalse(AnalysisJob.objects.filter(id=job_id).exists())
+
+    @override_settings(ANALYSIS_JOB_CHECK_INTERVAL=0)
+    def test_cancel_while_fitting(self):
+        job_id = self.submit(self.params(type='Alpha')).json()['id']
+        fit = growth.fit_gompertz
+        def cancel_and_fit(*args, **kwargs):
+            self.client.post(f'/api/analysis_job/{job_id}/cancel/')
+            return fit(*args, **kwargs)
+        with mock.patch.object(growth, 'fit_gompertz', side_effect=cancel_and_fit) as fits:
+            worker.run_queued()
+        # The plate is not fitted to completion
+        self.assertEqual(fits.call_count, 1)
+        job = AnalysisJob.objects.get(id=job_id)
+        self.assertEqual(job.status, AnalysisJob.CANCELLED)
+        self.assertEqual(job.n_rows, 0)
+
+    def test_cancel_check_interval(self):
+        job_id = self.submit(self.params()).json()['id']
+        AnalysisJob.objects.filter(id=job_id).update(status=AnalysisJob.RUNNING)
+        with override_settings(ANALYSIS_JOB_CHECK_INTERVAL=3600):
+            check = worker.cancel_check(job_id)
+        self.client.post(f'/api/analysis_job/{job_id}/cancel/')
+        with self.assertNumQueries(0):
+            check()
+        with override_settings(ANALYSIS_JOB_CHECK_INTERVAL=0):
+            check = worker.cancel_check(job_id)
+        with self.assertRaises(JobCancelled):
+            check()
+
+    @override_settings(ANALYSIS_JOB_STALE_AFTER=600, ANALYSIS_JOB_MAX_ATTEMPTS=2)
+    def test_recover_stale_jobs(self):
+        now = timezone.now()
+        old = now - timedelta(seconds=900)
+        def running(heartbeat, attempts):
+            return AnalysisJob.objects.create(owner=self.owner, params=json.dumps(self.params()),
+                                              status=AnalysisJob.RUNNING, started=old,
+                                              heartbeat=heartbeat, attempts=attempts)
+        alive = running(now, 1)
+        stopped = running(old, 1)
+        legacy = running(None, 0)
+        failing = running(old, 2)
+        self.assertEqual(sorted(worker.recover_stale_jobs()), [stopped.id, legacy.id])
+        status = dict(AnalysisJob.objects.values_list('id', 'status'))
+        self.assertEqual(status[alive.id], AnalysisJob.RUNNING)
+        self.assertEqual(status[stopped.id], AnalysisJob.QUEUED)
+        self.assertEqual(status[legacy.id], AnalysisJob.QUEUED)
+        self.assertEqual(status[failing.id], AnalysisJob.FAILED)
+
+        # Requeued jobs run again
+        self.assertEqual(worker.run_queued(), 2)
+        stopped.refresh_from_db()
+        self.assertEqual(stopped.status, AnalysisJob.FINISHED)
+        self.assertEqual(stopped.attempts, 2)
+
+
+
+class BiomassIndexTests(TestCase):
+    """
+    The biomass index must hold the background corrected biomass that each
+    analysis used to select from the whole biomass frame
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='biomass')
+        plate = synthetic_plate(n_wells=16, n_times=13, seed=2)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(user, plate, 16)
+
+    def test_against_biomass_frame(self):
+        df = get_measurements(Sample.objects.filter(assay=self.assay))
+        params = {'type': 'Expression Rate (indirect)', 'biomass_signal': self.signals['OD'].id}
+        old = Analysis(params, None)
+        density_df = old.bg_correct(get_biomass(df, old.density_name))
+
+        analysis = Analysis(params, None)
+        # Indexed in two parts, the second does not reload the first
+        samp_ids = sorted(df['Sample'].unique())
+        analysis.get_biomass_index(df[df['Sample'].isin(samp_ids[:5])])
+        biomass = analysis.get_biomass_index(df)
+        with self.assertNumQueries(0):
+            self.assertIs(analysis.get_biomass_index(df), biomass)
+
+        self.assertEqual(sorted(biomass), samp_ids)
+        for samp_id in samp_ids:
+            density = density_df[density_df['Sample']==samp_id].sort_values('Time')
+            time, value = biomass[samp_id]
+            np.testing.assert_array_equal(time, density['Time'].values)
+            np.testing.assert_array_equal(value, density['Measurement'].values)
+        # Background samples are not corrected, their biomass is empty
+        controls = df[df['Vector'].isnull()]['Sample'].unique()
+        self.assertEqual(len(controls), 4)
+        for samp_id in controls:
+            self.assertEqual(len(biomass[samp_id][0]), 0)
+
+
+class GompertzTests(SimpleTestCase):
+    """
+    The analytic Jacobian and warm started batch fits must agree with finite
+    differences and with independent fits of each sample
+    """
+
+    bounds = ([1e-2,0.01,0,-24], [1,4,2,24])
+
+    def test_jacobian(self):
+        t = np.linspace(0, 24, 50)
+        for params in [(0.05, 1.2, 0.6, 3.), (0.02, 3., 0.2, -2.), (0.5, 0.9, 1.5, 10.)]:
+            jac = growth.gompertz_jacobian(t, *params)
+            numeric = np.empty_like(jac)
+            for i in range(4):
+                h = 1e-6 * max(abs(params[i]), 1)
+                up, down = list(params), list(params)
+                up[i] += h
+                down[i] -= h
+                numeric[:,i] = (gompertz(t, *up) - gompertz(t, *down)) / (2*h)
+            np.testing.assert_allclose(jac, numeric, rtol=1e-5, atol=1e-7)
+
+    def test_batch_fits(self):
+        rng = np.random.default_rng(0)
+        t = np.linspace(0, 24, 49)
+        series = {}
+        for i in range(8):
+            params = (0.05 + 0.01*rng.uniform(), 1. + 0.5*rng.uniform(),
+                      0.4 + 0.2*rng.uniform(), 2. + 2*rng.uniform())
+            y = gompertz(t, *params) * (1 + rng.normal(0, 0.01, len(t)))
+            series[i + 1] = (t, y, ('assay', i // 4, i % 4))
+        # Too short to fit
+        series[0] = (t[:3], series[1][1][:3], ('assay', 2, 0))
+
+        fits = growth.fit_gompertz_batch(series, self.bounds)
+        self.assertEqual(sorted(fits), list(range(9)))
+        self.assertIsNone(fits[0])
+        for samp_id in range(1, 9):
+            t, y, _ = series[samp_id]
+            cold = growth.fit_gompertz(t, y, self.bounds)
+            np.testing.assert_allclose(fits[samp_id], cold, rtol=1e-4)
+
+
+class ResultCacheTests(TestCase):
+    """
+    Analysis results are stored per sample and reused by requests with the
+    same parameters while the data is unchanged
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='cache')
+        plate = synthetic_plate(n_wells=8, n_times=25, seed=3)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(user, plate, 8)
+
+    def setUp(self):
+        self.samples = Sample.objects.filter(assay=self.assay)
+        self.df = get_measurements(self.samples)
+
+    def analysis(self, **params):
+        return Analysis(dict({'type': 'Velocity'}, **params), None)
+
+    def sort(self, result):
+        return result.sort_values(['Sample', 'Signal_id', 'Time']).reset_index(drop=True)
+
+    def test_repeat_request(self):
+        fresh = self.analysis().analyze_data(self.df)
+        self.assertEqual(AnalysisResult.objects.count(), self.df.groupby(['Sample', 'Signal_id']).ngroups)
+        analysis = self.analysis()
+        with mock.patch.object(Analysis, 'compute') as compute:
+            cached = analysis.analyze_data(self.df)
+        compute.assert_not_called()
+        pd.testing.assert_frame_equal(self.sort(cached)[fresh.columns], self.sort(fresh),
+                                      check_dtype=False)
+
+    def test_parameter_change(self):
+        self.analysis().analyze_data(self.df)
+        with mock.patch.object(Analysis, 'compute', return_value=pd.DataFrame()) as compute:
+            self.analysis(pre_smoothing=11).analyze_data(self.df)
+            self.analysis(incremental=False).analyze_data(self.df)
+        self.assertEqual(compute.call_count, 2)
+        # Without cache nothing is stored
+        AnalysisResult.objects.all().delete()
+        with override_settings(ANALYSIS_CACHE_ENABLED=False):
+            self.analysis().analyze_data(self.df)
+        self.assertEqual(AnalysisResult.objects.count(), 0)
+
+    def test_single_lookup(self):
+        samp_ids = sorted(self.df['Sample'].unique())
+        self.analysis().analyze_data(self.df[self.df['Sample'].isin(samp_ids[:3])])
+        analysis = self.analysis()
+        with mock.patch.object(cache, 'get_data_versions', wraps=cache.get_data_versions) as versions:
+            cached, samples = analysis.get_cached_results(self.samples)
+            df = get_measurements(samples)
+            result = analysis.analyze_data(df)
+        self.assertEqual(versions.call_count, 1)
+        self.assertEqual(sorted(pd.concat(cached)['Sample'].unique()), samp_ids[:3])
+        self.assertEqual(sorted(result['Sample'].unique()), sorted(df['Sample'].unique()))
+        self.assertFalse(set(df['Sample']) & set(samp_ids[:3]))
+        # The samples analyzed are now stored too
+        with mock.patch.object(Analysis, 'compute') as compute:
+            self.analysis().analyze_data(self.df)
+        compute.assert_not_called()
+
+    def test_evict(self):
+        samp = self.samples.first()
+        now = timezone.now()
+        for i in range(5):
+            AnalysisResult.objects.create(key=str(i), analysis_type='Velocity', params='{}',
+                                          sample=samp, signal=self.signals['OD'],
+                                          data_version='0', data='', size=100)
+        # Used in the order 2, 0, 4, 1, 3
+        for i, key in enumerate(['2', '0', '4', '1', '3']):
+            AnalysisResult.objects.filter(key=key).update(last_used=now + timedelta(seconds=i))
+        cache.evict(max_size=500)
+        self.assertEqual(AnalysisResult.objects.count(), 5)
+        cache.evict(max_size=250)
+        self.assertEqual(sorted(AnalysisResult.objects.values_list('key', flat=True)), ['1', '3'])
+        with override_settings(ANALYSIS_CACHE_MAX_SIZE=100):
+            cache.evict()
+        self.assertEqual(list(AnalysisResult.objects.values_list('key', flat=True)), ['3'])
+
+
+class IncrementalTests(TestCase):
+    """
+    After an edit only the samples whose data, or background controls,
+    changed are analyzed again
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='incremental')
+        plate = synthetic_plate(n_wells=8, n_times=13, seed=4)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(cls.user, plate, 8)
+
+    def setUp(self):
+        self.samples = Sample.objects.filter(assay=self.assay)
+        self.controls = set(self.samples.filter(vector__isnull=True).values_list('id', flat=True))
+        self.all = set(self.samples.values_list('id', flat=True))
+        self.analyze()
+
+    def analyze(self):
+        '''
+        Analyze the assay, returning the set of samples computed
+        '''
+        computed = set()
+        original = Analysis.compute
+        def compute(analysis, df):
+            if len(df)>0:
+                computed.update(df['Sample'].unique())
+            return original(analysis, df)
+        analysis = Analysis({'type': 'Mean Expression',
+                             'biomass_signal': self.signals['OD'].id}, None)
+        with mock.patch.object(Analysis, 'compute', compute):
+            cached, samples = analysis.get_cached_results(self.samples)
+            analysis.analyze_data(get_measurements(samples))
+        return computed
+
+    def measurement(self, control=False):
+        return Measurement.objects.filter(sample__assay=self.assay,
+                                          sample__vector__isnull=control).order_by('id').first()
+
+    def test_unchanged(self):
+        self.assertEqual(self.analyze(), set())
+
+    def test_sample_edit(self):
+        meas = self.measurement()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.patch(f'/api/measurement/{meas.id}/', {'value': meas.value + 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.analyze(), {meas.sample_id})
+
+    def test_control_edit(self):
+        meas = self.measurement(control=True)
+        meas.value += 1
+        admin.site._registry[Measurement].save_model(None, meas, None, True)
+        self.assertEqual(self.analyze(), self.all)
+
+    def test_new_control(self):
+        control = self.samples.get(id=min(self.controls))
+        Sample.objects.create(assay=self.assay, media=control.media, strain=control.strain,
+                              row=7, col=7)
+        self.assertEqual(self.analyze(), self.all)
+        self.assertEqual(self.analyze(), set())
+
+    def test_admin_delete(self):
+        model_admin = admin.site._registry[Measurement]
+        meas = self.measurement()
+        version = Sample.objects.get(id=meas.sample_id).data_version
+        model_admin.delete_model(None, meas)
+        self.assertEqual(Sample.objects.get(id=meas.sample_id).data_version, version + 1)
+
+    def test_admin_delete_series(self):
+        # Whole series, so that the background still matches each time
+        model_admin = admin.site._registry[Measurement]
+        meas = self.measurement(control=True)
+        series = Measurement.objects.filter(sample_id=meas.sample_id, signal_id=meas.signal_id)
+        model_admin.delete_queryset(None, series)
+        self.assertEqual(self.analyze(), self.all)
+
+
+def old_chemical_data(df, chemical_ids, columns):
+    '''
+    Samples containing all the chemicals, with a column of the concentration
+    of each, selected sample by sample as before the supplement index
+    '''
+    data = df
+    for chemical_id in chemical_ids:
+        data = data[data['Chemical_id'].apply(lambda x: chemical_id in x)]
+    chem_data = []
+    for samp_id, samp_data in data.groupby('Sample'):
+        chem_ids = samp_data.Chemical_id.values[0]
+        samp_data = samp_data.copy()
+        for chemical_id, column in zip(chemical_ids, columns):
+            idx = np.where(np.array(chem_ids)==chemical_id)[0]
+            samp_data[column] = samp_data[f'Concentration{idx[0]+1}']
+        chem_data.append(samp_data)
+    return pd.concat(chem_data)
+
+
+class SupplementIndexTests(TestCase):
+    """
+    Induction curves and heatmaps must select the same samples and
+    concentrations as the per-sample selection they replaced
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create(username='supplements')
+        study = Study.objects.create(name='study', description='', owner=owner, public=False)
+        assay = Assay.objects.create(study=study, name='assay', machine='',
+                                     description='', temperature=30.)
+        vector = Vector.objects.create(owner=owner, name='vector')
+        cls.signal = Signal.objects.create(owner=owner, name='signal', description='')
+        chem_a = Chemical.objects.create(owner=owner, name='A', description='')
+        chem_b = Chemical.objects.create(owner=owner, name='B', description='')
+        cls.chemicals = chem_a.id, chem_b.id
+        a1 = Supplement.objects.create(owner=owner, name='A1', chemical=chem_a, concentration=0.1)
+        a2 = Supplement.objects.create(owner=owner, name='A2', chemical=chem_a, concentration=1.)
+        b1 = Supplement.objects.create(owner=owner, name='B1', chemical=chem_b, concentration=5.)
+        # No supplement, one of A, one of each, two of A, two of A and one of B
+        contents = [[], [a1], [b1], [a2, b1], [b1, a1], [a1, a2], [a2, a1, b1]]
+        rng = np.random.default_rng(5)
+        meas = []
+        for col, supplements in enumerate(contents):
+            samp = Sample.objects.create(assay=assay, vector=vector, row=0, col=col)
+            samp.supplements.add(*supplements)
+            for t in range(5):
+                meas.append(Measurement(sample=samp, signal=cls.signal, value=rng.uniform(), time=t))
+        Measurement.objects.bulk_create(meas)
+        cls.df = get_measurements(Sample.objects.filter(assay=assay))
+
+    def sort(self, df):
+        return df.sort_values(['Sample', 'Time', 'Concentration1']).reset_index(drop=True)
+
+    def analysis(self, **params):
+        return Analysis(dict(params, function='Background Correct'), None)
+
+    def test_induction_curve(self):
+        chem_a, chem_b = self.chemicals
+        for chemical_id in self.chemicals:
+            analysis = self.analysis(type='Induction Curve', analyte=chemical_id)
+            result = analysis.induction_curve(self.df)
+            expected = old_chemical_data(self.df, [chemical_id], ['Concentration'])
+            pd.testing.assert_frame_equal(self.sort(result), self.sort(expected))
+        # Both concentrations of A are kept in the samples with two of A
+        result = self.analysis(type='Induction Curve', analyte=chem_a).induction_curve(self.df)
+        concs = result.groupby('Sample')['Concentration'].unique()
+        self.assertEqual(sorted(len(c) for c in concs), [1, 1, 1, 2, 2])
+
+    def test_heatmap(self):
+        chem_a, chem_b = self.chemicals
+        for chemicals in [(chem_a, chem_b), (chem_b, chem_a)]:
+            analysis = self.analysis(type='Heatmap', analyte1=chemicals[0], analyte2=chemicals[1])
+            result = analysis.heatmap(self.df)
+            expected = old_chemical_data(self.df, chemicals, ['Concentration A', 'Concentration B'])
+            pd.testing.assert_frame_equal(self.sort(result), self.sort(expected))
+            self.assertEqual(result['Sample'].nunique(), 3)
+
+    def test_missing_chemical(self):
+        analysis = self.analysis(type='Induction Curve', analyte=0)
+        self.assertEqual(len(analysis.induction_curve(self.df)), 0)
+
+
+@override_settings(ANALYSIS_CACHE_ENABLED=False)
+class MultiAnalysisTests(TestCase):
+    """
+    Several analysis types analyzed in one pass must give the results of
+    each type analyzed on its own, correcting the background, loading the
+    biomass and fitting growth once for all of them
+    """
+
+    types = ['Expression Rate (indirect)', 'Mean Expression', 'Alpha', 'Rho']
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='multi')
+        plate = synthetic_plate(n_wells=12, n_times=49, seed=6)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(user, plate, 12)
+
+    def params(self, analysis_type):
+        return {
+            'type': analysis_type,
+            'biomass_signal': self.signals['OD'].id,
+            'ref_signal': self.signals['RFP'].id
+        }
+
+    def sort(self, result):
+        return result.sort_values(['Sample', 'Signal_id', 'Time']).reset_index(drop=True)
+
+    def test_analyze_all(self):
+        df = get_measurements(Sample.objects.filter(assay=self.assay))
+        analysis = Analysis(self.params(self.types), None)
+        with mock.patch.object(Analysis, 'bg_correct', autospec=True,
+                               side_effect=Analysis.bg_correct) as bg_correct, \
+                mock.patch.object(Analysis, 'compute_background', autospec=True,
+                                  side_effect=Analysis.compute_background) as background, \
+                mock.patch.object(growth, 'fit_gompertz_batch',
+                                  wraps=growth.fit_gompertz_batch) as fits:
+            results = analysis.analyze_all(df)
+        # Measurements and biomass are each corrected once
+        self.assertEqual(bg_correct.call_count, 2)
+        self.assertEqual(background.call_count, 1)
+        self.assertEqual(fits.call_count, 1)
+
+        self.assertEqual(list(results), self.types)
+        self.assertTrue(results['Rho']['Rho'].notnull().any())
+        for analysis_type in self.types:
+            expected = Analysis(self.params(analysis_type), None).analyze(df)
+            self.assertGreater(len(expected), 0)
+            pd.testing.assert_frame_equal(self.sort(results[analysis_type]), self.sort(expected))
+
+        combined = analysis.analyze(df)
+        self.assertEqual(sorted(combined['Analysis'].unique()), sorted(self.types))
+        self.assertEqual(len(combined), sum(len(result) for result in results.values()))
+
+
+@override_settings(ANALYSIS_CACHE_ENABLED=False)
+class SummaryAnalysisTests(TestCase):
+    """
+    Mean and Max Expression computed from the measurement summaries must
+    equal those computed from the measurements
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create(username='summaries')
+        plate = synthetic_plate(n_wells=12, n_times=13, seed=7)
+        cls.assay, cls.signals, cls.chemicals = BenchmarkCommand().load_plate(user, plate, 12)
+
+    def setUp(self):
+        self.samples = Sample.objects.filter(assay=self.assay)
+
+    def analysis(self, analysis_type):
+        return Analysis({'type': analysis_type, 'biomass_signal': self.signals['OD'].id}, None)
+
+    def check(self, analysis_type):
+        summary = self.analysis(analysis_type).analyze_summaries(self.samples)
+        expected = self.analysis(analysis_type).analyze(get_measurements(self.samples))
+        self.assertEqual(len(summary), len(expected))
+        columns = ['Sample', 'Signal_id', 'Expression']
+        summary = summary[columns].sort_values(columns[:2]).reset_index(drop=True)
+        expected = expected[columns].sort_values(columns[:2]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(summary, expected, check_dtype=False, rtol=1e-9)
+
+    def test_with_background(self):
+        self.check('Mean Expression')
+        # The max of a background corrected series is not in the summaries
+        self.assertIsNone(self.analysis('Max Expression').analyze_summaries(self.samples))
+
+    def test_without_background(self):
+        self.samples.filter(vector__isnull=True).delete()
+        self.check('Mean Expression')
+        self.check('Max Expression')
+
+    def test_control_lengths(self):
+        # Controls of different lengths, the mean of their means is not
+        # the mean background
+        meas = Measurement.objects.filter(sample__in=self.samples.filter(vector__isnull=True)) \
+                                  .order_by('-time', 'id').first()
+        meas.delete()
+        measurements_changed([meas.sample_id])
+        self.assertIsNone(self.analysis('Mean Expression').analyze_summaries(self.samples))
@@ -0,0 +1,10 @@
+from rest_framework import routers
+from django.conf.urls import url, include
+from . import views
+
+router = routers.DefaultRouter()
+router.register(r'analysis_job', views.AnalysisJobViewSet, basename='analysis_job')
+
+urlpatterns = [
+    url(r'^api/', include(router.urls))
+]
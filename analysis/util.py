@@ -1,6 +1,5 @@
 import numpy as np
 import pandas as pd
-import wellfare as wf
 
 # Model functions for fitting to data
 # -----------------------------------------------------------------------------------
@@ -24,25 +23,50 @@ def gompertz_growth_rate(t, y0, ymax, um, l):
     return(gr)
 
 # Normalization functions
-def normalize_min_max(data, column):    
-    val = data[column].values
-    nval = (val-np.nanmin(val)) / (np.nanmax(val) - np.nanmin(val))
-    data[column] = nval
+# Each normalizes the column of every (Sample, Signal_id) series in data
+# -----------------------------------------------------------------------------------
+series_keys = ['Sample', 'Signal_id']
+
+def normalize_min_max(data, column):
+    grouped = data.groupby(series_keys)[column]
+    vmin = grouped.transform('min')
+    vmax = grouped.transform('max')
+    data[column] = (data[column] - vmin) / (vmax - vmin)
     return data
 
-def normalize_mean_std(data, column):    
-    val = data[column].values
-    nval = (val-np.nanmean(val)) / np.nanstd(val)
-    data[column] = nval
+def normalize_mean_std(data, column):
+    grouped = data.groupby(series_keys)[column]
+    mean = grouped.transform('mean')
+    # Population standard deviation (ddof=0), as np.nanstd
+    dev = data[column] - mean
+    std = np.sqrt((dev**2).groupby([data[key] for key in series_keys]).transform('mean'))
+    data[column] = dev / std
     return data
 
-def normalize_temporal_mean(data, column):    
-    val = data[column].values
-    t = data['Time'].values
-    sval = wf.curves.Curve(x=t, y=val)
-    sval = sval.normalized()
-    nval = sval(t)
-    data[column] = nval
+def normalize_temporal_mean(data, column):
+    '''
+    Divide each series by its temporal mean, the trapezoid rule integral
+    over time divided by the duration
+    '''
+    t = data['Time'].values.astype(float)
+    val = data[column].values.astype(float)
+    codes = data.groupby(series_keys).ngroup().values
+    # Sort by series then time
+    order = np.lexsort((t, codes))
+    t, val, codes = t[order], val[order], codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:]!=codes[:-1]])
+    # Area of each trapezoid, zero across series boundaries
+    area = np.zeros_like(val)
+    area[1:] = 0.5 * (t[1:] - t[:-1]) * (val[1:] + val[:-1])
+    area[starts] = 0.
+    integral = np.add.reduceat(area, starts)
+    duration = np.maximum.reduceat(t, starts) - np.minimum.reduceat(t, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = integral / duration
+        nval = val / np.repeat(mean, np.diff(np.r_[starts, len(val)]))
+    result = np.empty_like(nval)
+    result[order] = nval
+    data[column] = result
     return data
 
 def normalize_data(df, norm_type, column):
@@ -52,17 +76,13 @@ def normalize_data(df, norm_type, column):
         'Temporal Mean': normalize_temporal_mean
     }
     norm_func = norm_funcs.get(norm_type, None)
-    rows = []
-    result = pd.DataFrame()
     if norm_func:
-        grouped_samp = df.groupby('Sample')
-        for samp_id,samp_data in grouped_samp:
-            grouped_name = samp_data.groupby('Signal_id')
-            for name,meas in grouped_name:
-                meas = norm_func(meas, column)
-                rows.append(meas)
-        if len(rows)>0:
-            result = result.append(rows)
-        return result
+        if len(df)==0:
+            return pd.DataFrame()
+        # Drop series without sample or signal, and order the rows by
+        # series as the result was previously assembled series by series
+        df = df.dropna(subset=series_keys)
+        df = df.sort_values(series_keys, kind='mergesort')
+        return norm_func(df.copy(), column)
     else:
-        return df
\ No newline at end of file
+        return df
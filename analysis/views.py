@@ -1,3 +1,67 @@
-from django.shortcuts import render
+import io
+import pandas as pd
+from django.http import HttpResponse
+from rest_framework import viewsets, mixins, status
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from .encoding import ResultStream
+from .models import AnalysisJob
+from .serializers import AnalysisJobSerializer
+from . import worker
 
-# Create your views here.
+
+class AnalysisJobViewSet(mixins.CreateModelMixin,
+                         mixins.ListModelMixin,
+                         mixins.RetrieveModelMixin,
+                         mixins.DestroyModelMixin,
+                         viewsets.GenericViewSet):
+    """
+    API endpoint to submit analyses to run in the background, poll their
+    status and progress and download their results.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = AnalysisJobSerializer
+
+    def get_queryset(self):
+        return AnalysisJob.objects.filter(owner=self.request.user) \
+                                  .defer('result').order_by('-created')
+
+    def perform_create(self, serializer):
+        job = serializer.save()
+        worker.enqueue(job.id)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        job = self.get_object()
+        AnalysisJob.objects.filter(
+            id=job.id, status__in=[AnalysisJob.QUEUED, AnalysisJob.RUNNING]
+        ).update(status=AnalysisJob.CANCELLED)
+        job.refresh_from_db()
+        return Response(self.get_serializer(job).data)
+
+    @action(detail=True, methods=['get'])
+    def result(self, request, pk=None):
+        '''
+        Result of a finished job, ?output=json (default), csv or typed
+        '''
+        job = AnalysisJob.objects.get(id=self.get_object().id)
+        if job.status != AnalysisJob.FINISHED:
+            return Response({'detail': f'Job is {job.status}', 'status': job.status},
+                            status.HTTP_409_CONFLICT)
+        output = request.query_params.get('output', 'json')
+        if output == 'json':
+            return HttpResponse(job.result, content_type='application/json')
+        df = pd.read_json(io.StringIO(job.result), orient='split')
+        if output == 'csv':
+            response = HttpResponse(df.to_csv(index=False), content_type='text/csv')
+            response['Content-Disposition'] = f'attachment; filename="analysis-{job.id}.csv"'
+            return response
+        if output == 'typed':
+            stream = ResultStream()
+            return Response({
+                'metadata': stream.metadata_message([df]),
+                'data': stream.data_message(df, 100)
+            })
+        return Response({'detail': f'Unknown output {output}, expected json, csv or typed'},
+                        status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,251 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from analysis.analysis import Analysis
+from analysis.models import AnalysisJob
+from registry.util import get_samples
+from flapjack_api.jobs import JobCancelled
+from flapjack_api.timing import span
+
+logger = logging.getLogger('flapjack.jobs')
+
+# Background execution of analysis jobs submitted through the REST api
+# -----------------------------------------------------------------------------------
+# The queue is the AnalysisJob table, so queued jobs survive restarts and can
+# also be run out of process with the run_analysis_jobs command. Running jobs
+# refresh a heartbeat, jobs whose heartbeat stops are requeued.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''
+    Thread pool running the jobs of this process, created on first use when
+    queued jobs, and running jobs of stopped workers, are also resumed
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'ANALYSIS_JOB_WORKERS', 2)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis-job')
+            recover_stale_jobs()
+            queued = list(AnalysisJob.objects.filter(status=AnalysisJob.QUEUED)
+                                             .order_by('created')
+                                             .values_list('id', flat=True))
+            for job_id in queued:
+                _executor.submit(run_job, job_id)
+            threading.Thread(target=monitor, name='analysis-job-monitor', daemon=True).start()
+    return _executor
+
+
+def monitor():
+    '''
+    Periodically requeue and run the jobs of stopped workers
+    '''
+    interval = getattr(settings, 'ANALYSIS_JOB_STALE_AFTER', 600) / 4
+    while True:
+        time.sleep(interval)
+        try:
+            for job_id in recover_stale_jobs():
+                _executor.submit(run_job, job_id)
+        except Exception:
+            logger.exception('Recovering stale analysis jobs failed')
+        finally:
+            connection.close()
+
+
+def recover_stale_jobs():
+    '''
+    Requeue running jobs whose heartbeat is older than ANALYSIS_JOB_STALE_AFTER
+    seconds, because the process running them stopped. Jobs already attempted
+    ANALYSIS_JOB_MAX_ATTEMPTS times are marked as failed instead.
+
+    Returns:
+    job_ids = ids of the requeued jobs
+    '''
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'ANALYSIS_JOB_STALE_AFTER', 600))
+    max_attempts = getattr(settings, 'ANALYSIS_JOB_MAX_ATTEMPTS', 2)
+    # Jobs started before heartbeats were recorded have none
+    stale = AnalysisJob.objects.filter(
+        Q(heartbeat__lt=cutoff) | Q(heartbeat__isnull=True, started__lt=cutoff),
+        status=AnalysisJob.RUNNING
+    )
+    n_failed = stale.filter(attempts__gte=max_attempts) \
+                    .update(status=AnalysisJob.FAILED,
+                            error=f'Interrupted {max_attempts} times by stopped workers',
+                            finished=now)
+    job_ids = []
+    for job_id in list(stale.values_list('id', flat=True)):
+        # Unless its heartbeat was refreshed meanwhile
+        n = stale.filter(id=job_id).update(status=AnalysisJob.QUEUED,
+                                           progress=0,
+                                           started=None,
+                                           heartbeat=None)
+        if n==1:
+            job_ids.append(job_id)
+    if n_failed or job_ids:
+        logger.warning('Stale analysis jobs: %d failed, requeued %s', n_failed, job_ids)
+    return job_ids
+
+
+def enqueue(job_id):
+    '''
+    Run the job in the background once the transaction creating it commits,
+    unless jobs are run out of process
+    '''
+    if getattr(settings, 'ANALYSIS_JOB_IN_PROCESS', True):
+        transaction.on_commit(lambda: get_executor().submit(run_job, job_id))
+
+
+def claim(job_id):
+    '''
+    Mark a queued job as running, returns False if it was claimed by another
+    worker or cancelled meanwhile
+    '''
+    now = timezone.now()
+    n = AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.QUEUED) \
+                           .update(status=AnalysisJob.RUNNING,
+                                   started=now,
+                                   heartbeat=now,
+                                   attempts=F('attempts')+1)
+    return n==1
+
+
+def keep_alive(job_id, stop):
+    '''
+    Refresh the heartbeat of a running job until stop is set
+    '''
+    interval = getattr(settings, 'ANALYSIS_JOB_HEARTBEAT', 30)
+    try:
+        while not stop.wait(interval):
+            AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.RUNNING) \
+                               .update(heartbeat=timezone.now())
+    finally:
+        connection.close()
+
+
+def run_job(job_id):
+    try:
+        if not claim(job_id):
+            return
+        job = AnalysisJob.objects.get(id=job_id)
+        stop = threading.Event()
+        threading.Thread(target=keep_alive, args=(job_id, stop), daemon=True).start()
+        try:
+            with span('job.analysis'):
+                df = execute(job)
+        except JobCancelled:
+            return
+        except Exception as e:
+            logger.exception('Analysis job %s failed', job_id)
+            AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.RUNNING) \
+                               .update(status=AnalysisJob.FAILED,
+                                       error=f'{type(e).__name__}: {e}',
+                                       finished=timezone.now())
+            return
+        finally:
+            stop.set()
+        AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.RUNNING) \
+                           .update(status=AnalysisJob.FINISHED,
+                                   progress=100,
+                                   result=df.to_json(orient='split'),
+                                   n_rows=len(df),
+                                   finished=timezone.now())
+    finally:
+        # Worker threads are not request threads, close their connection here
+        connection.close()
+
+
+def set_progress(job_id, progress):
+    '''
+    Update the progress of a running job, raising JobCancelled if the job
+    was cancelled or deleted
+    '''
+    n = AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.RUNNING) \
+                           .update(progress=progress)
+    if n==0:
+        raise JobCancelled(f"Job {job_id} was cancelled")
+
+
+def cancel_check(job_id):
+    '''
+    Check function for the Analysis of a job, raising JobCancelled once the
+    job is no longer running. The job is queried at most once every
+    ANALYSIS_JOB_CHECK_INTERVAL seconds, however often the check is called.
+    '''
+    interval = getattr(settings, 'ANALYSIS_JOB_CHECK_INTERVAL', 2)
+    last_check = [time.monotonic()]
+    def check():
+        now = time.monotonic()
+        if now - last_check[0] < interval:
+            return
+        last_check[0] = now
+        if not AnalysisJob.objects.filter(id=job_id, status=AnalysisJob.RUNNING).exists():
+            raise JobCancelled(f"Job {job_id} was cancelled")
+    return check
+
+
+def get_job_samples(job, params):
+    '''
+    Samples selected by the job parameters that the job owner can access
+    '''
+    user = job.owner
+    s = get_samples(params)
+    return s.filter(
+        Q(assay__study__owner=user) |
+        Q(assay__study__public=True) |
+        Q(assay__study__shared_with=user)
+    ).distinct()
+
+
+def execute(job):
+    '''
+    Run the analysis of a job, one plate at a time as in the websocket
+    consumers, and return the combined result dataframe
+    '''
+    params = json.loads(job.params)
+    analysis_params = params['analysis']
+    signals = params.get('signal')
+    s = get_job_samples(job, params)
+    analysis = Analysis(analysis_params, signals, check=cancel_check(job.id))
+    results, df = analysis.get_data(s)
+    if len(df)>0:
+        grouped = df.groupby(['Study', 'Assay'])
+        n_assays = len(grouped)
+        progress = 0
+        for id,g in grouped:
+            set_progress(job.id, 100 * progress / n_assays)
+            results.append(analysis.analyze(g))
+            progress += 1
+    results = [result for result in results if len(result)>0]
+    if len(results)==0:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True, sort=False)
+
+
+def run_queued(limit=None):
+    '''
+    Run queued jobs in this thread, oldest first
+
+    Returns:
+    n = number of jobs run
+    '''
+    n = 0
+    while limit is None or n < limit:
+        job_id = AnalysisJob.objects.filter(status=AnalysisJob.QUEUED) \
+                                    .order_by('created') \
+                                    .values_list('id', flat=True).first()
+        if job_id is None:
+            break
+        run_job(job_id)
+        n += 1
+    return n
@@ -1,12 +1,73 @@
 # https://hashnode.com/post/using-django-drf-jwt-authentication-with-django-channels-cjzy5ffqs0013rus1yb9huxvl
 
-from django.db import close_old_connections
+import logging
+import threading
+import time
 from rest_framework_simplejwt.tokens import UntypedToken
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from jwt import decode as jwt_decode
+from rest_framework_simplejwt.settings import api_settings
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from urllib.parse import parse_qs
+from flapjack_api.executor import run_sync
+
+logger = logging.getLogger('flapjack.consumers')
+
+
+class UserCache:
+    """
+    Users of recent websocket connections by id, kept for ttl seconds so that
+    reconnections do not query the database. Entries are dropped when the
+    user is saved or deleted in this process, other processes see the change
+    once the entry expires.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get_ttl(self):
+        if self.ttl is not None:
+            return self.ttl
+        return getattr(settings, 'WS_USER_CACHE_TTL', 60)
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            user, expires = entry
+            if time.monotonic() >= expires:
+                del self.entries[user_id]
+                return None
+            return user
+
+    def put(self, user):
+        ttl = self.get_ttl()
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[user.pk] = (user, time.monotonic() + ttl)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+user_cache = UserCache()
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_user(sender, instance, **kwargs):
+    if sender is get_user_model():
+        user_cache.invalidate(instance.pk)
 
 
 class TokenAuthMiddleware:
@@ -19,36 +80,72 @@ class TokenAuthMiddleware:
         self.inner = inner
 
     def __call__(self, scope):
+        # Authentication may query the database, which cannot be done here in
+        # the event loop, so it is deferred to the instance
+        return TokenAuthMiddlewareInstance(scope, self)
+
+
+class TokenAuthMiddlewareInstance:
+    """
+    Authenticates the connection of a scope, then runs the inner application
+    """
+
+    def __init__(self, scope, middleware):
+        self.middleware = middleware
+        self.scope = dict(scope)
+        self.inner = self.middleware.inner
+
+    async def __call__(self, receive, send):
+        user_id = get_token_user_id(self.scope)
+        if user_id is None:
+            # Reject the websocket handshake
+            await send({'type': 'websocket.close'})
+            return
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await run_sync(get_user, user_id)
+            if user is None:
+                await send({'type': 'websocket.close'})
+                return
+        # Instantiate the inner application with the user shared by all
+        # consumers, and let it run everything else
+        inner = self.inner(dict(self.scope, user=user))
+        return await inner(receive, send)
+
+
+def get_token_user_id(scope):
+    '''
+    Id of the user of the token in the query string of the scope, None if
+    the token is missing or invalid
+    '''
+    # Get the token
+    token = parse_qs(scope["query_string"].decode("utf8")).get("token", [None])[0]
+    if token is None:
+        return None
+
+    # Try to authenticate the user
+    try:
+        # This validates and decodes the token once, raising an error if it is invalid
+        decoded_data = UntypedToken(token)
+    except (InvalidToken, TokenError) as e:
+        # Token is invalid
+        logger.info('Rejected websocket token: %s', e)
+        return None
+    # The payload is a dictionary like -
+    # {
+    #     "token_type": "access",
+    #     "exp": 1568770772,
+    #     "jti": "5c15e80d65b04c20ad34d77b6703251b",
+    #     "user_id": 6
+    # }
+    return decoded_data.get(api_settings.USER_ID_CLAIM)
+
 
-        # Close old database connections to prevent usage of timed out connections
-        close_old_connections()
-
-        # Get the token
-        token = parse_qs(scope["query_string"].decode("utf8"))["token"][0]
-
-        # Try to authenticate the user
-        try:
-            # This will automatically validate the token and raise an error if token is invalid
-            UntypedToken(token)
-        except (InvalidToken, TokenError) as e:
-            # Token is invalid
-            print(e)
-            return None
-        else:
-            #  Then token is valid, decode it
-            decoded_data = jwt_decode(
-                token, settings.SECRET_KEY, algorithms=["HS256"])
-            # print(decoded_data)
-            # Will return a dictionary like -
-            # {
-            #     "token_type": "access",
-            #     "exp": 1568770772,
-            #     "jti": "5c15e80d65b04c20ad34d77b6703251b",
-            #     "user_id": 6
-            # }
-
-            # Get the user using ID
-            user = get_user_model().objects.get(id=decoded_data["user_id"])
-
-        # Return the inner application directly and let it run everything else
-        return self.inner(dict(scope, user=user))
+def get_user(user_id):
+    '''
+    Get the user using ID and cache it, None if it does not exist
+    '''
+    user = get_user_model().objects.filter(id=user_id).first()
+    if user is not None:
+        user_cache.put(user)
+    return user
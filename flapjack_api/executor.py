@@ -0,0 +1,58 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+
+# Thread pool for the blocking work of websocket consumers
+# -----------------------------------------------------------------------------------
+# ORM queries and CPU heavy pandas/plotly work must not run in the event loop,
+# where they would stall every other connection served by the same worker
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''
+    Bounded thread pool shared by all consumers, of settings.CONSUMER_WORKERS threads
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = getattr(settings, 'CONSUMER_WORKERS', 8)
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='consumer')
+    return _executor
+
+
+def call_with_connections(func, *args, **kwargs):
+    # Database connections of pool threads are reused across calls, close
+    # them if they timed out as database_sync_to_async does
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_sync(func, *args, **kwargs):
+    '''
+    Run the blocking function func(*args, **kwargs) in the consumer thread
+    pool and return its result, e.g.
+
+        df = await run_sync(get_measurements, samples, signals)
+    '''
+    loop = asyncio.get_event_loop()
+    call = functools.partial(call_with_connections, func, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(), call)
+
+
+def sync_to_pool(func):
+    '''
+    Decorator making the blocking function or method func awaitable, running
+    it in the consumer thread pool with run_sync
+    '''
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_sync(func, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,82 @@
+import asyncio
+import itertools
+import logging
+import threading
+
+logger = logging.getLogger('flapjack.jobs')
+
+
+class JobCancelled(Exception):
+    """
+    Raised by synchronous code running on behalf of a cancelled job
+    """
+
+
+class Job:
+    """
+    A request running as an asyncio task. Synchronous work done for the job
+    in worker threads should call check() regularly so that it stops when the
+    job is cancelled.
+    """
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.task = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.task:
+            self.task.cancel()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled")
+
+
+class JobManager:
+    """
+    Per-connection manager of the jobs started by websocket requests. By
+    default a new job supersedes (cancels) those still running.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.ids = itertools.count(1)
+
+    def submit(self, func, *args, supersede=True):
+        '''
+        Run the coroutine function func(job, *args) as a new job
+
+        Returns:
+        job = the Job object, job.id identifies it to the client
+        '''
+        if supersede:
+            self.cancel_all()
+        job = Job(next(self.ids))
+        self.jobs[job.id] = job
+        job.task = asyncio.ensure_future(self.run(job, func, *args))
+        # Forget the job when done, even if cancelled before it started
+        job.task.add_done_callback(lambda task: self.jobs.pop(job.id, None))
+        return job
+
+    async def run(self, job, func, *args):
+        try:
+            await func(job, *args)
+        except (asyncio.CancelledError, JobCancelled):
+            logger.info('Job %s cancelled', job.id)
+        except Exception:
+            logger.exception('Job %s failed', job.id)
+
+    def cancel(self, job_id=None):
+        '''
+        Cancel the job with the given id, or all jobs if job_id is None
+        '''
+        if job_id is None:
+            self.cancel_all()
+        elif job_id in self.jobs:
+            self.jobs[job_id].cancel()
+
+    def cancel_all(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
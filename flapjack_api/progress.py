@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+
+class ProgressReporter:
+    """
+    Coalesces the progress updates of a long running consumer task. A message
+    is sent only when the progress has changed by at least min_step, or has
+    changed at all after interval seconds, and the task yields to the event
+    loop once every yield_interval seconds instead of on every update.
+    """
+
+    def __init__(self, send, min_step=1, interval=0.5, yield_interval=0.05):
+        '''
+        send = coroutine function send(progress) sending the progress message,
+               or None to only yield to the event loop, see pause
+        '''
+        self.send = send
+        self.min_step = min_step
+        self.interval = interval
+        self.yield_interval = yield_interval
+        self.sent = None
+        self.last_send = self.last_yield = time.monotonic()
+
+    async def update(self, progress):
+        now = time.monotonic()
+        if self.sent is None or abs(progress - self.sent) >= self.min_step \
+                or (progress != self.sent and now - self.last_send >= self.interval):
+            await self.send(progress)
+            self.sent = progress
+            self.last_send = now
+        await self.pause(now)
+
+    async def pause(self, now=None):
+        '''
+        Yield to the event loop if yield_interval has passed since last time
+        '''
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_yield >= self.yield_interval:
+            await asyncio.sleep(0)
+            self.last_yield = time.monotonic()
+
+    async def finish(self, progress):
+        '''
+        Send the final progress unless it was the last sent
+        '''
+        if progress != self.sent:
+            await self.send(progress)
+            self.sent = progress
@@ -137,4 +137,57 @@ CHANNEL_LAYERS = {
     },
 }
 
-os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+# Threads running the database queries and computations of websocket
+# consumers, see flapjack_api.executor
+CONSUMER_WORKERS = 8
+
+# Seconds a websocket user is cached after authentication, 0 to disable
+WS_USER_CACHE_TTL = 60
+
+# Persistent cache of per-sample analysis results
+ANALYSIS_CACHE_ENABLED = True
+ANALYSIS_CACHE_MAX_SIZE = 512 * 1024 * 1024  # bytes
+
+# In-memory cache of serialized plot figures, per process
+PLOT_CACHE_ENABLED = True
+PLOT_CACHE_MAX_SIZE = 64 * 1024 * 1024  # bytes
+
+# Background analysis jobs submitted through the REST api, see analysis.worker
+ANALYSIS_JOB_WORKERS = 2
+ANALYSIS_JOB_IN_PROCESS = True  # False to run them with manage.py run_analysis_jobs
+ANALYSIS_JOB_HEARTBEAT = 30  # seconds between heartbeats of a running job
+ANALYSIS_JOB_STALE_AFTER = 600  # seconds without heartbeat before a job is run again
+ANALYSIS_JOB_MAX_ATTEMPTS = 2
+ANALYSIS_JOB_CHECK_INTERVAL = 2  # seconds between checks for cancellation of a running job
+
+# Timing of request stages, see flapjack_api.timing
+TIMING_ENABLED = True
+TIMING_SINKS = ['histogram']  # also 'log', or dotted path of a sink class
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'flapjack.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'flapjack.analysis': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'flapjack.jobs': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'flapjack.consumers': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
@@ -0,0 +1,148 @@
+import asyncio
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from . import channels_middleware, progress
+from .channels_middleware import TokenAuthMiddleware, UserCache, user_cache
+from .progress import ProgressReporter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class ProgressReporterTests(SimpleTestCase):
+    """
+    Progress updates are coalesced, but the first and final progress are
+    always sent
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(progress.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sent = []
+
+    async def send(self, value):
+        self.sent.append(value)
+
+    def run_updates(self, reporter, updates, final, dt=0.):
+        async def run():
+            for value in updates:
+                self.clock.now += dt
+                await reporter.update(value)
+            await reporter.finish(final)
+        asyncio.run(run())
+
+    def test_min_step(self):
+        reporter = ProgressReporter(self.send, min_step=5)
+        self.run_updates(reporter, range(20), 19)
+        self.assertEqual(self.sent, [0, 5, 10, 15, 19])
+        # Without time passing, small changes are never sent
+        self.sent = []
+        self.run_updates(ProgressReporter(self.send, min_step=5), [0, 1, 2, 3, 4, 3, 2, 6], 6)
+        self.assertEqual(self.sent, [0, 6])
+
+    def test_finish(self):
+        # The final progress is not repeated if it was the last sent
+        reporter = ProgressReporter(self.send, min_step=5)
+        self.run_updates(reporter, [0, 5, 10], 10)
+        self.assertEqual(self.sent, [0, 5, 10])
+        # And sent without any update before
+        self.sent = []
+        self.run_updates(ProgressReporter(self.send), [], 100)
+        self.assertEqual(self.sent, [100])
+
+    def test_interval(self):
+        reporter = ProgressReporter(self.send, min_step=10, interval=0.5)
+        # Small changes are sent once interval has passed, unchanged values never
+        self.run_updates(reporter, [0, 1, 2, 2, 2, 2, 3], 3, dt=0.3)
+        self.assertEqual(self.sent, [0, 2, 3])
+
+
+class UserCacheTests(TestCase):
+    """
+    Cached users expire after the ttl and are dropped when saved or deleted
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(channels_middleware.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(user_cache.clear)
+
+    def test_ttl(self):
+        cache = UserCache(ttl=10)
+        user = User(id=1, username='user')
+        cache.put(user)
+        self.clock.now = 9.9
+        self.assertIs(cache.get(1), user)
+        self.clock.now = 10.
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.entries, {})
+
+    @override_settings(WS_USER_CACHE_TTL=0)
+    def test_disabled(self):
+        cache = UserCache()
+        cache.put(User(id=1, username='user'))
+        self.assertIsNone(cache.get(1))
+
+    def test_invalidation(self):
+        user = User.objects.create(username='user')
+        other = User.objects.create(username='other')
+        user_cache.put(user)
+        user_cache.put(other)
+        user.first_name = 'renamed'
+        user.save()
+        self.assertIsNone(user_cache.get(user.id))
+        self.assertIs(user_cache.get(other.id), other)
+        other_id = other.id
+        other.delete()
+        self.assertIsNone(user_cache.get(other_id))
+
+
+class TokenAuthTests(TestCase):
+    """
+    Connections without a valid token of an existing user are closed before
+    reaching the consumer
+    """
+
+    def setUp(self):
+        self.addCleanup(user_cache.clear)
+        self.scopes = []
+
+    def inner(self, scope):
+        self.scopes.append(scope)
+        async def app(receive, send):
+            await send({'type': 'websocket.accept'})
+        return app
+
+    def connect(self, query_string):
+        messages = []
+        async def send(message):
+            messages.append(message)
+        instance = TokenAuthMiddleware(self.inner)({'type': 'websocket', 'query_string': query_string})
+        asyncio.run(instance(None, send))
+        return messages
+
+    def test_rejected(self):
+        missing_user = User(id=1000, username='missing')
+        for query_string in [b'', b'token=', b'token=invalid',
+                             f'token={AccessToken.for_user(missing_user)}'.encode()]:
+            self.assertEqual(self.connect(query_string), [{'type': 'websocket.close'}])
+        self.assertEqual(self.scopes, [])
+
+    def test_accepted(self):
+        user = User(id=1, username='user')
+        # Cached, so the user is not queried from another thread
+        user_cache.put(user)
+        token = AccessToken.for_user(user)
+        self.assertEqual(self.connect(f'token={token}'.encode()), [{'type': 'websocket.accept'}])
+        self.assertIs(self.scopes[0]['user'], user)
@@ -0,0 +1,147 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('flapjack.timing')
+
+
+class LogSink:
+    """
+    Writes one log line per span to the flapjack.timing logger
+    """
+
+    def record(self, name, elapsed, tags):
+        if logger.isEnabledFor(logging.INFO):
+            extra = ''.join(f' {key}={value}' for key, value in tags.items())
+            logger.info('%s took %.6f s%s', name, elapsed, extra)
+
+
+class HistogramSink:
+    """
+    Keeps an in-memory histogram of the duration of each span name, with
+    logarithmically spaced buckets from 10 us to about 3 minutes
+    """
+
+    bounds = [1e-5 * 2**i for i in range(25)]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def record(self, name, elapsed, tags):
+        bucket = bisect.bisect_left(self.bounds, elapsed)
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = {
+                    'count': 0,
+                    'total': 0.,
+                    'max': 0.,
+                    'buckets': [0] * (len(self.bounds) + 1)
+                }
+            hist['count'] += 1
+            hist['total'] += elapsed
+            hist['max'] = max(hist['max'], elapsed)
+            hist['buckets'][bucket] += 1
+
+    def quantile(self, hist, q):
+        '''
+        Upper bound of the bucket containing the q quantile
+        '''
+        target = q * hist['count']
+        cumulative = 0
+        for i, n in enumerate(hist['buckets']):
+            cumulative += n
+            if cumulative >= target and n > 0:
+                return self.bounds[i] if i < len(self.bounds) else hist['max']
+        return hist['max']
+
+    def summary(self):
+        with self.lock:
+            histograms = {name: dict(hist, buckets=list(hist['buckets']))
+                          for name, hist in self.histograms.items()}
+        stats = {}
+        for name, hist in sorted(histograms.items()):
+            stats[name] = {
+                'count': hist['count'],
+                'total': hist['total'],
+                'mean': hist['total'] / hist['count'],
+                'max': hist['max'],
+                'p50': self.quantile(hist, 0.5),
+                'p90': self.quantile(hist, 0.9),
+                'p99': self.quantile(hist, 0.99),
+                'buckets': dict(
+                    (str(bound), n) for bound, n in
+                    zip(self.bounds + ['inf'], hist['buckets']) if n > 0
+                )
+            }
+        return stats
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+sink_classes = {
+    'log': LogSink,
+    'histogram': HistogramSink,
+}
+
+_sinks = None
+
+
+def get_sinks():
+    '''
+    Sinks named in settings.TIMING_SINKS, either 'log', 'histogram' or the
+    dotted path of a class with a record(name, elapsed, tags) method
+    '''
+    global _sinks
+    if _sinks is None:
+        sinks = []
+        if getattr(settings, 'TIMING_ENABLED', True):
+            for sink in getattr(settings, 'TIMING_SINKS', ['histogram']):
+                cls = sink_classes.get(sink) or import_string(sink)
+                sinks.append(cls())
+        _sinks = sinks
+    return _sinks
+
+
+@receiver(setting_changed)
+def reset_sinks(setting, **kwargs):
+    global _sinks
+    if setting in ('TIMING_ENABLED', 'TIMING_SINKS'):
+        _sinks = None
+
+
+def get_histogram():
+    for sink in get_sinks():
+        if isinstance(sink, HistogramSink):
+            return sink
+    return None
+
+
+@contextmanager
+def span(name, **tags):
+    '''
+    Time the enclosed block and record it in all sinks under name, e.g.
+
+        with span('query.measurements', samples=n):
+            ...
+    '''
+    sinks = get_sinks()
+    if not sinks:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for sink in sinks:
+            sink.record(name, elapsed, tags)
@@ -1,8 +1,11 @@
 from django.contrib import admin
 from django.urls import include, path
+from . import views
 
 urlpatterns = [
     path('', include('registry.urls')),
+    path('', include('analysis.urls')),
     path('api/auth/', include('accounts.urls'), name='accounts'),
     path('admin/', admin.site.urls),
+    path('api/timing/', views.timing_stats, name='timing'),
 ]
\ No newline at end of file
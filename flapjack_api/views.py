@@ -0,0 +1,15 @@
+from rest_framework import permissions, response, decorators, status
+from . import timing
+
+
+@decorators.api_view(["GET", "DELETE"])
+@decorators.permission_classes([permissions.IsAdminUser])
+def timing_stats(request):
+    histogram = timing.get_histogram()
+    if histogram is None:
+        return response.Response({'detail': 'Histogram timing sink is not enabled'},
+                                 status.HTTP_404_NOT_FOUND)
+    if request.method == 'DELETE':
+        histogram.reset()
+        return response.Response(status=status.HTTP_204_NO_CONTENT)
+    return response.Response(histogram.summary(), status.HTTP_200_OK)
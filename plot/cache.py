@@ -0,0 +1,80 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from analysis.cache import get_data_versions
+
+# In-memory cache of serialized plot figures
+# -----------------------------------------------------------------------------------
+# Request parameters that are lists of ids, whose order does not matter
+id_list_params = ['study', 'assay', 'vector', 'media', 'strain', 'sample', 'signal']
+
+def cache_enabled():
+    return getattr(settings, 'PLOT_CACHE_ENABLED', True)
+
+def canonical_request(params):
+    '''
+    Plot request parameters as a json string, equal for equivalent requests
+    '''
+    params = dict(params)
+    for key in id_list_params:
+        if isinstance(params.get(key), list):
+            params[key] = sorted(params[key], key=str)
+    return json.dumps(params, sort_keys=True, default=str)
+
+def figure_key(params, sample_ids):
+    '''
+    Key identifying the figure for a plot request, which changes whenever
+    the data of the samples plotted, or of their background controls, change.
+    Edits of the names and colours shown in the figure, e.g. of a vector or
+    signal, change the data versions of the samples using them
+    '''
+    versions = get_data_versions(sample_ids)
+    key = json.dumps([canonical_request(params), sorted(versions.items())])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+class FigureCache:
+    '''
+    Least recently used cache of serialized figures, limited to max_size
+    bytes in total
+    '''
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get_max_size(self):
+        if self.max_size is not None:
+            return self.max_size
+        return getattr(settings, 'PLOT_CACHE_MAX_SIZE', 64*1024*1024)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        max_size = self.get_max_size()
+        if size > max_size:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += size
+            while self.size > max_size:
+                _,evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+figure_cache = FigureCache()
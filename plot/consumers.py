@@ -1,19 +1,22 @@
 # Built in imports.
 import json
-import asyncio
+import logging
 # Third Party imports.
-from channels.exceptions import DenyConnection
 from channels.generic.websocket import AsyncWebsocketConsumer
 from . import plotting
+from .cache import cache_enabled, figure_cache, figure_key
 from analysis.analysis import Analysis 
 from analysis.util import *
 from registry.util import get_samples, get_measurements
 from registry.models import Signal, Chemical
-from plotly.subplots import make_subplots
+from flapjack_api.executor import run_sync
+from flapjack_api.jobs import JobManager
+from flapjack_api.progress import ProgressReporter
+from flapjack_api.timing import span
 import plotly
 import pandas as pd
-import time
-import math
+
+logger = logging.getLogger('flapjack.consumers')
 
 group_fields = {
     'Vector': 'Vector',
@@ -25,10 +28,86 @@ group_fields = {
     'Supplement': 'Supplement'
 }
 
+def figure_message(fig, encoding='json'):
+    '''
+        Serialized plot_data message with the figure fig
+    '''
+    if fig and encoding == 'typed':
+        fig_data = plotting.encode_figure(fig)
+    elif fig:
+        fig_data = fig.to_json()
+    else:
+        fig_data = ''
+    return json.dumps({
+        'type': 'plot_data',
+        'data': {
+            'figure': fig_data,
+            'encoding': encoding
+        }
+    }, cls=plotly.utils.PlotlyJSONEncoder)
+
+def start_message(rows, cols, n_subplots, layout, encoding='json'):
+    '''
+        Serialized plot_start message with the layout of a streamed figure
+    '''
+    return json.dumps({
+        'type': 'plot_start',
+        'data': {
+            'rows': rows,
+            'cols': cols,
+            'subplots': n_subplots,
+            'encoding': encoding,
+            'layout': layout
+        }
+    }, cls=plotly.utils.PlotlyJSONEncoder)
+
+def traces_message(fig, subplot_index, encoding='json'):
+    '''
+        Serialized plot_traces message with the traces of a streamed subplot
+    '''
+    traces = [dict(trace) for trace in fig.data]
+    if encoding == 'typed':
+        traces = [plotting.encode_trace(trace) for trace in traces]
+    return json.dumps({
+        'type': 'plot_traces',
+        'data': {
+            'subplot': subplot_index,
+            'traces': traces
+        }
+    }, cls=plotly.utils.PlotlyJSONEncoder)
+
+def axis_bins(bins):
+    '''
+        Bins of one axis, a number of bins or a list of bin edges
+    '''
+    if isinstance(bins, list):
+        return [float(edge) for edge in bins] or None
+    return int(bins) if bins else None
+
+def plot_bins(plot_options, plot_type):
+    '''
+        Bins of the x and y axes of heatmaps and kymographs, a cell per
+        unique value by default. Each axis is given by xbins and ybins, or
+        bins = {'x': ..., 'y': ...}. A bare number of bins applies to both
+        axes, while bare bin edges are of concentration, so only apply to
+        the x axis of kymographs (y is time)
+    '''
+    bins = plot_options.get('bins')
+    if isinstance(bins, dict):
+        xbins, ybins = bins.get('x'), bins.get('y')
+    elif isinstance(bins, list) and plot_type == 'kymograph':
+        xbins, ybins = bins, None
+    else:
+        xbins, ybins = bins, bins
+    xbins = plot_options.get('xbins', xbins)
+    ybins = plot_options.get('ybins', ybins)
+    return axis_bins(xbins), axis_bins(ybins)
+
 class PlotConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
-        print(self.user)
+        logger.info('Plot connection of user %s', self.user)
+        self.jobs = JobManager()
         await self.accept()
         await self.channel_layer.group_add(
             "asd",
@@ -46,9 +125,18 @@ class PlotConsumer(AsyncWebsocketConsumer):
                     ylabel='Measurement',
                     xcolumn='Time',
                     ycolumn='Measurement',
-                    plot_type='timeseries'):
+                    plot_type='timeseries',
+                    resolution=0.1,
+                    xbins=None,
+                    ybins=None,
+                    stream=False,
+                    encoding='json'):
         '''
             Generate plot data for frontend plotly plot generation
+
+            If stream is True the layout and then the traces of each subplot
+            are sent to the client as they are built, and dropped from the
+            returned figure
         '''
         n_measurements = len(df)
         if n_measurements == 0:
@@ -64,23 +152,37 @@ class PlotConsumer(AsyncWebsocketConsumer):
         n_subplots = len(grouped)
         ncolors = len(plotting.palette)
         progress = 0
+        reporter = ProgressReporter(self.send_progress)
 
         # Compute number of rows and columns
         n_sub_plots = len(grouped)
         rows,cols = plotting.optimal_grid(n_sub_plots)
         
-        # Construct subplots
-        start = time.time()
-        fig = make_subplots(
-                            rows=rows, cols=cols,
-                            subplot_titles=[name for name,g in grouped],
-                            shared_xaxes=True, shared_yaxes=False,
-                            vertical_spacing=0.1, horizontal_spacing=0.1
-                            ) 
-        end = time.time()
+        if plot_type=='kymograph' or plot_type=='induction':
+            xaxis_type, yaxis_type = 'log', None
+        elif plot_type=='heatmap':
+            xaxis_type, yaxis_type = 'log', 'log'
+        else:
+            xaxis_type, yaxis_type = None, None
+
+        # Construct subplots, with the complete layout
+        with span('plot.subplots', subplots=n_sub_plots):
+            fig = plotting.SubplotFigure(
+                                rows, cols,
+                                subplot_titles=[name for name,g in grouped],
+                                xlabel=xlabel, ylabel=ylabel,
+                                xaxis_type=xaxis_type, yaxis_type=yaxis_type,
+                                font_size=font_size
+                                )
+
+        if stream:
+            # Send the layout first so that the client can draw the grid
+            # while the subplots are built
+            await self.send(text_data=start_message(rows, cols, n_sub_plots,
+                                                    fig.layout, encoding))
+            fig.layout_sent = True
 
         # Add traces to subplots
-        print('make_subplots took %g'%(end-start), flush=True)
         for name1,g1 in grouped:
             for name2,g2 in g1.groupby(groupby2):
                 # Choose color and whether to show in legend
@@ -108,7 +210,7 @@ class PlotConsumer(AsyncWebsocketConsumer):
 
                 # Add traces to figure
                 if plot_type == 'timeseries':
-                    fig = plotting.make_timeseries_traces(
+                    fig = await run_sync(plotting.make_timeseries_traces,
                             fig,
                             g2,
                             color=color, 
@@ -118,10 +220,11 @@ class PlotConsumer(AsyncWebsocketConsumer):
                             show_legend_group=show_legend_group,
                             group_name=str(name2),
                             row=row, col=col,
-                            ycolumn=ycolumn
+                            ycolumn=ycolumn,
+                            resolution=resolution
                         )
                 elif plot_type == 'bar':
-                    fig = plotting.make_bar_traces(
+                    fig = await run_sync(plotting.make_bar_traces,
                             fig,
                             g2,
                             color=color, 
@@ -135,7 +238,7 @@ class PlotConsumer(AsyncWebsocketConsumer):
                             ycolumn=ycolumn
                         )
                 elif plot_type == 'induction':
-                    fig = plotting.make_induction_traces(
+                    fig = await run_sync(plotting.make_induction_traces,
                             fig,
                             g2,
                             color=color, 
@@ -148,7 +251,7 @@ class PlotConsumer(AsyncWebsocketConsumer):
                             ycolumn=ycolumn
                         )
                 elif plot_type == 'heatmap':
-                    fig = plotting.make_heatmap_traces(
+                    fig = await run_sync(plotting.make_heatmap_traces,
                             fig,
                             g2, 
                             mean=mean, 
@@ -157,10 +260,11 @@ class PlotConsumer(AsyncWebsocketConsumer):
                             show_legend_group=show_legend_group,
                             group_name=str(name2),
                             row=row, col=col,
-                            ycolumn=ycolumn
+                            ycolumn=ycolumn,
+                            xbins=xbins, ybins=ybins
                         )
                 elif plot_type == 'kymograph':
-                    fig = plotting.make_kymograph_traces(
+                    fig = await run_sync(plotting.make_kymograph_traces,
                             fig,
                             g2, 
                             mean=mean, 
@@ -169,64 +273,93 @@ class PlotConsumer(AsyncWebsocketConsumer):
                             show_legend_group=show_legend_group,
                             group_name=str(name2),
                             row=row, col=col,
-                            ycolumn=ycolumn
+                            ycolumn=ycolumn,
+                            xbins=xbins, ybins=ybins
                         )
                 else:
-                    print('Unsupported plot type, ', plot_type, flush=True)
-                
-                # Format axes
-                plotting.format_axes(fig, 
-                                        row, col, rows, 
-                                        xlabel=xlabel, 
-                                        ylabel=ylabel, 
-                                        font_size=font_size)
+                    logger.warning('Unsupported plot type %s', plot_type)
+
 
                 # Update progress bar
                 progress += len(g2)
-                await self.send(text_data=json.dumps({
-                    'type': 'progress_update',
-                    'data': {'progress': int(50 + 50 * progress / n_measurements)}
-                }))
-                await asyncio.sleep(0)
+                await reporter.update(int(50 + 50 * progress / n_measurements))
+            if stream:
+                # Send the traces of this subplot and drop them from the figure
+                await self.send_traces(fig, subplot_index, encoding)
+                fig.data = []
             # Next subplot
             subplot_index += 1
-        if plot_type=='kymograph' or plot_type=='induction':
-            xaxis_type, yaxis_type = 'log', None
-        elif plot_type=='heatmap':
-            xaxis_type, yaxis_type = 'log', 'log'
-        else:
-            xaxis_type, yaxis_type = None, None
-        plotting.layout_screen(fig, xaxis_type=xaxis_type, yaxis_type=yaxis_type, font_size=font_size)
+        await reporter.finish(int(50 + 50 * progress / n_measurements))
         return fig
 
+    async def send_progress(self, progress):
+        await self.send(text_data=json.dumps({
+            'type': 'progress_update',
+            'data': {'progress': progress}
+        }))
+
+    async def send_traces(self, fig, subplot_index, encoding='json'):
+        '''
+            Send the traces in fig, those of one subplot when streaming
+        '''
+        await self.send(text_data=await run_sync(traces_message, fig, subplot_index, encoding))
+
     async def run_analysis(self, df, analysis):
         if len(df)==0:
             return df
-        grouped = df.groupby('Sample')
+        # Analyze one plate at a time so that samples sharing a time grid
+        # can be fitted together
+        grouped = df.groupby(['Study', 'Assay'])
         result_dfs = []
-        n_samples = len(grouped)
+        n_assays = len(grouped)
         progress = 0
+        reporter = ProgressReporter(self.send_progress)
         for id,g in grouped:
-            result_df = analysis.analyze_data(g)
+            result_df = await run_sync(analysis.analyze_data, g)
             result_dfs.append(result_df)
             progress += 1
-            await self.send(text_data=json.dumps({
-                'type': 'progress_update',
-                'data': {'progress': int(50 * progress / n_samples)}
-            }))
-            await asyncio.sleep(0)
+            await reporter.update(int(50 * progress / n_assays))
         df = pd.concat(result_dfs)
         return df
 
-    async def generate_data(self, event):
+    async def generate_data(self, job, event):
         params = event['params']
         plot_options = params['plotOptions']
-        s = get_samples(params)
+        # Figure data as typed arrays if requested by the client
+        encoding = 'typed' if params.get('encoding') == 'typed' else 'json'
+        # Subplots sent as they are built if requested by the client
+        stream = bool(params.get('stream'))
+        analysis_params = params.get('analysis')
+        if analysis_params:
+            analysis_type = analysis_params.get('type')
+            if isinstance(analysis_type, (list, tuple)) or analysis_type not in plotting.plot_properties:
+                # Several types can be analyzed at once, but not plotted
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'data': {'message': f'Cannot plot analysis type {analysis_type}'}
+                }))
+                return
+        # The queryset is built and evaluated in the pool, not the event loop
+        s = await run_sync(get_samples, params)
         signals = params.get('signal')
-        n_samples = s.count()
+        n_samples = await run_sync(s.count)
+        if n_samples > 0 and cache_enabled() and not stream:
+            # Figures of repeated requests are sent back while the data is unchanged
+            key = await run_sync(figure_key, params, s.values_list('id', flat=True))
+            text_data = figure_cache.get(key)
+            if text_data is not None:
+                await self.send(text_data=text_data)
+                return
+        else:
+            key = None
         if n_samples > 0:
-            # Get measurements to plot/analyze
-            df = get_measurements(s, signals)
+            if analysis_params:
+                # Results known without analysis, and measurements to analyze
+                analysis = Analysis(analysis_params, signals, check=job.check)
+                cached, df = await run_sync(analysis.get_data, s)
+            else:
+                # Get measurements to plot
+                df = await run_sync(get_measurements, s, signals)
 
             # Default axis labels for raw measurements
             xlabel, ylabel = 'Time (h)', 'Measurement (AU)'
@@ -236,7 +369,6 @@ class PlotConsumer(AsyncWebsocketConsumer):
             plot_type = 'timeseries'
 
             # Run analysis if selected
-            analysis_params = params.get('analysis')
             if analysis_params:
                 # What analysis to run
                 analysis_type = analysis_params['type']
@@ -258,27 +390,25 @@ class PlotConsumer(AsyncWebsocketConsumer):
                     ycolumn = plotting.plot_properties[analysis_type]['data_column']
 
                 # Analyze the data
-                analysis = Analysis(analysis_params, signals)
                 df = await self.run_analysis(df, analysis)
+                df = pd.concat(cached + [df])
 
             # Normalize the data if required
             normalize = plot_options['normalize']
             if normalize and normalize!='None':
-                print('normalizing', flush=True)
-                print('normalize', normalize, flush=True)
-                df = normalize_data(df, normalize, ycolumn)
+                df = await run_sync(normalize_data, df, normalize, ycolumn)
 
             # Correct axis labels for heatmap and kymograph
             if plot_type == 'heatmap':
-                chem1 = Chemical.objects.get(id=analysis.chemical_id1)
-                chem2 = Chemical.objects.get(id=analysis.chemical_id2)
+                chem1 = await run_sync(Chemical.objects.get, id=analysis.chemical_id1)
+                chem2 = await run_sync(Chemical.objects.get, id=analysis.chemical_id2)
                 xlabel = 'Concentration ' + chem1.name + ' (M)'
                 ylabel = 'Concentration ' + chem2.name + ' (M)'
             elif plot_type == 'kymograph':
-                chem = Chemical.objects.get(id=analysis.chemical_id)
+                chem = await run_sync(Chemical.objects.get, id=analysis.chemical_id)
                 xlabel = 'Concentration ' + chem.name + ' (M)'
             elif plot_type == 'induction':
-                chem = Chemical.objects.get(id=analysis.chemical_id)
+                chem = await run_sync(Chemical.objects.get, id=analysis.chemical_id)
                 xlabel = 'Concentration ' + chem.name + ' (M)'
 
             # Plot figure
@@ -287,37 +417,64 @@ class PlotConsumer(AsyncWebsocketConsumer):
             normalize = plot_options['normalize']
             mean = 'Mean' in plot_options['plot']
             std = 'std' in plot_options['plot']
-            fig = await self.plot(df, 
-                                groupby1=subplots, 
-                                groupby2=markers,
-                                mean=mean, std=std,
-                                xlabel=xlabel, ylabel=ylabel,
-                                xcolumn=xcolumn, ycolumn=ycolumn,
-                                plot_type=plot_type,
-                                normalize=normalize
-                                )
-            if fig:
-                fig_json = fig.to_json()
-            else:
-                fig_json = ''
+            # Time grid spacing (h) of mean and std timeseries
+            resolution = float(plot_options.get('resolution') or 0.1)
+            if resolution <= 0:
+                resolution = 0.1
+            # Heatmap and kymograph bins for dense data
+            xbins, ybins = plot_bins(plot_options, plot_type)
+            with span('plot.figure', type=plot_type):
+                fig = await self.plot(df, 
+                                    groupby1=subplots, 
+                                    groupby2=markers,
+                                    mean=mean, std=std,
+                                    xlabel=xlabel, ylabel=ylabel,
+                                    xcolumn=xcolumn, ycolumn=ycolumn,
+                                    plot_type=plot_type,
+                                    normalize=normalize,
+                                    resolution=resolution,
+                                    xbins=xbins, ybins=ybins,
+                                    stream=stream,
+                                    encoding=encoding
+                                    )
         else:
-            print('No samples found for query params', flush=True)
-            fig_json = ''
-        # Send back traces to plot
-        await self.send(text_data=json.dumps({
-            'type': 'plot_data',
-            'data': {
-                'figure': fig_json
-            }
-        }))
+            logger.debug('No samples found for query params %s', params)
+            fig = None
+        if stream:
+            if fig is None:
+                # Nothing to plot, the client still gets a complete stream
+                await self.send(text_data=start_message(0, 0, 0, {}, encoding))
+            # Subplots were sent as they were built, end with the layout
+            # changes made by the traces, e.g. reversed kymograph axes
+            await self.send(text_data=json.dumps({
+                'type': 'plot_end',
+                'data': {'layout': fig.layout_patch if fig else {}}
+            }))
+            return
+        # Send back traces to plot, typed array figures are serialized in a
+        # single pass with the message
+        with span('plot.serialize', encoding=encoding):
+            text_data = await run_sync(figure_message, fig, encoding)
+        if key and fig:
+            figure_cache.put(key, text_data)
+        await self.send(text_data=text_data)
         
     async def receive(self, text_data):
-        print(f"Receive. text_data: {text_data}", flush=True)
         data = json.loads(text_data)
         if data['type'] == 'plot':
-            await self.generate_data({'params': data['parameters']})
+            logger.debug('Plot request of user %s: %s', self.user, data['parameters'])
+            # A new plot request supersedes the one being computed
+            job = self.jobs.submit(self.generate_data, {'params': data['parameters']})
+            await self.send(text_data=json.dumps({
+                'type': 'job_started',
+                'data': {'job_id': job.id}
+            }))
+        elif data['type'] == 'cancel':
+            self.jobs.cancel(data.get('job_id'))
 
     async def disconnect(self, message):
+        # Nobody will see the results of outstanding jobs
+        self.jobs.cancel_all()
         await self.channel_layer.group_discard(
             "asd",
             self.channel_name
@@ -4,9 +4,10 @@ from registry.util import *
 import plotly.graph_objects as go
 import plotly
 from matplotlib.colors import CSS4_COLORS
-import wellfare as wf
 import time
+import json
 import pandas as pd
+from analysis.encoding import encode_array
 
 # Properties to use for each analysis/plot type
 plot_properties = { 
@@ -98,6 +99,39 @@ special_case_grids = {
     5: (2,3)    
 }
 
+# Trace attributes sent as typed arrays by encode_figure
+typed_array_keys = ['x', 'y', 'z']
+
+def encode_trace(trace, dtype='f4'):
+    '''
+    Replace the numeric x, y and z data of the trace dict by typed arrays in
+    the form used by plotly.js:
+    {'dtype': 'f4', 'bdata': base64 encoded buffer, 'shape': 'rows,cols'}
+    '''
+    for key in typed_array_keys:
+        values = trace.get(key)
+        if values is None:
+            continue
+        arr = np.asarray(values)
+        if arr.dtype.kind not in 'biuf' or arr.ndim == 0:
+            continue
+        encoded = encode_array(arr.ravel(), dtype)
+        if arr.ndim > 1:
+            encoded['shape'] = ','.join(str(n) for n in arr.shape)
+        trace[key] = encoded
+    return trace
+
+def encode_figure(fig, dtype='f4'):
+    '''
+    Figure dict of fig with the trace data as typed arrays, see encode_trace.
+    The layout and non-numeric data (e.g. category names) are unchanged, the
+    dict is serialized once with the message using plotly's json encoder.
+    '''
+    figure = fig.to_plotly_json()
+    for trace in figure['data']:
+        encode_trace(trace, dtype)
+    return figure
+
 def optimal_grid(n):
     '''
     Compute optimal grid of subplots for n plots
@@ -128,88 +162,209 @@ def optimal_grid(n):
         x, y = n_sqrt, n_sqrt
     return x,y
 
-def layout_screen(fig, xaxis_type=None, yaxis_type=None, font_size=10):
+def style_trace(trace):
+    '''
+    Set the marker size and line width of the trace dict for screen display
+    '''
+    if trace.get('type') == 'scatter':
+        trace['marker'] = dict(trace.get('marker', {}), size=6)
+        trace['line'] = dict(trace.get('line', {}), width=1)
+    if trace.get('fill') == 'toself':
+        trace['line'] = dict(trace.get('line', {}), width=0)
+    return trace
+
+_template = None
+
+def get_template():
+    '''
+    Json of the default plotly template, used for the SubplotFigure layout
+    '''
+    global _template
+    if _template is None:
+        _template = go.Layout(template='plotly').to_plotly_json()['template']
+    return _template
+
+class SubplotFigure:
+    '''
+    Figure with a grid of subplots built directly as plotly json. The layout
+    is that of make_subplots(shared_xaxes=True) with axes formatted for
+    screen display, computed once per subplot instead of by repeated
+    validated updates of a plotly Figure. The make_*_traces
+    functions add traces with add_trace as to a plotly Figure.
     '''
-    Layout figure optimized for screen display
+    def __init__(self, rows, cols, subplot_titles,
+                    xlabel='Time', ylabel='Measurement',
+                    xaxis_type=None, yaxis_type=None,
+                    font_size=10,
+                    horizontal_spacing=0.1, vertical_spacing=0.1):
+        self.rows = rows
+        self.cols = cols
+        self.data = []
+        # Changes to the layout after it was sent to a streaming client
+        self.layout_patch = {}
+        self.layout_sent = False
+
+        # Grid cells, row 1 at the top, with the arithmetic of make_subplots
+        widths = [(1.0 - horizontal_spacing * (cols - 1)) / cols] * cols
+        heights = [(1.0 - vertical_spacing * (rows - 1)) / rows] * rows
+        font = dict(size=font_size)
+        axis_style = dict(hoverformat='.2e', linewidth=1, tickwidth=1, tickfont=font)
+        n_subplots = len(subplot_titles)
+        layout = dict(
+            annotations=[],
+            autosize=True,
+            font=font,
+            margin=dict(b=50, l=50, pad=0, r=50, t=50),
+            paper_bgcolor='rgb(255,255,255)',
+            template=get_template()
+        )
+        for r in range(rows):
+            rr = rows - 1 - r
+            y_s = sum(heights[:rr]) + rr * vertical_spacing
+            y_domain = [y_s, y_s + heights[-1 - r]]
+            for c in range(cols):
+                x_s = sum(widths[:c]) + c * horizontal_spacing
+                x_domain = [x_s, x_s + widths[c]]
+                index = r * cols + c
+                n = self.axis_number(r + 1, c + 1)
+                xaxis = dict(axis_style,
+                                anchor='y%s'%n,
+                                domain=[max(0.0, x_domain[0]), min(1.0, x_domain[1])],
+                                title=dict(font=font))
+                yaxis = dict(axis_style,
+                                anchor='x%s'%n,
+                                domain=[max(0.0, y_domain[0]), min(1.0, y_domain[1])],
+                                title=dict(font=font))
+                # x axes are shared by the columns, with ticks in the bottom row
+                if r < rows - 1:
+                    xaxis['matches'] = 'x%s'%self.axis_number(rows, c + 1)
+                    xaxis['showticklabels'] = False
+                if index < n_subplots:
+                    if r == rows - 1 and xlabel is not None:
+                        xaxis['title']['text'] = xlabel
+                    if c == 0 and ylabel is not None:
+                        yaxis['title']['text'] = ylabel
+                    title = subplot_titles[index]
+                    if title:
+                        layout['annotations'].append(dict(
+                            font=font,
+                            showarrow=False,
+                            text=str(title),
+                            x=sum(x_domain) / 2.0,
+                            xanchor='center',
+                            xref='paper',
+                            y=y_domain[1],
+                            yanchor='bottom',
+                            yref='paper'
+                        ))
+                for axis,axis_type in [(xaxis, xaxis_type), (yaxis, yaxis_type)]:
+                    if axis_type:
+                        axis['type'] = axis_type
+                        if axis_type == 'log':
+                            axis['dtick'] = 1
+                layout['xaxis%s'%n] = xaxis
+                layout['yaxis%s'%n] = yaxis
+        self.layout = layout
+
+    def axis_number(self, row, col):
+        '''
+        Number of the axes of the subplot at row, col as used in axis names,
+        '' for the first subplot
+        '''
+        n = (row - 1) * self.cols + col
+        return '' if n == 1 else n
+
+    def add_trace(self, trace, row=1, col=1):
+        if not isinstance(trace, dict):
+            trace = trace.to_plotly_json()
+        n = self.axis_number(row, col)
+        trace['xaxis'] = 'x%s'%n
+        trace['yaxis'] = 'y%s'%n
+        self.data.append(style_trace(trace))
+        return self
+
+    def update_axes(self, axis_letter, props):
+        for key,axis in self.layout.items():
+            if key.startswith(axis_letter + 'axis'):
+                axis.update(props)
+                if self.layout_sent:
+                    for name,value in props.items():
+                        self.layout_patch[key + '.' + name] = value
+        return self
+
+    def update_xaxes(self, **props):
+        return self.update_axes('x', props)
 
-    fig = figure to layout
-    font_size = font size in pts
+    def update_yaxes(self, **props):
+        return self.update_axes('y', props)
+
+    def to_plotly_json(self):
+        return {
+            'data': [dict(trace) for trace in self.data],
+            'layout': self.layout
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_plotly_json(), cls=plotly.utils.PlotlyJSONEncoder)
+
+def grid_index(values, bins=None, log=False):
+    '''
+    Index of the grid cell of each value along one axis of a heatmap
+
+    bins = None for a cell per unique value, the number of equally spaced
+           bins (logarithmically if log is True and all values are positive)
+           or an array of bin edges
 
     Returns:
-    fig = figure with correct layout
+    index = cell index of each value, -1 if outside the bins or not finite
+    axis = cell centers (unique values) or bin edges, as taken by plotly
     '''
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+    index = np.full(len(values), -1)
+    if bins is None:
+        axis, inverse = np.unique(values[finite], return_inverse=True)
+        index[finite] = inverse
+        return index, axis
+    if np.isscalar(bins):
+        if not finite.any():
+            return index, np.array([])
+        vmin, vmax = values[finite].min(), values[finite].max()
+        if log and vmin > 0:
+            edges = np.geomspace(vmin, vmax, int(bins) + 1)
+        else:
+            edges = np.linspace(vmin, vmax, int(bins) + 1)
+    else:
+        edges = np.sort(np.asarray(bins, dtype=float))
+    if len(edges) < 2:
+        return index, edges
+    # Bins include their lower edge, the last one also its upper edge
+    idx = np.searchsorted(edges, values[finite], side='right') - 1
+    idx[values[finite]==edges[-1]] = len(edges) - 2
+    idx[(idx < 0) | (idx > len(edges) - 2)] = -1
+    index[finite] = idx
+    return index, edges
 
-    fig.update_layout(  autosize=True,
-                        margin=go.layout.Margin(
-                            l=50,
-                            r=50,
-                            b=50,
-                            t=50,
-                            pad=0
-                        ),
-                        paper_bgcolor="rgb(255,255,255)",
-                        template='plotly',
-                        font_size=font_size,
-                    )
-    for a in fig['layout']['annotations']:
-        a['font'] = dict(size=font_size)
-    fig.update_traces(marker=dict(size=6), line=dict(width=1), selector=dict(type='scatter'))
-    fig.update_traces(marker=dict(size=6), line=dict(width=1), selector=dict(type='line'))
-    fig.update_traces(line=dict(width=0), selector=dict(fill="toself"))
-    fig.update_yaxes(linewidth=1, 
-                    tickwidth=1, 
-                    title_font=dict(size=font_size), 
-                    tickfont=dict(size=font_size),
-                    hoverformat=".2e",
-                    #showgrid=False
-                    )
-    if yaxis_type:
-        fig.update_yaxes(type=yaxis_type)
-        if yaxis_type == 'log':
-            fig.update_yaxes(dtick=1)
-    fig.update_xaxes(linewidth=1, 
-                    tickwidth=1, 
-                    title_font=dict(size=font_size), 
-                    tickfont=dict(size=font_size),
-                    hoverformat=".2e",
-                    #showgrid=False
-                    )
-    if xaxis_type:
-        fig.update_xaxes(type=xaxis_type)
-        if xaxis_type == 'log':
-            fig.update_xaxes(dtick=1)
-    return fig
+def grid_mean(x, y, values, xbins=None, ybins=None, xlog=False, ylog=False):
+    '''
+    Mean of values in each cell of the grid of x and y, see grid_index
 
-def format_axes(
-    fig, 
-    row, 
-    col, 
-    rows, 
-    xlabel='Time', ylabel='Measurement', 
-    font_size=10):
-    # Format axes
-    if row==rows:
-        fig.update_xaxes(title_text=xlabel, 
-                        title_font=dict(size=font_size), 
-                        tickfont=dict(size=font_size),
-                        tickwidth=3,
-                        linewidth=3,
-                        row=row, col=col)
-    if col==1:
-        fig.update_yaxes(title_text=ylabel, 
-                        title_font=dict(size=font_size), 
-                        tickfont=dict(size=font_size), 
-                        #tickformat='.2g',
-                        tickwidth=3,
-                        linewidth=3,
-                        row=row, col=col)
-    elif col>1:
-        fig.update_yaxes(title_font=dict(size=font_size), 
-                        tickfont=dict(size=font_size), 
-                        tickwidth=3,
-                        #tickformat='.2g',
-                        linewidth=3,
-                        row=row, col=col)
+    Returns:
+    xaxis, yaxis = cell centers or bin edges of each axis
+    z = array of shape (len(y cells), len(x cells)), NaN in empty cells
+    '''
+    xi, xaxis = grid_index(x, xbins, xlog)
+    yi, yaxis = grid_index(y, ybins, ylog)
+    nx = len(xaxis) if xbins is None else max(len(xaxis) - 1, 0)
+    ny = len(yaxis) if ybins is None else max(len(yaxis) - 1, 0)
+    values = np.asarray(values, dtype=float)
+    valid = (xi >= 0) & (yi >= 0) & np.isfinite(values)
+    cell = yi[valid] * nx + xi[valid]
+    sums = np.bincount(cell, weights=values[valid], minlength=nx * ny)
+    counts = np.bincount(cell, minlength=nx * ny)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.where(counts > 0, sums / counts, np.nan)
+    return xaxis, yaxis, z.reshape(ny, nx)
 
 def make_heatmap_traces(
         fig,
@@ -221,18 +376,20 @@ def make_heatmap_traces(
         group_name='',
         row=1, col=1,
         ycolumn='Rate',
+        xbins=None,
+        ybins=None
     ):
     if len(df)>0:
-        unique_concs1 = np.sort(df['Concentration A'].unique())
-        unique_concs2 = np.sort(df['Concentration B'].unique())
-        c1,bins1 = pd.cut(df['Concentration A'], bins=unique_concs1, retbins=True)
-        c2,bins2 = pd.cut(df['Concentration B'], bins=unique_concs2, retbins=True)       
-        hm = df.groupby([c1, c2])[ycolumn].mean().unstack()
+        xaxis, yaxis, hm = grid_mean(df['Concentration B'].values,
+                                    df['Concentration A'].values,
+                                    df[ycolumn].values,
+                                    xbins=xbins, ybins=ybins,
+                                    xlog=True, ylog=True)
         # Always normalize the heatmap since there is only 1 colorbar
-        hm = np.array(hm)
-        hm /= hm.max()
+        if np.isfinite(hm).any():
+            hm /= np.nanmax(hm)
 
-        heatmap = go.Heatmap(x=bins2, y=bins1, z=hm, 
+        heatmap = go.Heatmap(x=xaxis, y=yaxis, z=hm, 
                             showscale=show_legend_group,
                             colorscale='Viridis',
                             zmin=0., zmax=1.)
@@ -251,26 +408,20 @@ def make_kymograph_traces(
         group_name='',
         row=1, col=1,
         ycolumn='Rate',
+        xbins=None,
+        ybins=None
     ):
-    unique_times = np.sort(df['Time'].unique()) #np.unique(x[idx])
-    n_times = len(unique_times)-2
-    unique_concs = np.sort(df['Concentration'].unique()) #np.unique(y[idx])
-    n_concs = len(unique_concs)-2
-    
     if len(df)>0:
-        c1,bins1 = pd.cut(df.Time, bins=unique_times, retbins=True)
-        c2,bins2 = pd.cut(df.Concentration, bins=unique_concs, retbins=True)       
-        hm = df.groupby([c1, c2])[ycolumn].mean().unstack()
-        #print('c1, c2 ', c1, c2, flush=True)
-        print('bin sizes ', len(bins1), len(bins2), flush=True)
-        #print('bins ', bins1, bins2, flush=True)
-        print('size kymo ', hm.shape, flush=True)
-
+        xaxis, yaxis, hm = grid_mean(df['Concentration'].values,
+                                    df['Time'].values,
+                                    df[ycolumn].values,
+                                    xbins=xbins, ybins=ybins,
+                                    xlog=True)
         # Always normalize the heatmap since there is only 1 colorbar
-        hm = np.array(hm)
-        hm /= hm.max()
+        if np.isfinite(hm).any():
+            hm /= np.nanmax(hm)
 
-        heatmap = go.Heatmap(x=bins2, y=bins1, z=hm, 
+        heatmap = go.Heatmap(x=xaxis, y=yaxis, z=hm, 
                             showscale=show_legend_group,
                             colorscale='Viridis',
                             zmin=0., zmax=1.)
@@ -358,6 +509,46 @@ def make_bar_traces(
     fig.add_trace(bar, row=row, col=col)
     return fig
 
+def resample(df, ycolumn, grid):
+    '''
+    Linear interpolation of the ycolumn of each sample in df onto the times
+    in grid, all samples at once. Values outside the time range of a sample
+    are those at its first or last time, as with np.interp.
+
+    Returns:
+    vals = array of shape (number of samples, len(grid))
+    '''
+    grid = np.asarray(grid, dtype=float)
+    samples, codes = np.unique(df['Sample'].values, return_inverse=True)
+    t = df['Time'].values.astype(float)
+    y = df[ycolumn].values.astype(float)
+    order = np.lexsort((t, codes))
+    t, y, codes = t[order], y[order], codes[order]
+    n_samples = len(samples)
+    if n_samples==0 or len(grid)==0:
+        return np.empty((n_samples, len(grid)))
+    starts = np.searchsorted(codes, np.arange(n_samples))
+    ends = np.append(starts[1:], len(codes)) - 1
+
+    # Offset each sample's times so that a single sorted search finds the
+    # interval containing each grid point within each sample
+    tmin = min(t.min(), grid[0])
+    width = max(t.max(), grid[-1]) - tmin + 1
+    keys = codes * width + (t - tmin)
+    queries = np.arange(n_samples)[:,None] * width + (grid[None,:] - tmin)
+    idx = np.searchsorted(keys, queries, side='right')
+    left = np.clip(idx - 1, starts[:,None], ends[:,None])
+    right = np.clip(idx, starts[:,None], ends[:,None])
+
+    t0, t1 = t[left], t[right]
+    y0, y1 = y[left], y[right]
+    dt = t1 - t0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.where(dt>0, (grid[None,:] - t0) / dt, 0.)
+    vals = y0 + frac * (y1 - y0)
+    # Exact hits and clamped ends take the value at that time
+    return np.where(frac==0, y0, vals)
+
 def make_timeseries_traces(
         fig,
         df, 
@@ -368,10 +559,12 @@ def make_timeseries_traces(
         show_legend_group=False,
         group_name='',
         row=1, col=1,
-        ycolumn='Measurement'
+        ycolumn='Measurement',
+        resolution=0.1
     ):
     '''
-    Generate trace data for each sample, or mean and std, for the data in df
+    Generate trace data for each sample, or mean and std, for the data in df.
+    The mean and std are computed on a grid of times spaced by resolution (h).
     '''
     if len(df)==0:
         return(fig)
@@ -381,16 +574,8 @@ def make_timeseries_traces(
     traces = []
 
     if mean:
-        grouped_samp = df.groupby('Sample')
-        st = np.arange(df['Time'].min(), df['Time'].max(), 0.1)
-        vals = []
-        for id,samp_data in grouped_samp:
-            samp_data = samp_data.sort_values('Time')
-            t = samp_data['Time'].values
-            val = samp_data[ycolumn].values
-            sval = wf.curves.Curve(x=t, y=val)
-            vals.append(sval(st))
-        vals = np.array(vals)
+        st = np.arange(df['Time'].min(), df['Time'].max(), resolution)
+        vals = resample(df, ycolumn, st)
         meanval = np.nanmean(vals, axis=0)
         stdval = np.nanstd(vals, axis=0)
 
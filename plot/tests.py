@@ -1,3 +1,285 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+from unittest import mock
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from analysis.management.commands.benchmark_analysis import Command as BenchmarkCommand
+from analysis.synthetic import synthetic_plate
+from flapjack_api.jobs import Job
+from registry.models import Study, Assay, Vector, Sample
+from .cache import figure_key
+from . import plotting
+from .consumers import PlotConsumer, plot_bins
+from .plotting import resample, grid_mean, encode_trace, encode_figure
+
+
+class ResampleTests(SimpleTestCase):
+    """
+    resample must match np.interp applied to each sample in turn
+    """
+
+    def test_against_interp(self):
+        rng = np.random.default_rng(0)
+        frames = []
+        for samp in range(6):
+            # Unsorted, irregular times of different ranges
+            n = rng.integers(1, 12)
+            t = rng.choice(np.arange(samp, 20 + samp, 0.5), n, replace=False)
+            frames.append(pd.DataFrame({'Sample': samp, 'Time': t,
+                                        'Measurement': rng.normal(size=n)}))
+        df = pd.concat(frames).sample(frac=1, random_state=0)
+        grid = np.concatenate([[-5., 0.], np.linspace(0, 30, 61), [t[0]]])
+        grid.sort()
+
+        vals = resample(df, 'Measurement', grid)
+        self.assertEqual(vals.shape, (6, len(grid)))
+        for i, (samp, data) in enumerate(df.groupby('Sample')):
+            data = data.sort_values('Time')
+            expected = np.interp(grid, data['Time'].values, data['Measurement'].values)
+            np.testing.assert_allclose(vals[i], expected, rtol=1e-12, atol=1e-12)
+
+    def test_empty(self):
+        df = pd.DataFrame({'Sample': [], 'Time': [], 'Measurement': []})
+        self.assertEqual(resample(df, 'Measurement', [0., 1.]).shape, (0, 2))
+
+
+class GridMeanTests(SimpleTestCase):
+    """
+    grid_mean must match the groupby mean of the values in each cell
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        n = 200
+        self.df = pd.DataFrame({
+            'x': rng.choice([0.1, 1., 10., 100.], n),
+            'y': rng.choice([0.5, 5., 50.], n),
+            'value': rng.normal(size=n)
+        })
+        self.df.loc[:5, 'value'] = np.nan
+
+    def test_unique_values(self):
+        df = self.df.iloc[:-20]
+        xaxis, yaxis, z = grid_mean(df['x'], df['y'], df['value'])
+        expected = df.groupby(['y', 'x'])['value'].mean().unstack()
+        expected = expected.reindex(index=yaxis, columns=xaxis)
+        np.testing.assert_allclose(z, expected.values, rtol=1e-12)
+
+    def test_bin_edges(self):
+        df = self.df.copy()
+        df['x'] *= np.random.default_rng(2).uniform(0.5, 1.5, len(df))
+        xbins = [0.1, 1., 10., 50.]
+        ybins = [0.5, 5., 50.]
+        xaxis, yaxis, z = grid_mean(df['x'], df['y'], df['value'], xbins=xbins, ybins=ybins)
+        np.testing.assert_array_equal(xaxis, xbins)
+        np.testing.assert_array_equal(yaxis, ybins)
+
+        # Bins include their lower edge, the last one also its upper edge
+        def cut(values, edges):
+            cells = pd.cut(values, edges, right=False, labels=False)
+            return cells.where(values!=edges[-1], len(edges) - 2)
+        xcell, ycell = cut(df['x'], xbins), cut(df['y'], ybins)
+        expected = df.groupby([ycell, xcell])['value'].mean().unstack()
+        expected = expected.reindex(index=range(len(ybins) - 1), columns=range(len(xbins) - 1))
+        np.testing.assert_allclose(z, expected.values, rtol=1e-12)
+
+
+def decode_trace_array(encoded):
+    dtype = np.dtype(encoded['dtype']).newbyteorder('<')
+    arr = np.frombuffer(base64.b64decode(encoded['bdata']), dtype=dtype)
+    if 'shape' in encoded:
+        arr = arr.reshape([int(n) for n in encoded['shape'].split(',')])
+    return arr
+
+
+class EncodeTests(SimpleTestCase):
+    """
+    Typed arrays must decode to the float32 values of the original data
+    """
+
+    def test_trace(self):
+        x = [0., 1.5, np.nan, 1e6]
+        z = np.arange(12, dtype=float).reshape(3, 4)
+        z[1, 2] = np.nan
+        trace = encode_trace({'type': 'heatmap', 'x': x, 'y': [], 'z': z,
+                              'name': 'sample', 'text': ['a', 'b']})
+        for key, values in [('x', x), ('y', []), ('z', z)]:
+            self.assertEqual(trace[key]['dtype'], 'f4')
+            decoded = decode_trace_array(trace[key])
+            self.assertEqual(decoded.shape, np.shape(values))
+            np.testing.assert_allclose(decoded, np.asarray(values, dtype='f4'), equal_nan=True)
+        self.assertEqual(trace['z']['shape'], '3,4')
+        self.assertNotIn('shape', trace['x'])
+        self.assertEqual(trace['name'], 'sample')
+        self.assertEqual(trace['text'], ['a', 'b'])
+
+    def test_non_numeric(self):
+        trace = encode_trace({'x': ['a', 'b'], 'y': 1.})
+        self.assertEqual(trace, {'x': ['a', 'b'], 'y': 1.})
+
+    def test_figure(self):
+        fig = go.Figure()
+        fig.add_trace(go.Scatter(x=[0, 1, 2], y=[np.nan, 2., 3.], name='scatter'))
+        fig.add_trace(go.Bar(x=['a', 'b'], y=[1, 2]))
+        fig.update_layout(title='figure')
+        figure = encode_figure(fig)
+        expected = fig.to_plotly_json()
+        self.assertEqual(figure['layout'], expected['layout'])
+        self.assertEqual(figure['data'][0]['name'], 'scatter')
+        self.assertEqual(figure['data'][1]['x'], ['a', 'b'])
+        for trace, original in zip(figure['data'], expected['data']):
+            for key in ['x', 'y']:
+                if isinstance(trace[key], dict):
+                    np.testing.assert_allclose(decode_trace_array(trace[key]),
+                                               np.asarray(original[key], dtype='f4'),
+                                               equal_nan=True)
+        # Serializable as sent by the consumers
+        json.loads(json.dumps(figure))
+
+
+def plot_messages(params):
+    '''
+    Messages sent by the plot consumer in reply to a plot request
+    '''
+    consumer = PlotConsumer({'type': 'websocket', 'user': User(username='user')})
+    messages = []
+    async def send(text_data):
+        messages.append(json.loads(text_data))
+    consumer.send = send
+    event = {'params': dict({'plotOptions': {'normalize': 'None'}}, **params)}
+    asyncio.run(consumer.generate_data(Job(1), event))
+    return messages
+
+
+class StreamTests(TestCase):
+    """
+    Streamed plots always start with plot_start and end with plot_end
+    """
+
+    def test_no_samples(self):
+        messages = plot_messages({'assay': [0], 'stream': True})
+        self.assertEqual([msg['type'] for msg in messages], ['plot_start', 'plot_end'])
+        self.assertEqual(messages[0]['data']['subplots'], 0)
+        self.assertEqual(messages[0]['data']['layout'], {})
+        self.assertEqual(messages[1]['data']['layout'], {})
+
+
+class AnalysisTypeTests(TestCase):
+    """
+    Plots are of a single known analysis type
+    """
+
+    def test_invalid_types(self):
+        for analysis_type in [['Velocity', 'Mean Expression'], 'Unknown']:
+            messages = plot_messages({'assay': [0], 'analysis': {'type': analysis_type}})
+            self.assertEqual([msg['type'] for msg in messages], ['error'])
+            self.assertIn('Cannot plot', messages[0]['data']['message'])
+
+
+class BinsTests(SimpleTestCase):
+    """
+    Bare bin edges are of concentration, so only bin the time axis of
+    kymographs when given for that axis
+    """
+
+    def test_options(self):
+        edges = [0.1, 1, 10]
+        cases = [
+            ({}, 'kymograph', (None, None)),
+            ({'bins': 5}, 'kymograph', (5, 5)),
+            ({'bins': edges}, 'heatmap', ([0.1, 1., 10.], [0.1, 1., 10.])),
+            ({'bins': edges}, 'kymograph', ([0.1, 1., 10.], None)),
+            ({'bins': {'x': edges, 'y': 4}}, 'kymograph', ([0.1, 1., 10.], 4)),
+            ({'bins': edges, 'ybins': [0, 12, 24]}, 'kymograph', ([0.1, 1., 10.], [0., 12., 24.])),
+            ({'xbins': 3, 'bins': []}, 'heatmap', (3, None)),
+        ]
+        for options, plot_type, expected in cases:
+            self.assertEqual(plot_bins(options, plot_type), expected)
+
+
+@override_settings(ANALYSIS_CACHE_ENABLED=False, PLOT_CACHE_ENABLED=False)
+class BinnedPlotTests(TransactionTestCase):
+    """
+    The bins requested by the client reach the axes they were given for
+    """
+
+    def setUp(self):
+        # Committed, the consumer reads the data in other threads
+        user = User.objects.create(username='bins')
+        plate = synthetic_plate(n_wells=16, n_times=13, seed=3)
+        self.assay, self.signals, self.chemicals = BenchmarkCommand().load_plate(user, plate, 16)
+
+    def plot(self, analysis, **plot_options):
+        params = {
+            'assay': [self.assay.id],
+            'signal': [self.signals['GFP'].id],
+            'analysis': dict(analysis, function='Mean Expression',
+                             biomass_signal=self.signals['OD'].id),
+            'plotOptions': dict(plot_options, normalize='None', subplots='Signal',
+                                markers='Vector', plot='Mean')
+        }
+        with mock.patch.object(plotting, 'grid_mean', wraps=plotting.grid_mean) as grid_mean:
+            messages = plot_messages(params)
+        self.assertEqual(messages[-1]['type'], 'plot_data')
+        self.assertEqual(grid_mean.call_count, 1)
+        return grid_mean.call_args[1]
+
+    def test_kymograph(self):
+        analysis = {'type': 'Kymograph', 'analyte': self.chemicals['A'].id}
+        kwargs = self.plot(analysis, bins=[1e-6, 1e-3, 1.])
+        self.assertEqual(kwargs['xbins'], [1e-6, 1e-3, 1.])
+        self.assertIsNone(kwargs['ybins'])
+        kwargs = self.plot(analysis, bins={'x': 4, 'y': [0, 12, 24]})
+        self.assertEqual(kwargs['xbins'], 4)
+        self.assertEqual(kwargs['ybins'], [0., 12., 24.])
+
+    def test_heatmap(self):
+        analysis = {'type': 'Heatmap', 'analyte1': self.chemicals['A'].id,
+                    'analyte2': self.chemicals['B'].id}
+        kwargs = self.plot(analysis, bins=[1e-6, 1e-3, 1.])
+        self.assertEqual(kwargs['xbins'], [1e-6, 1e-3, 1.])
+        self.assertEqual(kwargs['ybins'], [1e-6, 1e-3, 1.])
+
+
+class FigureKeyTests(TestCase):
+    """
+    Figure keys must change when the metadata shown in the figure is edited
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner')
+        cls.study = Study.objects.create(name='study', description='', owner=cls.owner, public=False)
+        cls.assay = Assay.objects.create(study=cls.study, name='assay', machine='',
+                                         description='', temperature=30.)
+        cls.vector = Vector.objects.create(owner=cls.owner, name='vector')
+        cls.sample = Sample.objects.create(assay=cls.assay, vector=cls.vector, row=0, col=0)
+
+    def key(self):
+        params = {'study': [self.study.id], 'plotOptions': {'subplots': 'Vector'}}
+        return figure_key(params, [self.sample.id])
+
+    def test_api_edits(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        client.patch(f'/api/vector/{self.vector.id}/', {'name': 'renamed'})
+        self.assertNotEqual(self.key(), key)
+        key = self.key()
+        client.patch(f'/api/study/{self.study.id}/', {'name': 'renamed'})
+        self.assertNotEqual(self.key(), key)
+
+    def test_admin_edits(self):
+        key = self.key()
+        self.vector.name = 'renamed'
+        admin.site._registry[Vector].save_model(None, self.vector, None, True)
+        self.assertNotEqual(self.key(), key)
+        self.assertEqual(Vector.objects.get(id=self.vector.id).name, 'renamed')
 
-# Create your tests here.
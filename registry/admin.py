@@ -1,15 +1,62 @@
 from django.contrib import admin
 from registry.models import *
+from registry.util import measurement_added, measurements_changed, metadata_changed
+
+# Lookup from Sample to each kind of metadata joined to its measurements
+sample_lookups = {
+    Study: 'assay__study',
+    Assay: 'assay',
+    Strain: 'strain',
+    Media: 'media',
+    Vector: 'vector',
+    Chemical: 'supplements__chemical',
+    Supplement: 'supplements',
+    Signal: 'measurement__signal'
+}
+
+class MetadataAdmin(admin.ModelAdmin):
+    '''
+    Admin of metadata that updates the data version of the samples using it
+    when it is edited, as the api views do
+    '''
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change:
+            lookup = sample_lookups[type(obj)]
+            metadata_changed(Sample.objects.filter(**{lookup: obj}))
+
+class MeasurementAdmin(admin.ModelAdmin):
+    '''
+    Admin of measurements that updates the data version and summaries of
+    their samples when they are edited, as the api views do
+    '''
+    def save_model(self, request, obj, form, change):
+        old = Measurement.objects.filter(id=obj.id).values_list('sample_id', 'signal_id').first()
+        super().save_model(request, obj, form, change)
+        if old is None:
+            measurement_added(obj)
+        else:
+            measurements_changed([old[0], obj.sample_id], [old[1], obj.signal_id])
+
+    def delete_model(self, request, obj):
+        sample_id, signal_id = obj.sample_id, obj.signal_id
+        super().delete_model(request, obj)
+        measurements_changed([sample_id], [signal_id])
+
+    def delete_queryset(self, request, queryset):
+        sample_ids = set(queryset.values_list('sample_id', flat=True))
+        super().delete_queryset(request, queryset)
+        measurements_changed(sample_ids)
 
 # Models modifiable in the admin
-admin.site.register(Study)
-admin.site.register(Assay)
-admin.site.register(Strain)
-admin.site.register(Media)
+admin.site.register(Study, MetadataAdmin)
+admin.site.register(Assay, MetadataAdmin)
+admin.site.register(Strain, MetadataAdmin)
+admin.site.register(Media, MetadataAdmin)
 admin.site.register(Dna)
 admin.site.register(Sample)
-admin.site.register(Measurement)
-admin.site.register(Vector)
-admin.site.register(Chemical)
-admin.site.register(Supplement)
-admin.site.register(Signal)
+admin.site.register(Measurement, MeasurementAdmin)
+admin.site.register(Vector, MetadataAdmin)
+admin.site.register(Chemical, MetadataAdmin)
+admin.site.register(Supplement, MetadataAdmin)
+admin.site.register(Signal, MetadataAdmin)
@@ -2,7 +2,6 @@
 import json
 import asyncio
 import io
-import time
 from django.db.models import Q
 # Third Party imports.
 import openpyxl as opxl
@@ -14,6 +13,9 @@ from channels.generic.websocket import AsyncWebsocketConsumer
 from .upload import *
 from .models import *
 from .util import *
+from flapjack_api.executor import run_sync, sync_to_pool
+from flapjack_api.progress import ProgressReporter
+from flapjack_api.timing import span
 
 empty_dna_names = ['none', 'None', '']
 
@@ -31,24 +33,31 @@ class MeasurementsConsumer(AsyncWebsocketConsumer):
             params = data['parameters']
             signals = params.get('signal')
             analysis_params = params.get('analysis')
-            s = get_samples(params)
-            df = get_measurements(s, signals)
+            data = await run_sync(self.load_measurements, params, signals)
             await self.send(text_data=json.dumps({
                 'type': 'measurements',
-                'data': df.to_json()
+                'data': data
             }))
         elif data['type'] == 'upload':
             params = data['parameters']
             sample = params['sample']
             signal = params['signal']
             json_data = data['data']
-            df = pd.read_json(json_data)
-            upload_measurements(df, sample, signal)
+            await run_sync(self.save_measurements, json_data, sample, signal)
             await self.send(text_data=json.dumps({
                 'type': 'upload',
                 'data': 'success'
             }))
 
+    def load_measurements(self, params, signals):
+        s = get_samples(params)
+        df = get_measurements(s, signals)
+        return df.to_json()
+
+    def save_measurements(self, json_data, sample, signal):
+        df = pd.read_json(json_data)
+        upload_measurements(df, sample, signal)
+
     async def disconnect(self, message):
         await self.channel_layer.group_discard(
             "measurements",
@@ -73,7 +82,8 @@ class UploadConsumer(AsyncWebsocketConsumer):
         self.binary_file = b''
 
     async def connect(self):
-        self.user = User.objects.get(username=self.scope["user"])
+        # User authenticated by the token middleware
+        self.user = self.scope["user"]
         await self.accept()
         await self.channel_layer.group_add(
             "upload",
@@ -86,22 +96,45 @@ class UploadConsumer(AsyncWebsocketConsumer):
         self.machine = data['machine']
         
         # create assay object and store id as attribute
+        self.assay_id = await self.create_assay(data)
+
+        # Send message for receiving file
+        await self.send(text_data=json.dumps({
+                'type': 'ready_for_file',
+                'data': {'assay_id': self.assay_id}
+            }))
+
+
+    @sync_to_pool
+    def create_assay(self, data):
         assay = Assay(study=Study.objects.get(id=data['study']), 
                     name=data['name'], 
                     machine=self.machine, 
                     description=data['description'], 
                     temperature=float(data['temperature']))
         assay.save()
-        self.assay_id = assay.id
+        return assay.id
 
-        # Send message for receiving file
+    async def read_binary(self, bin_data):
+        # Parsing large workbooks takes seconds, so it is done off the event loop
+        chem_names_file = await run_sync(self.load_file, bin_data)
+
+        ## SEND CORRECT DATA DEPENDING ON THE FILE
+        # Ask for dna, chemicals and signals
         await self.send(text_data=json.dumps({
-                'type': 'ready_for_file',
-                'data': {'assay_id': self.assay_id}
+                'type': 'input_requests',
+                'data': {
+                    'dna': self.dna_names,
+                    'chemical': chem_names_file,
+                    'signal': self.signal_names
+                }
             }))
 
-
-    async def read_binary(self, bin_data):
+    def load_file(self, bin_data):
+        '''
+        Load the uploaded file and its metadata, returns the chemical names
+        to ask the user for
+        '''
         ## IF MACHINE SYNERGY
         if 'synergy' in self.machine.lower():
             # load workbook, sheet containing data and extract metadata information
@@ -155,17 +188,7 @@ class UploadConsumer(AsyncWebsocketConsumer):
                     )
                 )
             chem_names_file = [val for val in self.meta_dict.index if "chem" in val]
-
-        ## SEND CORRECT DATA DEPENDING ON THE FILE
-        # Ask for dna, chemicals and signals
-        await self.send(text_data=json.dumps({
-                'type': 'input_requests',
-                'data': {
-                    'dna': self.dna_names,
-                    'chemical': chem_names_file,
-                    'signal': self.signal_names
-                }
-            }))
+        return chem_names_file
 
 
     async def parse_metadata(self, metadata):
@@ -174,48 +197,42 @@ class UploadConsumer(AsyncWebsocketConsumer):
         if 'synergy' in self.machine.lower():
             # get dnas and inducers
             # construct signal_map ({signal_name: signal from machine})
-            signal_map = {self.signal_names[i]:Signal.objects.get(id=s_id).name 
-                            for i, s_id in enumerate(metadata['signal'])}
+            signal_map = await run_sync(self.get_signal_map, metadata)
             dna_map = {self.dna_names[idx]: dna_id 
                             for idx, dna_id in enumerate(metadata['dna'])}
 
             # load data from "Data" sheet as a DataFrame
             signal_names_aux = self.signal_names.copy()
             signal_names_aux.append('Results')
-            dfs = synergy_load_data(self.ws, signal_names_aux, signal_map)
+            dfs = await run_sync(synergy_load_data, self.ws, signal_names_aux, signal_map)
             
             signal_ids = {signal_map[name]: metadata['signal'][idx] 
                             for idx, name in enumerate(self.signal_names)}
             # upload data
-            start = time.time()
-            await self.upload_data(self.assay_id, self.meta_dict, dfs, metadata, signal_ids, dna_map)
-            end = time.time()
-            print(f"UPLOAD SYNERGY FINISHED. Took {end-start} secs")
+            with span('upload.synergy'):
+                await self.upload_data(self.assay_id, self.meta_dict, dfs, metadata, signal_ids, dna_map)
         
         ## IF MACHINE BMG
         elif 'bmg' in self.machine.lower():
             # get dnas and inducers
             # construct signal_map ({signal_name: signal from machine})
-            signal_map = {self.signal_names[i]:Signal.objects.get(id=s_id).name 
-                            for i, s_id in enumerate(metadata['signal'])}
+            signal_map = await run_sync(self.get_signal_map, metadata)
             dna_map = {self.dna_names[idx]: dna_id 
                             for idx, dna_id in enumerate(metadata['dna'])}
             # load data from "Data" sheet as a DataFrame
             signal_names_aux = self.signal_names.copy()
             
-            dfs = bmg_load_data(self.wb, signal_map, self.columns)
+            dfs = await run_sync(bmg_load_data, self.wb, signal_map, self.columns)
 
             signal_ids = {signal_map[name]: metadata['signal'][idx] 
                             for idx, name in enumerate(self.signal_names)}
             # upload data
-            start = time.time()
-            await self.upload_data(self.assay_id, self.meta_dict, dfs, metadata, signal_ids, dna_map)
-            end = time.time()
-            print(f"UPLOAD BMG FINISHED. Took {end-start} secs")
+            with span('upload.bmg'):
+                await self.upload_data(self.assay_id, self.meta_dict, dfs, metadata, signal_ids, dna_map)
             
         ## IF MACHINE FLUOPI
         elif 'fluopi' in self.machine.lower():
-            data = json.loads(self.binary_file.decode())
+            data = await run_sync(json.loads, self.binary_file.decode())
 
             # time domain for the experiment
             time_serie = data['Times']
@@ -240,34 +257,36 @@ class UploadConsumer(AsyncWebsocketConsumer):
             dna_map = {self.dna_names[idx]: dna_id for idx, dna_id in enumerate(metadata['dna'])}
             signal_map = {self.signal_names[idx]: signal_id for idx, signal_id in enumerate(metadata['signal'])}
 
-            start = time.time()
-            await self.fluopi_upload(self.assay_id, 
-                        time_serie, 
-                        sel_cols,
-                        rad,
-                        pos,
-                        fluo,
-                        self.dna_names,
-                        media[0],
-                        strain[0],
-                        col_dnas,
-                        dna_map,
-                        signal_map)       
-            
-            end = time.time()
-            print(f"UPLOAD FLUOPI FINISHED. Took {end-start} secs")
+            with span('upload.fluopi'):
+                await self.fluopi_upload(self.assay_id, 
+                            time_serie, 
+                            sel_cols,
+                            rad,
+                            pos,
+                            fluo,
+                            self.dna_names,
+                            media[0],
+                            strain[0],
+                            col_dnas,
+                            dna_map,
+                            signal_map)
         
         await self.send(text_data=json.dumps({
                 'type': 'creation_done'
             }))
 
+    def get_signal_map(self, metadata):
+        '''
+        Map of the signal names in the file to the names of the signals chosen
+        '''
+        return {self.signal_names[i]:Signal.objects.get(id=s_id).name 
+                    for i, s_id in enumerate(metadata['signal'])}
+
     async def progress_update(self, progress):
-        print(f"progress: {progress}", flush=True)
         await self.send(text_data=json.dumps({
                 'type': 'progress',
                 'data': progress
             }))
-        await asyncio.sleep(0)
 
     async def receive(self, text_data=None, bytes_data=None):
         if text_data:
@@ -296,153 +315,167 @@ class UploadConsumer(AsyncWebsocketConsumer):
         columns = list(meta_dict.columns)
         meta_dnas = [k for k in list(meta_dict.index) if 'DNA' in k]
         meta_inds = [k for k in list(meta_dict.index) if 'chem' in k]
+        progress = ProgressReporter(self.progress_update, min_step=0.01)
         for well_idx, well in enumerate(columns):
-            existing_med = [i.name for i in Media.objects.all()]
-            existing_str = [i.name for i in Strain.objects.all()]
-            existing_sup = [(s.chemical.id, s.concentration) for s in Supplement.objects.all()]
-            user_vectors = Vector.objects.filter(
-                Q(owner=self.user) |
-                Q(sample__assay__study__public=True) |
-                Q(sample__assay__study__shared_with=self.user) |
-                Q(sample__assay__study__owner=self.user)
-            ).distinct()
-
-            # Metadata value for each well (sample): strain and media
-            s_media = meta_dict.loc['Media'][well]
-            s_strain = meta_dict.loc['Strains'][well]
-
-            # skip well if media==None
-            if s_media.upper() != 'NONE':
-                # create Media object
-                if s_media not in existing_med:
-                    media = Media(owner=self.user, name=s_media, description='')
-                    media.save()
-                else:
-                    media = Media.objects.filter(name__exact=s_media)[0]
-                
-                # create Strain object
-                if s_strain.upper()=='NONE':
-                    strain = None
-                else:
-                    if s_strain not in existing_str:
-                        strain = Strain(owner=self.user, name=s_strain, description='')
-                        strain.save()
-                    else:
-                        strain = Strain.objects.filter(name__exact=s_strain)[0]
-
-
-                # Vector
-                # TO DO: this is assuming the user uses as Dna name the same name
-                # that is in the excel
-                
-                # dna in this well (meta_dict.loc[meta_dnas][well])
-                well_dnas = meta_dict.loc[meta_dnas][well]
-                well_dna_ids = [dna_map[d] for d in well_dnas if d.lower()!='none']
-                
-                if len(well_dna_ids) > 0:
-                    well_dna_ids.sort()
-                    vector_ids = [v.id for v in user_vectors]
-                    vectors_dna_ids = []
-                    for v in user_vectors:
-                        vector_dna_ids = [dna.id for dna in v.dnas.all()]
-                        vector_dna_ids.sort()
-                        vectors_dna_ids.append(vector_dna_ids)
-                    
-                    # if colony dnas already exist in a vector, we assign that object
-                    if well_dna_ids in vectors_dna_ids:
-                        idx = vectors_dna_ids.index(well_dna_ids)
-                        vector_id = vector_ids[idx]
-                        vector = Vector.objects.get(id=vector_id)
-                    else:
-                        vector = Vector.objects.create(owner=self.user)
-                        for dna_id in well_dna_ids:
-                            vector.dnas.add(Dna.objects.get(id=dna_id))
-                        # add names to vector
-                        vector.name = '+'.join([d.name for d in vector.dnas.all()])
-                        vector.save()
-                else:
-                    vector = None
-
-                # create chemicals and supplements
-                # checking either len(metadata['chemical']) or len(meta_inds) > 0
-                sample_supps = []
-                if len(meta_inds) > 0:
-                    concs = [float(meta_dict.loc[meta_ind][well]) for meta_ind in meta_inds]
-                    for i, chem_id in enumerate(metadata['chemical']):
-                        chemical = Chemical.objects.get(id=chem_id)
-                        if concs[i] > 0.:
-                            if (chemical.id, concs[i]) not in existing_sup:
-                                # make func
-                                conc_log = np.log10(concs[i])
-                                if conc_log >= 0:
-                                    units = 'M'
-                                    cons_str= str(concs[i])
-                                elif (conc_log < 0) and (conc_log) > -3:
-                                    if concs[i]*1e3 < 100:
-                                        cons_str= f"{concs[i]*1e3:.2f}"
-                                        units = 'mM'
-                                    else:
-                                        cons_str= f"{concs[i]:.2f}"
-                                        units = '\u03BCM'                      
-                                elif (conc_log <= -3) and (conc_log) > -6:
-                                    if concs[i]*1e6 < 100:
-                                        units = '\u03BCM'
-                                        cons_str= f"{concs[i]*1e6:.2f}"
-                                    else:
-                                        units = 'nM'
-                                        cons_str= f"{concs[i]*1e3:.2f}"
-                                elif (conc_log <= -6) and (conc_log) > -9:
-                                    if concs[i]*1e9 < 100:
-                                        units = 'nM'
-                                        cons_str= f"{concs[i]*1e9:.2f}"
-                                    else:
-                                        units = 'pM'
-                                        cons_str= f"{concs[i]*1e6:.2f}"
-                                elif (conc_log <= -9) and (conc_log) > -12:
-                                    units = 'pM'
-                                    cons_str= f"{concs[i]*1e12:.2f}"
-                                sup = Supplement(owner=self.user,
-                                                name=f"{chemical.name} = {cons_str} {units}", 
-                                                chemical=chemical, 
-                                                concentration=concs[i])
-                                sup.save()
-                            else:
-                                sup = Supplement.objects.get(chemical=chemical, concentration=concs[i])
-                            sample_supps.append(sup)
-                
-                # create Sample object
-                samp = Sample(assay=Assay.objects.get(id=assay_id), 
-                                media=media, 
-                                strain=strain, 
-                                vector=vector, 
-                                row=ord(well[0])-64, 
-                                col=well[1:])
-
-                samp.save()
-                # assign supplements to sample
-                for sup in sample_supps:
-                    samp.supplements.add(sup)
-
-                # Data value for each well
-                measurements = []
-                for key, dfm in dfs.items():
-                    # TO DO: decide whether to check for user's signals or public ones
-                    signal = Signal.objects.filter(id=signal_ids[key])[0]
-                    #signal = Signal.objects.filter(Q(measurement__sample__assay__study__owner=self.user) & 
-                    #                               Q(name='OD')).distinct()[0]
-                    for i, value in enumerate(dfm[well]):
-                        m_value = value
-                        m_time = dfm['Time'].iloc[i]
-                        m = Measurement(sample=samp, signal=signal, value=m_value, time=m_time)
-                        measurements.append(m)
-                Measurement.objects.bulk_create(measurements)
-
+            samp = await self.upload_well(well, assay_id, meta_dict, dfs, metadata, signal_ids, dna_map,
+                                            meta_dnas, meta_inds)
+            if samp is not None:
                 # status update
                 process_percent = (well_idx+1)/(len(columns))
-                await self.progress_update(process_percent)
-
+                await progress.update(process_percent)
             else:
                 print("I'm Media None")
+        await progress.finish(1.)
+
+    @sync_to_pool
+    def upload_well(self, well, assay_id, meta_dict, dfs, metadata, signal_ids, dna_map, meta_dnas, meta_inds):
+        '''
+        Create the sample and measurements of a well, returns the sample or
+        None if the well has no media
+        '''
+        existing_med = [i.name for i in Media.objects.all()]
+        existing_str = [i.name for i in Strain.objects.all()]
+        existing_sup = [(s.chemical.id, s.concentration) for s in Supplement.objects.all()]
+        user_vectors = Vector.objects.filter(
+            Q(owner=self.user) |
+            Q(sample__assay__study__public=True) |
+            Q(sample__assay__study__shared_with=self.user) |
+            Q(sample__assay__study__owner=self.user)
+        ).distinct()
+
+        # Metadata value for each well (sample): strain and media
+        s_media = meta_dict.loc['Media'][well]
+        s_strain = meta_dict.loc['Strains'][well]
+
+        # skip well if media==None
+        if s_media.upper() == 'NONE':
+            return None
+
+        # create Media object
+        if s_media not in existing_med:
+            media = Media(owner=self.user, name=s_media, description='')
+            media.save()
+        else:
+            media = Media.objects.filter(name__exact=s_media)[0]
+
+        # create Strain object
+        if s_strain.upper()=='NONE':
+            strain = None
+        else:
+            if s_strain not in existing_str:
+                strain = Strain(owner=self.user, name=s_strain, description='')
+                strain.save()
+            else:
+                strain = Strain.objects.filter(name__exact=s_strain)[0]
+
+
+        # Vector
+        # TO DO: this is assuming the user uses as Dna name the same name
+        # that is in the excel
+
+        # dna in this well (meta_dict.loc[meta_dnas][well])
+        well_dnas = meta_dict.loc[meta_dnas][well]
+        well_dna_ids = [dna_map[d] for d in well_dnas if d.lower()!='none']
+
+        if len(well_dna_ids) > 0:
+            well_dna_ids.sort()
+            vector_ids = [v.id for v in user_vectors]
+            vectors_dna_ids = []
+            for v in user_vectors:
+                vector_dna_ids = [dna.id for dna in v.dnas.all()]
+                vector_dna_ids.sort()
+                vectors_dna_ids.append(vector_dna_ids)
+
+            # if colony dnas already exist in a vector, we assign that object
+            if well_dna_ids in vectors_dna_ids:
+                idx = vectors_dna_ids.index(well_dna_ids)
+                vector_id = vector_ids[idx]
+                vector = Vector.objects.get(id=vector_id)
+            else:
+                vector = Vector.objects.create(owner=self.user)
+                for dna_id in well_dna_ids:
+                    vector.dnas.add(Dna.objects.get(id=dna_id))
+                # add names to vector
+                vector.name = '+'.join([d.name for d in vector.dnas.all()])
+                vector.save()
+        else:
+            vector = None
+
+        # create chemicals and supplements
+        # checking either len(metadata['chemical']) or len(meta_inds) > 0
+        sample_supps = []
+        if len(meta_inds) > 0:
+            concs = [float(meta_dict.loc[meta_ind][well]) for meta_ind in meta_inds]
+            for i, chem_id in enumerate(metadata['chemical']):
+                chemical = Chemical.objects.get(id=chem_id)
+                if concs[i] > 0.:
+                    if (chemical.id, concs[i]) not in existing_sup:
+                        # make func
+                        conc_log = np.log10(concs[i])
+                        if conc_log >= 0:
+                            units = 'M'
+                            cons_str= str(concs[i])
+                        elif (conc_log < 0) and (conc_log) > -3:
+                            if concs[i]*1e3 < 100:
+                                cons_str= f"{concs[i]*1e3:.2f}"
+                                units = 'mM'
+                            else:
+                                cons_str= f"{concs[i]:.2f}"
+                                units = '\u03BCM'                      
+                        elif (conc_log <= -3) and (conc_log) > -6:
+                            if concs[i]*1e6 < 100:
+                                units = '\u03BCM'
+                                cons_str= f"{concs[i]*1e6:.2f}"
+                            else:
+                                units = 'nM'
+                                cons_str= f"{concs[i]*1e3:.2f}"
+                        elif (conc_log <= -6) and (conc_log) > -9:
+                            if concs[i]*1e9 < 100:
+                                units = 'nM'
+                                cons_str= f"{concs[i]*1e9:.2f}"
+                            else:
+                                units = 'pM'
+                                cons_str= f"{concs[i]*1e6:.2f}"
+                        elif (conc_log <= -9) and (conc_log) > -12:
+                            units = 'pM'
+                            cons_str= f"{concs[i]*1e12:.2f}"
+                        sup = Supplement(owner=self.user,
+                                        name=f"{chemical.name} = {cons_str} {units}", 
+                                        chemical=chemical, 
+                                        concentration=concs[i])
+                        sup.save()
+                    else:
+                        sup = Supplement.objects.get(chemical=chemical, concentration=concs[i])
+                    sample_supps.append(sup)
+
+        # create Sample object
+        samp = Sample(assay=Assay.objects.get(id=assay_id), 
+                        media=media, 
+                        strain=strain, 
+                        vector=vector, 
+                        row=ord(well[0])-64, 
+                        col=well[1:])
+
+        samp.save()
+        # assign supplements to sample
+        for sup in sample_supps:
+            samp.supplements.add(sup)
+
+        # Data value for each well
+        measurements = []
+        for key, dfm in dfs.items():
+            # TO DO: decide whether to check for user's signals or public ones
+            signal = Signal.objects.filter(id=signal_ids[key])[0]
+            #signal = Signal.objects.filter(Q(measurement__sample__assay__study__owner=self.user) & 
+            #                               Q(name='OD')).distinct()[0]
+            for i, value in enumerate(dfm[well]):
+                m_value = value
+                m_time = dfm['Time'].iloc[i]
+                m = Measurement(sample=samp, signal=signal, value=m_value, time=m_time)
+                measurements.append(m)
+        Measurement.objects.bulk_create(measurements)
+        update_summaries([samp.id])
+        return samp
 
     async def fluopi_upload(self, 
                             assay_id, 
@@ -458,6 +491,23 @@ class UploadConsumer(AsyncWebsocketConsumer):
                             dna_map,
                             signal_map):
         
+        progress = ProgressReporter(self.progress_update, min_step=0.01)
+        media, strain = await self.fluopi_media_strain(media, strain)
+        measurements = []
+        for col_idx, col in enumerate(sel_cols):
+            measurements += await self.fluopi_colony(col, assay_id, time_serie, rad, pos, fluo,
+                                                     media, strain, col_dnas, dna_map, signal_map)
+            # status update
+            process_percent = (col_idx+1)/(len(sel_cols))
+            await progress.update(process_percent)
+        await progress.finish(1.)
+        await self.save_measurements(measurements)
+
+    @sync_to_pool
+    def fluopi_media_strain(self, media, strain):
+        '''
+        Get or create the media and strain objects of a fluopi assay
+        '''
         existing_med = [m.name for m in Media.objects.all()]
         existing_str = [s.name for s in Strain.objects.all()]
 
@@ -474,72 +524,78 @@ class UploadConsumer(AsyncWebsocketConsumer):
             strain.save()
         else:
             strain = Strain.objects.filter(name__exact=strain)[0]
-
+        return media, strain
+
+    @sync_to_pool
+    def fluopi_colony(self, col, assay_id, time_serie, rad, pos, fluo,
+                      media, strain, col_dnas, dna_map, signal_map):
+        '''
+        Create the vector and sample of a colony, returns its unsaved measurements
+        '''
         measurements = []
-        for col_idx, col in enumerate(sel_cols):
-            # Vector
-            # construct a list of lists, each containing the ids of the dnas
-            # in each vector, for the requesting user
-            user_vectors = Vector.objects.filter(
-                Q(owner=self.user) |
-                Q(sample__assay__study__public=True) |
-                Q(sample__assay__study__shared_with=self.user) |
-                Q(sample__assay__study__owner=self.user)
-            ).distinct()
-            vectors_dna_ids = []
-            vector_ids = [v.id for v in user_vectors]
-            for v in user_vectors:
-                vector_dna_ids = [dna.id for dna in v.dnas.all()]
-                vector_dna_ids.sort()
-                vectors_dna_ids.append(vector_dna_ids)
-
-            # dna in this colony (col_dnas[col])
-            col_dna_ids = [dna_map[d] for d in col_dnas[str(col)]]
-            col_dna_ids.sort()
-
-            # if colony dnas already exist in a vector, we assign that object
-            if col_dna_ids in vectors_dna_ids:
-                idx = vectors_dna_ids.index(col_dna_ids)
-                vector_id = vector_ids[idx]
-                vector = Vector.objects.get(id=vector_id)
-            else:
-                vector = Vector.objects.create(owner=self.user)
-                for dna_id in col_dna_ids:
-                    vector.dnas.add(Dna.objects.get(id=dna_id))
-                # add names to vector
-                vector.name = '+'.join([d.name for d in vector.dnas.all()])
-                vector.save()     
-
-            # Sample 
-            samp = Sample(assay=Assay.objects.get(id=assay_id), 
-                                    media=media, 
-                                    strain=strain, 
-                                    vector=vector, 
-                                    row=pos[str(col)][0], 
-                                    col=pos[str(col)][1])
-            samp.save()
-            
-            # area as OD
-            # TO DO: Area Signal is created if not exists. Think on a better way
-            try:
-                od_signal = Signal.objects.get(name='Area')
-            except:
-                od_signal = Signal(owner=self.user, name='Area', description='', color='')
-                od_signal.save()
-            
-            for idx, r in enumerate(rad[str(col)]):
-                mar = Measurement(sample=samp, signal=od_signal, value=(r**2)*np.pi, time=time_serie[idx])
-                measurements.append(mar)
-            
-            # Fluo
-            for f_name in fluo.keys():
-                f_signal = Signal.objects.get(id=signal_map[f_name])
-                for idx, val in enumerate(fluo[f_name][str(col)]):
-                    m = Measurement(sample=samp, signal=f_signal, value=val, time=time_serie[idx])
-                    measurements.append(m)
-
-            # status update
-            process_percent = (col_idx+1)/(len(sel_cols))
-            await self.progress_update(process_percent)
-
-        Measurement.objects.bulk_create(measurements)
\ No newline at end of file
+        # Vector
+        # construct a list of lists, each containing the ids of the dnas
+        # in each vector, for the requesting user
+        user_vectors = Vector.objects.filter(
+            Q(owner=self.user) |
+            Q(sample__assay__study__public=True) |
+            Q(sample__assay__study__shared_with=self.user) |
+            Q(sample__assay__study__owner=self.user)
+        ).distinct()
+        vectors_dna_ids = []
+        vector_ids = [v.id for v in user_vectors]
+        for v in user_vectors:
+            vector_dna_ids = [dna.id for dna in v.dnas.all()]
+            vector_dna_ids.sort()
+            vectors_dna_ids.append(vector_dna_ids)
+
+        # dna in this colony (col_dnas[col])
+        col_dna_ids = [dna_map[d] for d in col_dnas[str(col)]]
+        col_dna_ids.sort()
+
+        # if colony dnas already exist in a vector, we assign that object
+        if col_dna_ids in vectors_dna_ids:
+            idx = vectors_dna_ids.index(col_dna_ids)
+            vector_id = vector_ids[idx]
+            vector = Vector.objects.get(id=vector_id)
+        else:
+            vector = Vector.objects.create(owner=self.user)
+            for dna_id in col_dna_ids:
+                vector.dnas.add(Dna.objects.get(id=dna_id))
+            # add names to vector
+            vector.name = '+'.join([d.name for d in vector.dnas.all()])
+            vector.save()     
+
+        # Sample
+        samp = Sample(assay=Assay.objects.get(id=assay_id), 
+                                media=media, 
+                                strain=strain, 
+                                vector=vector, 
+                                row=pos[str(col)][0], 
+                                col=pos[str(col)][1])
+        samp.save()
+
+        # area as OD
+        # TO DO: Area Signal is created if not exists. Think on a better way
+        try:
+            od_signal = Signal.objects.get(name='Area')
+        except:
+            od_signal = Signal(owner=self.user, name='Area', description='', color='')
+            od_signal.save()
+
+        for idx, r in enumerate(rad[str(col)]):
+            mar = Measurement(sample=samp, signal=od_signal, value=(r**2)*np.pi, time=time_serie[idx])
+            measurements.append(mar)
+
+        # Fluo
+        for f_name in fluo.keys():
+            f_signal = Signal.objects.get(id=signal_map[f_name])
+            for idx, val in enumerate(fluo[f_name][str(col)]):
+                m = Measurement(sample=samp, signal=f_signal, value=val, time=time_serie[idx])
+                measurements.append(m)
+        return measurements
+
+    @sync_to_pool
+    def save_measurements(self, measurements):
+        Measurement.objects.bulk_create(measurements)
+        update_summaries(set([m.sample_id for m in measurements]))
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2026-10-19 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0030_auto_20221118_1227'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sample',
+            name='data_version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
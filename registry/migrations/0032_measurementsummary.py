@@ -0,0 +1,64 @@
+# Generated by Django 3.0.5 on 2026-10-19 18:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def compute_summaries(apps, schema_editor):
+    import pandas as pd
+    from registry.util import summarize_measurements
+    Sample = apps.get_model('registry', 'Sample')
+    Measurement = apps.get_model('registry', 'Measurement')
+    MeasurementSummary = apps.get_model('registry', 'MeasurementSummary')
+    sample_ids = list(Sample.objects.order_by('id').values_list('id', flat=True))
+    for i in range(0, len(sample_ids), 100):
+        chunk = sample_ids[i:i+100]
+        meas = Measurement.objects.filter(sample_id__in=chunk) \
+                        .values_list('sample_id', 'signal_id', 'time', 'value')
+        df = pd.DataFrame.from_records(list(meas), columns=['Sample', 'Signal_id', 'Time', 'Measurement'])
+        summary = summarize_measurements(df)
+        summary = summary.astype(object).where(pd.notnull(summary), None)
+        MeasurementSummary.objects.bulk_create([
+            MeasurementSummary(
+                sample_id=row.Sample,
+                signal_id=row.Signal_id,
+                count=row.count,
+                min=row.min,
+                max=row.max,
+                mean=row.mean,
+                std=row.std,
+                first_time=row.first_time,
+                last_time=row.last_time,
+                auc=row.auc
+            ) for row in summary.itertuples(index=False)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('registry', '0031_sample_data_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeasurementSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField()),
+                ('min', models.FloatField(null=True)),
+                ('max', models.FloatField(null=True)),
+                ('mean', models.FloatField(null=True)),
+                ('std', models.FloatField(null=True)),
+                ('first_time', models.FloatField(null=True)),
+                ('last_time', models.FloatField(null=True)),
+                ('auc', models.FloatField(null=True)),
+                ('sample', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registry.Sample')),
+                ('signal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='registry.Signal')),
+            ],
+            options={
+                'unique_together': {('sample', 'signal')},
+            },
+        ),
+        migrations.RunPython(compute_summaries, migrations.RunPython.noop),
+    ]
@@ -107,6 +107,8 @@ class Sample(models.Model):
     sboluri = models.URLField(blank=True)
     row = models.IntegerField()
     col = models.IntegerField()
+    # Incremented whenever the measurements of the sample change
+    data_version = models.IntegerField(default=0)
 
     def __str__(self):
         return (f"Row: {self.row}, Col: {self.col}")
@@ -132,3 +134,24 @@ class Measurement(models.Model):
 
     def __str__(self):
         return str(self.value)
+
+
+class MeasurementSummary(models.Model):
+    # Statistics of the measurements of a signal in a sample, maintained by
+    # registry.util.update_summaries whenever the measurements change
+    sample = models.ForeignKey(Sample, on_delete=models.CASCADE)
+    signal = models.ForeignKey(Signal, on_delete=models.CASCADE)
+    count = models.IntegerField()
+    min = models.FloatField(null=True)
+    max = models.FloatField(null=True)
+    mean = models.FloatField(null=True)
+    std = models.FloatField(null=True)
+    first_time = models.FloatField(null=True)
+    last_time = models.FloatField(null=True)
+    auc = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = ('sample', 'signal')
+
+    def __str__(self):
+        return str(self.mean)
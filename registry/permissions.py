@@ -1,4 +1,5 @@
 from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
+from .models import Sample, Study
 
 
 class StudyPermission(IsAuthenticated):
@@ -11,7 +12,7 @@ class StudyPermission(IsAuthenticated):
         # so we'll always allow GET, HEAD or OPTIONS requests.
         if request.method in SAFE_METHODS:
             return True
-        return request.user == obj.owner
+        return obj.owner_id == request.user.id
 
 
 class AssayPermission(IsAuthenticated):
@@ -24,7 +25,7 @@ class AssayPermission(IsAuthenticated):
         # so we'll always allow GET, HEAD or OPTIONS requests.
         if request.method in SAFE_METHODS:
             return True
-        return request.user == obj.study.owner
+        return Study.objects.filter(id=obj.study_id, owner=request.user).exists()
 
 
 class MediaPermission(IsAuthenticated):
@@ -38,9 +39,7 @@ class MediaPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            if len(obj.sample_set.all()) == 0 and request.user == obj.owner:
-                return True
-            return False
+            return obj.owner_id == request.user.id and not obj.sample_set.exists()
 
 
 class StrainPermission(IsAuthenticated):
@@ -54,9 +53,7 @@ class StrainPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            if len(obj.sample_set.all()) == 0 and request.user == obj.owner:
-                return True
-            return False
+            return obj.owner_id == request.user.id and not obj.sample_set.exists()
 
 
 class ChemicalPermission(IsAuthenticated):
@@ -68,11 +65,9 @@ class ChemicalPermission(IsAuthenticated):
         # Read permissions are allowed to any request,
         # so we'll always allow GET, HEAD or OPTIONS requests.
         if request.method in SAFE_METHODS:
-            True
+            return True
         else:
-            if len(obj.supplement_set.all()) == 0 and request.user == obj.owner:
-                return True
-            return False
+            return obj.owner_id == request.user.id and not obj.supplement_set.exists()
 
 class SupplementPermission(IsAuthenticated):
     """
@@ -85,9 +80,7 @@ class SupplementPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            if len(obj.samples.all()) == 0 and request.user == obj.owner:
-                return True
-            return False
+            return obj.owner_id == request.user.id and not obj.samples.exists()
 
 
 class DnaPermission(IsAuthenticated):
@@ -101,11 +94,10 @@ class DnaPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            for vector in obj.vectors.all():
-                for sample in vector.sample_set.all():
-                    if request.user != sample.assay.study.owner:
-                        return False
-            return True
+            # Only if all the samples using the dna belong to the user
+            return not Sample.objects.filter(vector__dnas=obj) \
+                                     .exclude(assay__study__owner=request.user) \
+                                     .exists()
 
 
 class VectorPermission(IsAuthenticated):
@@ -119,10 +111,8 @@ class VectorPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            for sample in obj.sample_set.all():
-                if request.user != sample.assay.study.owner:
-                    return False
-            return True
+            # Only if all the samples using the vector belong to the user
+            return not obj.sample_set.exclude(assay__study__owner=request.user).exists()
 
 
 class SamplePermission(IsAuthenticated):
@@ -135,7 +125,7 @@ class SamplePermission(IsAuthenticated):
         # so we'll always allow GET, HEAD or OPTIONS requests.
         if request.method in SAFE_METHODS:
             return True
-        return request.user == obj.assay.study.owner
+        return Study.objects.filter(assay__id=obj.assay_id, owner=request.user).exists()
 
 
 class SignalPermission(IsAuthenticated):
@@ -149,9 +139,7 @@ class SignalPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            if len(obj.measurement_set.all()) == 0 and request.user == obj.owner:
-                return True
-            return False
+            return obj.owner_id == request.user.id and not obj.measurement_set.exists()
 
 
 class MeasurementPermission(IsAuthenticated):
@@ -165,7 +153,7 @@ class MeasurementPermission(IsAuthenticated):
         if request.method in SAFE_METHODS:
             return True
         else:
-            return request.user == obj.sample.assay.study.owner
+            return Study.objects.filter(assay__sample__id=obj.sample_id, owner=request.user).exists()
 
 class UserPermission(IsAuthenticated):
     """
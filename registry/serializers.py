@@ -102,6 +102,7 @@ class SampleSerializerCreate(serializers.ModelSerializer):
 
 class SampleSerializer(serializers.ModelSerializer):
     id = serializers.ReadOnlyField()
+    data_version = serializers.ReadOnlyField()
 
     class Meta:
         model = Sample
@@ -1,3 +1,257 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from .models import *
+from .permissions import *
+from .util import summarize_measurements, update_summaries
 
-# Create your tests here.
+
+class ObjectPermissionTests(TestCase):
+    """
+    Object permission checks must take a fixed number of queries, however
+    many samples use the object
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner')
+        cls.other = User.objects.create(username='other')
+        cls.study = Study.objects.create(name='study', description='', owner=cls.owner, public=False)
+        cls.assay = Assay.objects.create(study=cls.study, name='assay', machine='',
+                                         description='', temperature=30.)
+        cls.media = Media.objects.create(owner=cls.owner, name='media', description='')
+        cls.strain = Strain.objects.create(owner=cls.owner, name='strain', description='')
+        cls.chemical = Chemical.objects.create(owner=cls.owner, name='chemical', description='')
+        cls.supplement = Supplement.objects.create(owner=cls.owner, name='supplement',
+                                                   chemical=cls.chemical, concentration=1.)
+        cls.dna = Dna.objects.create(owner=cls.owner, name='dna')
+        cls.vector = Vector.objects.create(owner=cls.owner, name='vector')
+        cls.vector.dnas.add(cls.dna)
+        cls.signal = Signal.objects.create(owner=cls.owner, name='signal', description='')
+        cls.samples = [
+            Sample.objects.create(assay=cls.assay, media=cls.media, strain=cls.strain,
+                                  vector=cls.vector, row=row, col=col)
+            for row in range(4) for col in range(6)
+        ]
+        cls.measurement = Measurement.objects.create(sample=cls.samples[0], signal=cls.signal,
+                                                     value=1., time=0.)
+
+    def check(self, permission, obj, user, method='PATCH'):
+        request = SimpleNamespace(method=method, user=user)
+        return permission().has_object_permission(request, None, obj)
+
+    def test_safe_methods_without_queries(self):
+        permissions = [
+            (StudyPermission, self.study), (AssayPermission, self.assay),
+            (MediaPermission, self.media), (StrainPermission, self.strain),
+            (ChemicalPermission, self.chemical), (SupplementPermission, self.supplement),
+            (DnaPermission, self.dna), (VectorPermission, self.vector),
+            (SamplePermission, self.samples[0]), (SignalPermission, self.signal),
+            (MeasurementPermission, self.measurement)
+        ]
+        for permission, obj in permissions:
+            with self.assertNumQueries(0):
+                self.assertTrue(self.check(permission, obj, self.other, method='GET'))
+
+    def test_owned_objects(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(self.check(StudyPermission, self.study, self.owner))
+            self.assertFalse(self.check(StudyPermission, self.study, self.other))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.check(AssayPermission, self.assay, self.owner))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check(SamplePermission, self.samples[0], self.other))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.check(MeasurementPermission, self.measurement, self.owner))
+
+    def test_used_objects(self):
+        # Objects used by samples cannot be edited, not even by their owner
+        for permission, obj in [(MediaPermission, self.media),
+                                (StrainPermission, self.strain),
+                                (SignalPermission, self.signal)]:
+            with self.assertNumQueries(1):
+                self.assertFalse(self.check(permission, obj, self.owner))
+            with self.assertNumQueries(0):
+                self.assertFalse(self.check(permission, obj, self.other))
+        unused = Chemical.objects.create(owner=self.owner, name='unused', description='')
+        with self.assertNumQueries(1):
+            self.assertTrue(self.check(ChemicalPermission, unused, self.owner))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check(ChemicalPermission, self.chemical, self.owner))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.check(SupplementPermission, self.supplement, self.owner))
+
+    def test_dna_and_vector(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.check(DnaPermission, self.dna, self.owner))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check(DnaPermission, self.dna, self.other))
+        with self.assertNumQueries(1):
+            self.assertTrue(self.check(VectorPermission, self.vector, self.owner))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check(VectorPermission, self.vector, self.other))
+        # A single sample of another user is enough to forbid edits
+        study = Study.objects.create(name='other', description='', owner=self.other, public=False)
+        assay = Assay.objects.create(study=study, name='other', machine='',
+                                     description='', temperature=30.)
+        Sample.objects.create(assay=assay, vector=self.vector, row=0, col=0)
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check(DnaPermission, self.dna, self.owner))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.check(VectorPermission, self.vector, self.owner))
+
+
+class MetadataVersionTests(TestCase):
+    """
+    Editing metadata joined to the measurements must change the data version
+    of the samples using it, so that stored results and figures are rebuilt
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner')
+        cls.study = Study.objects.create(name='study', description='', owner=cls.owner, public=False)
+        cls.assay = Assay.objects.create(study=cls.study, name='assay', machine='',
+                                         description='', temperature=30.)
+        cls.other_assay = Assay.objects.create(study=cls.study, name='other', machine='',
+                                               description='', temperature=30.)
+        cls.vector = Vector.objects.create(owner=cls.owner, name='vector')
+        cls.signal = Signal.objects.create(owner=cls.owner, name='signal', description='')
+        cls.sample = Sample.objects.create(assay=cls.assay, vector=cls.vector, row=0, col=0)
+        cls.other_sample = Sample.objects.create(assay=cls.other_assay, row=0, col=1)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def versions(self):
+        return [Sample.objects.get(id=samp.id).data_version
+                for samp in [self.sample, self.other_sample]]
+
+    def test_vector_rename(self):
+        response = self.client.patch(f'/api/vector/{self.vector.id}/', {'name': 'renamed'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.versions(), [1, 0])
+
+    def test_assay_rename(self):
+        response = self.client.patch(f'/api/assay/{self.other_assay.id}/', {'name': 'renamed'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.versions(), [0, 1])
+
+    def test_study_rename(self):
+        response = self.client.patch(f'/api/study/{self.study.id}/', {'name': 'renamed'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.versions(), [1, 1])
+
+    def test_signal_recolour(self):
+        # Signals can only be edited before they are measured
+        response = self.client.patch(f'/api/signal/{self.signal.id}/',
+                                     {'name': 'signal', 'description': '', 'color': 'red'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.versions(), [0, 0])
+
+
+
+def summarize_series(t, val):
+    '''
+    Statistics of a single series, as stored in MeasurementSummary
+    '''
+    order = np.argsort(t)
+    t, val = np.asarray(t)[order], np.asarray(val)[order]
+    return {
+        'count': len(val), 'min': val.min(), 'max': val.max(),
+        'mean': val.mean(), 'std': val.std(), 'first_time': t[0], 'last_time': t[-1],
+        'auc': np.sum(0.5 * np.diff(t) * (val[1:] + val[:-1]))
+    }
+
+
+class SummaryTests(TestCase):
+    """
+    Measurement summaries must hold the statistics of the measurements of
+    each sample and signal as they are created, edited and deleted
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(username='owner')
+        cls.study = Study.objects.create(name='study', description='', owner=cls.owner, public=False)
+        cls.assay = Assay.objects.create(study=cls.study, name='assay', machine='',
+                                         description='', temperature=30.)
+        cls.sample = Sample.objects.create(assay=cls.assay, row=0, col=0)
+        cls.signals = [Signal.objects.create(owner=cls.owner, name=name, description='')
+                       for name in ['signal1', 'signal2']]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.rng = np.random.default_rng(0)
+
+    def assertSummary(self, signal):
+        meas = Measurement.objects.filter(sample=self.sample, signal=signal)
+        expected = summarize_series(*zip(*meas.values_list('time', 'value')))
+        summary = MeasurementSummary.objects.get(sample=self.sample, signal=signal)
+        for field, value in expected.items():
+            self.assertAlmostEqual(getattr(summary, field), value, places=9, msg=field)
+
+    def test_summarize_measurements(self):
+        rows = []
+        for samp_id in [2, 1]:
+            for signal_id in [1, 3]:
+                t = self.rng.permutation(np.arange(10.))
+                rows.append(pd.DataFrame({'Sample': samp_id, 'Signal_id': signal_id, 'Time': t,
+                                          'Measurement': self.rng.uniform(size=10)}))
+        df = pd.concat(rows)
+        summary = summarize_measurements(df.sample(frac=1, random_state=0))
+        self.assertEqual(list(zip(summary['Sample'], summary['Signal_id'])),
+                         [(1, 1), (1, 3), (2, 1), (2, 3)])
+        for row in summary.itertuples(index=False):
+            series = df[(df['Sample']==row.Sample) & (df['Signal_id']==row.Signal_id)]
+            expected = summarize_series(series['Time'].values, series['Measurement'].values)
+            for field, value in expected.items():
+                self.assertAlmostEqual(getattr(row, field), value, places=12)
+        self.assertEqual(len(summarize_measurements(df.iloc[0:0])), 0)
+
+    def test_api_create(self):
+        # Points added before, after and between those already uploaded
+        times = self.rng.permutation(np.arange(30.))
+        queries = []
+        for i, t in enumerate(times):
+            signal = self.signals[i % 2]
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.post('/api/measurement/', {
+                    'sample': self.sample.id, 'signal': signal.id,
+                    'time': t, 'value': self.rng.uniform()
+                })
+            self.assertEqual(response.status_code, 201)
+            queries.append(len(context))
+            self.assertSummary(signal)
+        # Each upload takes the same number of queries however many
+        # measurements the sample already has
+        self.assertEqual(len(set(queries[2:])), 1)
+        self.assertEqual(Sample.objects.get(id=self.sample.id).data_version, 30)
+
+    def test_api_edit_and_delete(self):
+        signal = self.signals[0]
+        Measurement.objects.bulk_create([
+            Measurement(sample=self.sample, signal=signal, time=t, value=self.rng.uniform())
+            for t in range(10)
+        ])
+        update_summaries([self.sample.id])
+        meas = Measurement.objects.filter(sample=self.sample, signal=signal).order_by('time')
+        response = self.client.patch(f'/api/measurement/{meas[3].id}/', {'value': 5.})
+        self.assertEqual(response.status_code, 200)
+        self.assertSummary(signal)
+        response = self.client.delete(f'/api/measurement/{meas[0].id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertSummary(signal)
+        # A repeated time is added by recomputing the series
+        response = self.client.post('/api/measurement/', {
+            'sample': self.sample.id, 'signal': signal.id, 'time': 5., 'value': 2.
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertSummary(signal)
@@ -1,8 +1,10 @@
 from registry.models import *
+from django.db import transaction
+from django.db.models import F
 from django_pandas.io import read_frame
 import pandas as pd
 import numpy as np
-import time
+from flapjack_api.timing import span
 
 field_names = [
     'signal__id',
@@ -45,9 +47,6 @@ pretty_field_names = {
 }
 
 def get_samples(filter):
-    print('get_samples', flush=True)
-    start = time.time()
-    print(f"filter: {filter}", flush=True)
     studies = filter.get('study')
     assays = filter.get('assay')
     vectors = filter.get('vector')
@@ -80,26 +79,31 @@ def get_samples(filter):
     if not filter_exist:
         s = Sample.objects.none()
 
-    end = time.time()
-    print('get_samples took %f seconds'%(end-start), flush=True)
     return s
 
 # Get dataframe of measurement values for a set of samples in a query
 # -----------------------------------------------------------------------------------
 def get_measurements(samples, signals=None):
     # Get measurements for a given samples
-    print('get_measurements', flush=True)
-    start = time.time()
-    samp_ids = [samp.id for samp in samples]
-    meas = Measurement.objects.filter(sample__id__in=samp_ids)
-    # Filter by signal
-    if signals:
-        meas = meas.filter(signal__id__in=signals)
-
-    # Get pandas dataframe 
-    df_all = read_frame(meas, fieldnames=field_names)
-    df_all.columns = [pretty_field_names[col] for col in df_all.columns]
+    with span('query.measurements'):
+        samp_ids = [samp.id for samp in samples]
+        meas = Measurement.objects.filter(sample__id__in=samp_ids)
+        # Filter by signal
+        if signals:
+            meas = meas.filter(signal__id__in=signals)
 
+        # Get pandas dataframe 
+        df_all = read_frame(meas, fieldnames=field_names)
+        df_all.columns = [pretty_field_names[col] for col in df_all.columns]
+
+    with span('query.chemical_pivot', samples=len(samp_ids)):
+        return pivot_chemicals(df_all)
+
+def pivot_chemicals(df_all):
+    '''
+    Join the rows of each sample that differ only in the supplement, so that
+    there is one column per chemical (Supplement1, Concentration1, ...)
+    '''
     results = []
     for samp_id,df in df_all.groupby('Sample'):
         # Merge to get one column per chemical for the relevant columns
@@ -113,8 +117,6 @@ def get_measurements(samples, signals=None):
         chemicals = df.Chemical.unique()
         # If no chemicals we are done...
         if len(chemicals)==0:
-            end = time.time()
-            print('No chemicals found, get_measurements took ', end-start, flush=True)
             results.append(df)
         else:
             # Do recursive join over all chemicals
@@ -122,13 +124,13 @@ def get_measurements(samples, signals=None):
                 merge = df[df.Chemical==chemicals[0]]
             else:
                 merge = df[pd.isnull(df.Chemical)]
-            
+        
             for i in range(1, len(chemicals)):
                 chemical = chemicals[i]
                 if chemical:
                     to_merge = df[df.Chemical==chemical]
                     merge = merge.merge(to_merge, on=on, suffixes=['', str(i+1)])
-                
+            
             # Original supplement becomes Supplement1 etc.
             merge = merge.rename(columns={
                 'Supplement': 'Supplement1',
@@ -151,14 +153,155 @@ def get_measurements(samples, signals=None):
             if len(merge) == 0:
                 print('get_measurements: no measurements after chemical merge', flush=True)
             results.append(merge)
-    
-    end = time.time()
-    print('get_measurements took ', end-start, flush=True)
+
     if len(results) > 0:
         return pd.concat(results, ignore_index=True)
     else:
         return pd.DataFrame()
 
+# Summary statistics of the measurements of each sample and signal
+# -----------------------------------------------------------------------------------
+summary_field_names = [
+    {'value': 'mean', 'time': 'first_time'}.get(field, field) for field in field_names
+] + ['count', 'min', 'max', 'std', 'last_time', 'auc']
+
+pretty_summary_field_names = dict(pretty_field_names, 
+    mean='Measurement',
+    first_time='Time',
+    count='Count',
+    min='Min',
+    max='Max',
+    std='Std',
+    last_time='Last Time',
+    auc='AUC'
+)
+
+def get_summaries(samples, signals=None):
+    '''
+    Dataframe of measurement summaries with the same columns as
+    get_measurements, one row per sample and signal. Measurement is the
+    mean and Time the first time of the measurements, the other statistics
+    are in the columns Count, Min, Max, Std, Last Time and AUC
+    '''
+    with span('query.summaries'):
+        samp_ids = [samp.id for samp in samples]
+        summ = MeasurementSummary.objects.filter(sample__id__in=samp_ids)
+        if signals:
+            summ = summ.filter(signal__id__in=signals)
+        df_all = read_frame(summ, fieldnames=summary_field_names)
+        df_all.columns = [pretty_summary_field_names[col] for col in df_all.columns]
+    return pivot_chemicals(df_all)
+
+def summarize_measurements(df):
+    '''
+    Compute the statistics stored in MeasurementSummary for each (Sample,
+    Signal_id) in a dataframe with columns Sample, Signal_id, Time and
+    Measurement. The standard deviation is the population one (ddof=0) and
+    AUC is the trapezoid rule integral over time.
+    '''
+    columns = ['Sample', 'Signal_id', 'count', 'min', 'max', 'mean', 'std', 
+                'first_time', 'last_time', 'auc']
+    if len(df)==0:
+        return pd.DataFrame(columns=columns)
+    df = df.sort_values(['Sample', 'Signal_id', 'Time'])
+    grouped = df.groupby(['Sample', 'Signal_id'], sort=False)
+    summary = grouped['Measurement'].agg(['count', 'min', 'max', 'mean'])
+    summary['std'] = grouped['Measurement'].std(ddof=0)
+    summary['first_time'] = grouped['Time'].min()
+    summary['last_time'] = grouped['Time'].max()
+
+    # Trapezoid areas, zero across series boundaries
+    t = df['Time'].values.astype(float)
+    val = df['Measurement'].values.astype(float)
+    codes = grouped.ngroup().values
+    starts = np.flatnonzero(np.r_[True, codes[1:]!=codes[:-1]])
+    area = np.zeros_like(val)
+    area[1:] = 0.5 * (t[1:] - t[:-1]) * (val[1:] + val[:-1])
+    area[starts] = 0.
+    summary['auc'] = np.add.reduceat(area, starts)
+    return summary.reset_index()[columns]
+
+def update_summaries(sample_ids, signal_ids=None):
+    '''
+    Recompute the measurement summaries of the samples, only those of the
+    signals in signal_ids if given
+    '''
+    sample_ids = list(sample_ids)
+    meas = Measurement.objects.filter(sample__id__in=sample_ids)
+    summ = MeasurementSummary.objects.filter(sample__id__in=sample_ids)
+    if signal_ids is not None:
+        meas = meas.filter(signal__id__in=list(signal_ids))
+        summ = summ.filter(signal__id__in=list(signal_ids))
+    meas = meas.values_list('sample_id', 'signal_id', 'time', 'value')
+    df = pd.DataFrame.from_records(list(meas), columns=['Sample', 'Signal_id', 'Time', 'Measurement'])
+    summary = summarize_measurements(df)
+    # Missing statistics (e.g. std of NaN values) are stored as NULL
+    summary = summary.astype(object).where(pd.notnull(summary), None)
+    summaries = [
+        MeasurementSummary(
+            sample_id=row.Sample,
+            signal_id=row.Signal_id,
+            count=row.count,
+            min=row.min,
+            max=row.max,
+            mean=row.mean,
+            std=row.std,
+            first_time=row.first_time,
+            last_time=row.last_time,
+            auc=row.auc
+            ) for row in summary.itertuples(index=False)
+        ]
+    with transaction.atomic():
+        summ.delete()
+        MeasurementSummary.objects.bulk_create(summaries)
+
+def add_to_summary(measurement):
+    '''
+    Add a new measurement to the summary of its sample and signal without
+    reading the other measurements, the AUC is updated from its neighbours
+    in time. The summary is recomputed if it cannot be updated exactly.
+    '''
+    sample_id, signal_id = measurement.sample_id, measurement.signal_id
+    t, val = measurement.time, measurement.value
+    others = Measurement.objects.filter(sample_id=sample_id, signal_id=signal_id) \
+                                .exclude(id=measurement.id)
+    summary = MeasurementSummary.objects.filter(sample_id=sample_id, signal_id=signal_id).first()
+    if summary is None or None in [summary.mean, summary.std, summary.auc] \
+            or not np.isfinite([t, val]).all() or others.filter(time=t).exists():
+        # New series, missing values, or times whose order is not defined
+        update_summaries([sample_id], [signal_id])
+        return
+
+    # Running mean and population variance
+    count = summary.count + 1
+    delta = val - summary.mean
+    mean = summary.mean + delta / count
+    var = (summary.std**2 * summary.count + delta * (val - mean)) / count
+
+    # The new point splits the trapezoid between its neighbours
+    def area(p, q):
+        return 0.5 * (q[0] - p[0]) * (p[1] + q[1])
+    prev = others.filter(time__lt=t).order_by('-time').values_list('time', 'value').first()
+    next = others.filter(time__gt=t).order_by('time').values_list('time', 'value').first()
+    auc = summary.auc
+    if prev:
+        auc += area(prev, (t, val))
+    if next:
+        auc += area((t, val), next)
+    if prev and next:
+        auc -= area(prev, next)
+
+    MeasurementSummary.objects.filter(id=summary.id).update(
+        count=count,
+        min=min(summary.min, val),
+        max=max(summary.max, val),
+        mean=mean,
+        std=np.sqrt(max(var, 0.)),
+        first_time=min(summary.first_time, t),
+        last_time=max(summary.last_time, t),
+        auc=auc
+    )
+
 def get_biomass(df, biomass_signal):
     samp_ids = df.Sample.unique()
     s = Sample.objects.all()
@@ -182,4 +325,37 @@ def upload_measurements(df, sample, signal):
     if len(measurements)==0:
         return False
     Measurement.objects.bulk_create(measurements)
+    measurements_changed([samp.id])
     return True
+
+def bump_data_version(sample_ids):
+    '''
+    Mark the measurements of the samples as changed, so that stored analysis
+    results for them are recomputed
+    '''
+    Sample.objects.filter(id__in=list(sample_ids)).update(data_version=F('data_version')+1)
+
+def measurements_changed(sample_ids, signal_ids=None):
+    '''
+    Update the data version and measurement summaries of samples whose
+    measurements were created, edited or deleted, only the summaries of the
+    signals in signal_ids if given
+    '''
+    bump_data_version(sample_ids)
+    update_summaries(sample_ids, signal_ids)
+
+def measurement_added(measurement):
+    '''
+    Update the data version and summary of the sample of a single new
+    measurement, in constant time however many measurements it has
+    '''
+    bump_data_version([measurement.sample_id])
+    add_to_summary(measurement)
+
+def metadata_changed(samples):
+    '''
+    Update the data version of the samples in the queryset samples when the
+    names, colours or concentrations joined to their measurements changed,
+    since stored analysis results and plot figures include them
+    '''
+    Sample.objects.filter(id__in=samples.values('id')).update(data_version=F('data_version')+1)
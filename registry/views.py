@@ -9,6 +9,7 @@ from rest_framework_filters.backends import RestFrameworkFilterBackend
 from .models import *
 from .serializers import *
 from .permissions import *
+from .util import bump_data_version, measurement_added, measurements_changed, metadata_changed
 import django_filters
 
 
@@ -157,6 +158,10 @@ class StudyViewSet(viewsets.ModelViewSet):
     filterset_class = StudyFilter
     search_fields = ['name',  'description', 'doi', 'sboluri']
     
+    def perform_update(self, serializer):
+        study = serializer.save()
+        metadata_changed(Sample.objects.filter(assay__study=study))
+
     def get_queryset(self):
         user = self.request.user
         return Study.objects.filter(
@@ -184,6 +189,10 @@ class AssayViewSet(viewsets.ModelViewSet):
         'sboluri'
     ]
 
+    def perform_update(self, serializer):
+        assay = serializer.save()
+        metadata_changed(Sample.objects.filter(assay=assay))
+
     def get_queryset(self):
         user = self.request.user
         return Assay.objects.filter(
@@ -204,6 +213,10 @@ class MediaViewSet(viewsets.ModelViewSet):
     filter_class = MediaFilter
     search_fields = ['name', 'description', 'sboluri']
 
+    def perform_update(self, serializer):
+        media = serializer.save()
+        metadata_changed(Sample.objects.filter(media=media))
+
 
 class StrainViewSet(viewsets.ModelViewSet):
     """
@@ -216,6 +229,10 @@ class StrainViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter, RestFrameworkFilterBackend]
     search_fields = ['name', 'description', 'sboluri']
 
+    def perform_update(self, serializer):
+        strain = serializer.save()
+        metadata_changed(Sample.objects.filter(strain=strain))
+
 
 class ChemicalViewSet(viewsets.ModelViewSet):
     """
@@ -228,6 +245,10 @@ class ChemicalViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter, RestFrameworkFilterBackend]
     search_fields = ['name', 'description', 'sboluri']
 
+    def perform_update(self, serializer):
+        chemical = serializer.save()
+        metadata_changed(Sample.objects.filter(supplements__chemical=chemical))
+
 
 class SupplementViewSet(viewsets.ModelViewSet):
     """
@@ -240,6 +261,10 @@ class SupplementViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter, RestFrameworkFilterBackend]
     search_fields = ['name', 'sboluri']
 
+    def perform_update(self, serializer):
+        supplement = serializer.save()
+        metadata_changed(Sample.objects.filter(supplements=supplement))
+
 
 class DnaViewSet(viewsets.ModelViewSet):
     """
@@ -276,6 +301,10 @@ class VectorAllViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter, RestFrameworkFilterBackend]
     search_fields = ['name', 'sboluri']
 
+    def perform_update(self, serializer):
+        vector = serializer.save()
+        metadata_changed(Sample.objects.filter(vector=vector))
+
     def get_queryset(self):
         user = self.request.user
         return Vector.objects.filter(
@@ -297,6 +326,10 @@ class VectorViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter, RestFrameworkFilterBackend]
     search_fields = ['name', 'sboluri']
 
+    def perform_update(self, serializer):
+        vector = serializer.save()
+        metadata_changed(Sample.objects.filter(vector=vector))
+
     def get_queryset(self):
         user = self.request.user
         return Vector.objects.filter(
@@ -332,6 +365,10 @@ class SampleViewSet(viewsets.ModelViewSet):
         else:
             return SampleSerializer
 
+    def perform_update(self, serializer):
+        sample = serializer.save()
+        bump_data_version([sample.id])
+
     def get_queryset(self):
         user = self.request.user
         return Sample.objects.filter(
@@ -352,6 +389,10 @@ class SignalViewSet(viewsets.ModelViewSet):
     filter_backends = [SearchFilter, RestFrameworkFilterBackend]
     search_fields = ['name', 'description', 'color', 'sboluri']
 
+    def perform_update(self, serializer):
+        signal = serializer.save()
+        metadata_changed(Sample.objects.filter(measurement__signal=signal))
+
 
 class MeasurementViewSet(viewsets.ModelViewSet):
     """
@@ -367,6 +408,20 @@ class MeasurementViewSet(viewsets.ModelViewSet):
         'sample__assay__name', 
         'sample__assay__study__name']
 
+    def perform_create(self, serializer):
+        measurement = serializer.save()
+        measurement_added(measurement)
+
+    def perform_update(self, serializer):
+        old = serializer.instance.sample_id, serializer.instance.signal_id
+        measurement = serializer.save()
+        measurements_changed([old[0], measurement.sample_id], [old[1], measurement.signal_id])
+
+    def perform_destroy(self, instance):
+        sample_id, signal_id = instance.sample_id, instance.signal_id
+        instance.delete()
+        measurements_changed([sample_id], [signal_id])
+
     def get_queryset(self):
         user = self.request.user
         return Measurement.objects.filter(